@@ -0,0 +1,104 @@
+import threading
+from typing import Callable, Tuple
+from core.cost import RenderCost
+
+# What happens to a render whose estimated cost is over the budget
+POLICIES = ('downscale', 'reject', 'defer')
+# Job priority of the deferred renders, RenderJobQueue serves the lower ones first
+DEFERRED_PRIORITY = 1
+
+
+class RenderTooExpensive(Exception):
+    def __init__(self, message: str, cost: RenderCost):
+        super().__init__(message)
+        self.cost = cost
+
+
+class AdmissionControl:
+    """
+        Decides what happens to a render from its estimated cost (core.cost.estimate_cost, in
+        intersection tests). Renders within budget are admitted, the others are downscaled to fit
+        it, rejected, or deferred behind the renders within budget when they go through the job
+        queue, depending on the policy. Renders over limit are rejected instead of being deferred
+        (0 is no limit), and a budget of 0 admits everything.
+    """
+
+    def __init__(self, budget: float, limit: float = 0, policy: str = 'downscale'):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown admission policy '{policy}', expected one of {list(POLICIES)}")
+        self.budget = budget
+        self.limit = limit
+        self.policy = policy
+        self.admitted = 0
+        self.downscaled = 0
+        self.deferred = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def within_budget(self, cost: RenderCost) -> bool:
+        return not self.budget or cost.intersection_tests <= self.budget
+
+    def admit(self, screen_size: Tuple[int, int], cost: RenderCost,
+              estimate: Callable[[Tuple[int, int]], RenderCost],
+              queued: bool = False) -> Tuple[str, Tuple[int, int], RenderCost]:
+        """
+            The decision ('admit', 'downscale' or 'defer', only for queued renders), the resolution
+            to render at and its cost. estimate gives the cost of the render at another
+            resolution. Raises RenderTooExpensive when the render is rejected.
+        """
+        if self.within_budget(cost):
+            decision = 'admit'
+        elif self.policy == 'downscale':
+            decision = 'downscale'
+            screen_size, cost = self.downscale(screen_size, cost, estimate)
+        elif self.limit and cost.intersection_tests > self.limit:
+            self.reject(cost, f"over the limit of {self.limit:.0f}")
+        elif self.policy == 'defer' and queued:
+            decision = 'defer'
+        else:
+            hint = ", submit it to /jobs" if self.policy == 'defer' else ""
+            self.reject(cost, f"over the budget of {self.budget:.0f}{hint}")
+        with self.lock:
+            if decision == 'admit':
+                self.admitted += 1
+            elif decision == 'downscale':
+                self.downscaled += 1
+            else:
+                self.deferred += 1
+        return decision, screen_size, cost
+
+    def downscale(self, screen_size: Tuple[int, int], cost: RenderCost,
+                  estimate: Callable[[Tuple[int, int]], RenderCost]) -> Tuple[Tuple[int, int], RenderCost]:
+        """
+            The largest resolution with the aspect ratio of screen_size that fits the budget,
+            starting from the one the cost per pixel gives and shrinking by 10% until it fits.
+        """
+        width, height = screen_size
+        scale = (self.budget / cost.intersection_tests) ** 0.5
+        while True:
+            size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            cost = estimate(size)
+            if self.within_budget(cost):
+                return size, cost
+            if size == (1, 1):
+                self.reject(cost, f"over the budget of {self.budget:.0f} even at 1x1")
+            scale *= 0.9
+
+    def reject(self, cost: RenderCost, reason: str):
+        with self.lock:
+            self.rejected += 1
+        raise RenderTooExpensive(
+            f"Render too expensive: about {cost.intersection_tests:.0f} intersection tests, {reason}", cost)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'budget': self.budget,
+                'limit': self.limit,
+                'policy': self.policy,
+                'admitted': self.admitted,
+                'downscaled': self.downscaled,
+                'deferred': self.deferred,
+                'rejected': self.rejected,
+            }
+
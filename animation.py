@@ -0,0 +1,208 @@
+import io
+import os
+import copy
+import zipfile
+import numpy as np
+from multiprocessing import Pool
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from core.light_index import LightIndex
+from core.lights import Light
+from core.objects import SceneObject
+from core.png import decode_raw, encode_png, encode_raw
+from core.scene import Scene
+from core.utils import normalize
+from renders import trace_scene, wavefront_trace_scene
+
+# Light attributes that can be keyframed
+LIGHT_ATTRIBUTES = ('position', 'intensity', 'direction')
+
+# Frame renderers by engine name, every worker renders whole frames
+ENGINES: Dict[str, Callable[[Scene], np.ndarray]] = {
+    'scalar': trace_scene,
+    'wavefront': wavefront_trace_scene,
+}
+
+
+class Track:
+    """
+        A keyframed vector, linearly interpolated between its keyframes and held before the first
+        one and after the last one.
+    """
+
+    def __init__(self, keys: List[Tuple[float, np.ndarray]]):
+        if not keys:
+            raise ValueError("A track needs at least one keyframe")
+        keys = sorted(keys, key=lambda key: key[0])
+        self.frames = np.array([frame for frame, _ in keys], dtype=float)
+        self.values = np.array([np.asarray(value, dtype=float).reshape(-1) for _, value in keys])
+
+    def at(self, frame: float) -> np.ndarray:
+        return np.array([np.interp(frame, self.frames, self.values[:, k]) for k in range(self.values.shape[1])])
+
+
+class Animation:
+    """
+        A base scene and keyframed tracks: the camera position, light attributes by (light index,
+        attribute) and object translations by object index. Every frame is the base scene with
+        the tracks applied. Without object tracks the geometry is static, so the BVH and compiled
+        scene of the base scene are built once (per worker) and shared by all the frames.
+    """
+
+    def __init__(self, camera: np.ndarray, ambient: np.ndarray, lights: List[Light], objects: List[SceneObject],
+                 frames: int, screen_size: Tuple[int, int], max_depth: int, camera_track: Optional[Track] = None,
+                 light_tracks: Optional[Dict[Tuple[int, str], Track]] = None,
+                 object_tracks: Optional[Dict[int, Track]] = None, **options):
+        self.camera = camera
+        self.ambient = ambient
+        self.lights = lights
+        self.objects = objects
+        self.frames = frames
+        self.screen_size = screen_size
+        self.max_depth = max_depth
+        self.camera_track = camera_track
+        self.light_tracks = light_tracks or {}
+        self.object_tracks = object_tracks or {}
+        # Render settings of Scene (anti-aliasing, precision, crop...)
+        self.options = options
+
+    @property
+    def static_geometry(self) -> bool:
+        return not self.object_tracks
+
+    def base_scene(self) -> Scene:
+        return Scene(self.camera, self.ambient, self.lights, self.objects, self.screen_size, self.max_depth,
+                     **self.options)
+
+    def frame_scene(self, frame: int, base: Optional[Scene] = None) -> Scene:
+        """
+            The scene of a frame. base is the base_scene, it is reused when the geometry is static.
+        """
+        camera = self.camera if self.camera_track is None else self.camera_track.at(frame)
+        lights = list(self.lights)
+        for (index, attribute), track in self.light_tracks.items():
+            light = lights[index] = copy.copy(lights[index])
+            value = track.at(frame)
+            setattr(light, attribute, normalize(value) if attribute == 'direction' else value)
+
+        if self.static_geometry and base is not None:
+            scene = copy.copy(base)
+            scene.camera, scene.lights = camera, lights
+            if base.light_index is not None:
+                scene.light_index = LightIndex(lights, base.light_cutoff, base.light_samples)
+            if base.compiled is not None:
+                scene.compiled = base.compiled.with_camera(camera)
+        else:
+            objects = [obj if index not in self.object_tracks else obj.translated(self.object_tracks[index].at(frame))
+                       for index, obj in enumerate(self.objects)]
+            scene = Scene(camera, self.ambient, lights, objects, self.screen_size, self.max_depth, **self.options)
+        # Random choices (Russian roulette) only depend on the frame
+        scene.rng = np.random.default_rng((scene.seed, frame))
+        return scene
+
+
+def parse_animation(animation_data: dict, camera: np.ndarray, ambient: np.ndarray, lights: List[Light],
+                    objects: List[SceneObject], screen_size: Tuple[int, int], max_depth: int,
+                    **options) -> Animation:
+    """
+        Reads the keyframes of an animation request:
+        {"frames": 24,
+         "camera": [{"frame": 0, "position": [0, 0, 1]}, ...],
+         "lights": [{"light": 0, "frame": 0, "position": [...], "intensity": [...], "direction": [...]}, ...],
+         "objects": [{"object": 2, "frame": 0, "translation": [0, 0, 0]}, ...]}
+        Light and object indices are positions in the lists of the scene.
+    """
+    frames = int(animation_data['frames'])
+    if frames < 1:
+        raise ValueError("An animation needs at least one frame")
+
+    camera_keys = [(float(key['frame']), key['position']) for key in animation_data.get('camera', [])]
+
+    light_keys: Dict[Tuple[int, str], list] = {}
+    for key in animation_data.get('lights', []):
+        index = checked_index(key['light'], lights, 'light')
+        for attribute in LIGHT_ATTRIBUTES:
+            if attribute in key:
+                light_keys.setdefault((index, attribute), []).append((float(key['frame']), key[attribute]))
+
+    object_keys: Dict[int, list] = {}
+    for key in animation_data.get('objects', []):
+        index = checked_index(key['object'], objects, 'object')
+        object_keys.setdefault(index, []).append((float(key['frame']), key['translation']))
+
+    return Animation(camera, ambient, lights, objects, frames, screen_size, max_depth,
+                     Track(camera_keys) if camera_keys else None,
+                     {name: Track(keys) for name, keys in light_keys.items()},
+                     {index: Track(keys) for index, keys in object_keys.items()}, **options)
+
+
+def checked_index(value, items: list, name: str) -> int:
+    index = int(value)
+    if not 0 <= index < len(items):
+        raise ValueError(f"Unknown {name} {index}, the scene has {len(items)}")
+    return index
+
+
+# Each pool worker keeps the animation, its engine and the base scene shared by the frames
+_worker_animation: Optional[Animation] = None
+_worker_engine: Optional[Callable[[Scene], np.ndarray]] = None
+_worker_base: Optional[Scene] = None
+
+
+def init_animation_worker(animation: Animation, engine: str):
+    global _worker_animation, _worker_engine, _worker_base
+    _worker_animation = animation
+    _worker_engine = ENGINES[engine]
+    _worker_base = animation.base_scene() if animation.static_geometry else None
+    if _worker_base is not None and engine == 'wavefront':
+        _worker_base.compile()
+
+
+def render_frame(frame: int) -> Tuple[int, Tuple[bytes, Tuple[int, ...]]]:
+    # Frames only go to PNG, so they are sent back as 8 bit pixels instead of float images
+    return frame, encode_raw(_worker_engine(_worker_animation.frame_scene(frame, _worker_base)))
+
+
+def render_animation(animation: Animation, engine: str = 'wavefront',
+                     processes: Optional[int] = None) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+        Renders the frames on one process pool and yields (frame, image) as soon as every frame
+        is finished, not in frame order; the images are 8 bit (to_uint8). The animation is sent once per worker and a worker
+        renders whole frames, so the pool and the static geometry are set up once for the whole
+        sequence. Closing the generator early terminates the pool.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', expected one of {list(ENGINES)}")
+    with Pool(processes, initializer=init_animation_worker, initargs=(animation, engine)) as pool:
+        for frame, raw in pool.imap_unordered(render_frame, range(animation.frames), chunksize=1):
+            yield frame, decode_raw(*raw)
+
+
+def frame_name(frame: int) -> str:
+    return f"frame_{frame:04d}.png"
+
+
+def save_animation(animation: Animation, directory: str, engine: str = 'wavefront',
+                   processes: Optional[int] = None) -> List[str]:
+    """
+        Writes every frame to directory as frame_0000.png, frame_0001.png... as soon as it is
+        rendered, returns the paths in frame order.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for frame, image in render_animation(animation, engine, processes):
+        paths[frame] = os.path.join(directory, frame_name(frame))
+        with open(paths[frame], 'wb') as file:
+            file.write(encode_png(image))
+    return [paths[frame] for frame in sorted(paths)]
+
+
+def pack_frames(frames: Dict[int, bytes]) -> bytes:
+    """
+        Packs encoded frames into a zip archive of frame_0000.png, frame_0001.png...
+    """
+    bytes_io = io.BytesIO()
+    # PNG data is already compressed
+    with zipfile.ZipFile(bytes_io, 'w', zipfile.ZIP_STORED) as archive:
+        for frame in sorted(frames):
+            archive.writestr(frame_name(frame), frames[frame])
+    return bytes_io.getvalue()
@@ -0,0 +1,71 @@
+"""
+    Renders the standard scenes with the scalar renderer and compares the counters of the
+    instrumentation with the estimates of core.cost, the constants of the cost model are
+    calibrated with this report.
+
+    python -m benchmarks.cost
+    python -m benchmarks.cost --scenes mirrors glass --resolutions 64x48 --depths 3 --samples 4
+"""
+import sys
+import json
+import time
+import argparse
+from typing import List, Optional, Tuple
+from renders import render_scene
+from core.cost import estimate_cost
+from core.instrumentation import RenderStats
+from .run import parse_resolution
+from .scenes import SCENES
+
+
+def compare(scene: str, screen_size: Tuple[int, int], max_depth: int, max_samples: int) -> dict:
+    data = SCENES[scene]()
+    estimate = estimate_cost(*data, screen_size, max_depth, max_samples=max_samples)
+    stats = RenderStats()
+    start = time.perf_counter()
+    render_scene(*data, screen_size, max_depth, stats=stats, max_samples=max_samples)
+    seconds = time.perf_counter() - start
+    counters = stats.counters()
+    return {
+        'scene': scene,
+        'resolution': list(screen_size),
+        'max_depth': max_depth,
+        'max_samples': max_samples,
+        'time': seconds,
+        'estimate': estimate.to_dict(),
+        'actual': {
+            'rays': {kind: sum(depths.values()) for kind, depths in counters['rays'].items()},
+            'total_rays': counters['total_rays'],
+            'intersection_tests': counters['intersection_tests'],
+        },
+        # Above 1 the estimate is too high
+        'rays_ratio': estimate.total_rays / counters['total_rays'],
+        'tests_ratio': estimate.intersection_tests / max(counters['intersection_tests'], 1),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Render cost estimates against real renders")
+    parser.add_argument('--scenes', nargs='+', default=list(SCENES), choices=list(SCENES))
+    parser.add_argument('--resolutions', nargs='+', type=parse_resolution, default=[(32, 24)])
+    parser.add_argument('--depths', nargs='+', type=int, default=[1, 3])
+    parser.add_argument('--samples', nargs='+', type=int, default=[1, 4])
+    args = parser.parse_args(argv)
+
+    results = [compare(scene, screen_size, max_depth, max_samples)
+               for scene in args.scenes
+               for screen_size in args.resolutions
+               for max_depth in args.depths
+               for max_samples in args.samples]
+    print(json.dumps({
+        'results': results,
+        'rays_ratio': [min(result['rays_ratio'] for result in results),
+                       max(result['rays_ratio'] for result in results)],
+        'tests_ratio': [min(result['tests_ratio'] for result in results),
+                        max(result['tests_ratio'] for result in results)],
+    }, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+    Renders the standard scenes with the ray kernels of core.jit and with the scalar reference
+    renderer and compares the images and the ray and hit counters. The kernels are compiled when
+    numba is installed and run as plain python otherwise (slowly, but with the same results), so
+    they can be checked on any machine.
+
+    python -m benchmarks.parity
+    python -m benchmarks.parity --scenes example mesh_100k --resolutions 32x24 --depths 3
+
+    The exit status is 1 when an image differs by more than the tolerance or a counter differs.
+"""
+import sys
+import json
+import argparse
+import numpy as np
+from typing import List, Optional, Tuple
+from renders import jit_trace_scene, trace_scene
+from core.instrumentation import RenderStats
+from core.jit import jit_available
+from core.scene import Scene
+from .run import parse_resolution
+from .scenes import SCENES
+
+# Settings every scene is rendered with besides the defaults, they cover anti-aliasing, secondary
+# ray pruning, light culling and the float32 image
+VARIANTS = {
+    'default': {},
+    'antialiased': {'max_samples': 4},
+    'pruned': {'min_weight': 0.1, 'light_cutoff': 0.05},
+    'no_shadows': {'shadows': False},
+    'float32': {'precision': 'float32'},
+}
+
+
+def compare(scene: str, screen_size: Tuple[int, int], max_depth: int, variant: str, tolerance: float) -> dict:
+    data = SCENES[scene]()
+    options = VARIANTS[variant]
+    reference_stats, jit_stats = RenderStats(), RenderStats()
+    reference = trace_scene(Scene(*data, screen_size, max_depth, stats=reference_stats, **options))
+    image = jit_trace_scene(Scene(*data, screen_size, max_depth, stats=jit_stats, **options))
+    difference = float(np.abs(image.astype(float) - reference).max())
+    # The kernels test every primitive instead of walking the scene BVH, so only the rays and the
+    # hits are compared
+    counters = reference_stats.counters(), jit_stats.counters()
+    same_counters = all(counters[0][key] == counters[1][key] for key in ('rays', 'hits'))
+    return {
+        'scene': scene,
+        'resolution': list(screen_size),
+        'max_depth': max_depth,
+        'variant': variant,
+        'max_difference': difference,
+        'same_counters': same_counters,
+        'passed': difference <= tolerance and same_counters,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Parity of the JIT kernels with the reference renderer")
+    parser.add_argument('--scenes', nargs='+', default=list(SCENES), choices=list(SCENES))
+    parser.add_argument('--resolutions', nargs='+', type=parse_resolution, default=[(24, 18)])
+    parser.add_argument('--depths', nargs='+', type=int, default=[1, 3])
+    parser.add_argument('--variants', nargs='+', default=list(VARIANTS), choices=list(VARIANTS))
+    parser.add_argument('--tolerance', type=float, default=1e-6,
+                        help="largest allowed channel difference with the reference image")
+    args = parser.parse_args(argv)
+
+    results = [compare(scene, screen_size, max_depth, variant, args.tolerance)
+               for scene in args.scenes
+               for screen_size in args.resolutions
+               for max_depth in args.depths
+               for variant in args.variants]
+    report = {
+        'compiled': jit_available(),
+        'results': results,
+        'passed': all(result['passed'] for result in results),
+    }
+    print(json.dumps(report, indent=2))
+    return 0 if report['passed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
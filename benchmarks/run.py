@@ -0,0 +1,316 @@
+"""
+    Renders the standard scenes with every renderer and prints a JSON report: wall time, rays
+    per second, peak memory (measured in a separate process), the scaling of the parallel
+    renderer with the number of processes, the float32 pipeline against the float64 one, and
+    the difference with the golden images.
+
+    python -m benchmarks.run --scenes example glass --resolutions 64x48 --depths 3
+    python -m benchmarks.run --renderers wavefront --precisions float64 float32
+    python -m benchmarks.run --update-golden
+
+    The exit status is 1 when a render differs from its golden image by more than the tolerance.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import multiprocessing
+import numpy as np
+from typing import Callable, Dict, List, Optional, Tuple
+from renders import render_scene, fast_render_scene, wavefront_render_scene, jit_render_scene
+from core.instrumentation import RenderStats
+from core.png import encode_png, to_uint8
+from core.precision import PRECISIONS
+from .scenes import SCENES, SceneData
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+
+RENDERERS: Dict[str, Callable[..., np.ndarray]] = {
+    'scalar': render_scene,
+    'parallel': fast_render_scene,
+    'wavefront': wavefront_render_scene,
+    'jit': jit_render_scene,
+}
+# Golden images are made by this renderer, the others have to match it
+REFERENCE_RENDERER = 'scalar'
+
+
+def parse_resolution(value: str) -> Tuple[int, int]:
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def default_processes() -> List[int]:
+    counts, count = [], 1
+    while count < (os.cpu_count() or 1):
+        counts.append(count)
+        count *= 2
+    return counts + [os.cpu_count() or 1]
+
+
+def golden_path(scene: str, screen_size: Tuple[int, int], max_depth: int) -> str:
+    width, height = screen_size
+    return os.path.join(GOLDEN_DIR, f"{scene}_{width}x{height}_{max_depth}.png")
+
+
+def load_golden(path: str) -> Optional[np.ndarray]:
+    if not os.path.exists(path):
+        return None
+    # Only needed to read the golden images
+    import matplotlib.pyplot as plt
+    return np.round(plt.imread(path)[..., :3] * 255).astype(np.uint8)
+
+
+def compare_golden(image: np.ndarray, golden: Optional[np.ndarray], tolerance: int) -> dict:
+    """
+        tolerance is the largest allowed difference of a color channel, in 1/255 steps.
+    """
+    if golden is None:
+        return {'status': 'missing'}
+    if golden.shape != image.shape:
+        return {'status': 'failed', 'error': f"golden image is {golden.shape}, render is {image.shape}"}
+    diff = np.abs(image.astype(int) - golden.astype(int)).max(axis=-1)
+    mismatched = int((diff > tolerance).sum())
+    return {
+        'status': 'failed' if mismatched else 'passed',
+        'max_diff': int(diff.max()),
+        'mismatched_pixels': mismatched,
+    }
+
+
+def timed_render(render: Callable[..., np.ndarray], scene: SceneData, screen_size: Tuple[int, int],
+                 max_depth: int, repeat: int, **options) -> Tuple[np.ndarray, dict]:
+    """
+        Best wall time of repeat renders, with the rays counted by the render instrumentation.
+    """
+    times = []
+    for _ in range(repeat):
+        stats = RenderStats()
+        start = time.perf_counter()
+        image = render(*scene, screen_size, max_depth, stats=stats, **options)
+        times.append(time.perf_counter() - start)
+
+    width, height = screen_size
+    counters = stats.counters()
+    return image, {
+        'wall_time': min(times),
+        'wall_times': times,
+        'camera_rays': width * height,
+        'camera_rays_per_second': width * height / min(times),
+        'rays': counters['total_rays'],
+        'rays_per_second': counters['total_rays'] / min(times),
+        'counters': counters,
+    }
+
+
+def status_bytes(field: str) -> Optional[int]:
+    """
+        A memory field (VmRSS, VmHWM...) of /proc/self/status in bytes, None where there is no /proc.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    # Linux resets VmHWM to the current RSS, elsewhere the peak keeps counting from the start
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def rusage_max_rss(who: int) -> int:
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return resource.getrusage(who).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def memory_worker(renderer: str, scene: str, screen_size: Tuple[int, int], max_depth: int, options: dict,
+                  connection):
+    data = SCENES[scene]()
+    reset_peak_rss()
+    before = status_bytes('VmRSS') or rusage_max_rss(resource.RUSAGE_SELF)
+    RENDERERS[renderer](*data, screen_size, max_depth, **options)
+    peak = status_bytes('VmHWM') or rusage_max_rss(resource.RUSAGE_SELF)
+    connection.send({
+        'peak_rss': peak,
+        'peak_rss_increase': peak - before,
+        'workers_peak_rss': rusage_max_rss(resource.RUSAGE_CHILDREN),
+    })
+    connection.close()
+
+
+def measure_memory(renderer: str, scene: str, screen_size: Tuple[int, int], max_depth: int, **options) -> dict:
+    """
+        Renders once more in a fresh process and returns its peak memory, so the numbers do not
+        depend on what was rendered before. peak_rss_increase is the growth of the peak during
+        the render, workers_peak_rss the largest pool worker of the parallel renderer.
+    """
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=memory_worker,
+                              args=(renderer, scene, screen_size, max_depth, options, sender))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        return {'error': f"memory measurement exited with code {process.exitcode}"}
+    finally:
+        process.join()
+
+
+def scaling_report(results: List[dict]) -> List[dict]:
+    """
+        Speedup and efficiency of the parallel renderer over its single process run.
+    """
+    report = []
+    for result in results:
+        if result['renderer'] != 'parallel' or result['processes'] == 1:
+            continue
+        base = next((r for r in results if r['renderer'] == 'parallel' and r['processes'] == 1 and
+                     same_render(r, result)), None)
+        if base is None:
+            continue
+        speedup = base['wall_time'] / result['wall_time']
+        report.append({
+            'scene': result['scene'],
+            'resolution': result['resolution'],
+            'max_depth': result['max_depth'],
+            'precision': result['precision'],
+            'processes': result['processes'],
+            'speedup': speedup,
+            'efficiency': speedup / result['processes'],
+        })
+    return report
+
+
+def precision_report(results: List[dict]) -> List[dict]:
+    """
+        Speedup and peak memory of every float32 render over the same render in float64.
+    """
+    report = []
+    for result in results:
+        if result['precision'] != 'float32':
+            continue
+        base = next((r for r in results if r['precision'] == 'float64' and r['renderer'] == result['renderer'] and
+                     r['processes'] == result['processes'] and same_render(r, result, precision=False)), None)
+        if base is None:
+            continue
+        entry = {
+            'scene': result['scene'],
+            'renderer': result['renderer'],
+            'resolution': result['resolution'],
+            'max_depth': result['max_depth'],
+            'processes': result['processes'],
+            'speedup': base['wall_time'] / result['wall_time'],
+        }
+        memory, base_memory = result.get('memory', {}), base.get('memory', {})
+        if 'peak_rss_increase' in memory and 'peak_rss_increase' in base_memory:
+            entry['peak_rss_increase_float64'] = base_memory['peak_rss_increase']
+            entry['peak_rss_increase_float32'] = memory['peak_rss_increase']
+        report.append(entry)
+    return report
+
+
+def same_render(a: dict, b: dict, precision: bool = True) -> bool:
+    keys = ('scene', 'resolution', 'max_depth') + (('precision',) if precision else ())
+    return all(a[key] == b[key] for key in keys)
+
+
+def run(scenes: List[str], renderers: List[str], resolutions: List[Tuple[int, int]], depths: List[int],
+        processes: List[int], repeat: int = 1, tolerance: int = 1, memory: bool = True,
+        update_golden: bool = False, precisions: Tuple[str, ...] = ('float64',)) -> dict:
+    results = []
+    for name in scenes:
+        scene = SCENES[name]()
+        for screen_size in resolutions:
+            for max_depth in depths:
+                path = golden_path(name, screen_size, max_depth)
+                if update_golden:
+                    image = to_uint8(RENDERERS[REFERENCE_RENDERER](*scene, screen_size, max_depth))
+                    os.makedirs(GOLDEN_DIR, exist_ok=True)
+                    with open(path, 'wb') as file:
+                        file.write(encode_png(image, 9))
+                golden = load_golden(path)
+
+                runs = [(renderer, {}) for renderer in renderers if renderer != 'parallel']
+                if 'parallel' in renderers:
+                    runs += [('parallel', {'processes': count}) for count in processes]
+                runs = [(renderer, {**options, 'precision': precision})
+                        for renderer, options in runs for precision in precisions]
+                for renderer, options in runs:
+                    image, result = timed_render(RENDERERS[renderer], scene, screen_size, max_depth,
+                                                 repeat, **options)
+                    if memory:
+                        result['memory'] = measure_memory(renderer, name, screen_size, max_depth, **options)
+                    results.append({
+                        'scene': name,
+                        'renderer': renderer,
+                        'resolution': list(screen_size),
+                        'max_depth': max_depth,
+                        'precision': options['precision'],
+                        'processes': options.get('processes', 1),
+                        **result,
+                        'golden': compare_golden(to_uint8(image), golden, tolerance),
+                    })
+                    print(f"{name} {renderer} {screen_size[0]}x{screen_size[1]} depth {max_depth} "
+                          f"{options['precision']} processes {results[-1]['processes']}: {result['wall_time']:.3f}s "
+                          f"{results[-1]['golden']['status']}", file=sys.stderr)
+
+    return {
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'settings': {'repeat': repeat, 'tolerance': tolerance},
+        'results': results,
+        'scaling': scaling_report(results),
+        'precision': precision_report(results),
+        'passed': all(result['golden']['status'] != 'failed' for result in results),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Ray tracer benchmarks")
+    parser.add_argument('--scenes', nargs='+', default=list(SCENES), choices=list(SCENES))
+    parser.add_argument('--renderers', nargs='+', default=list(RENDERERS), choices=list(RENDERERS))
+    parser.add_argument('--resolutions', nargs='+', type=parse_resolution, default=[(32, 24), (64, 48)])
+    parser.add_argument('--depths', nargs='+', type=int, default=[1, 3])
+    parser.add_argument('--processes', nargs='+', type=int, default=default_processes(),
+                        help="process counts the parallel renderer is run with")
+    parser.add_argument('--precisions', nargs='+', default=['float64'], choices=list(PRECISIONS),
+                        help="float types of the render pipeline, float32 renders are also compared with float64")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--tolerance', type=int, default=1,
+                        help="largest allowed channel difference with the golden image, in 1/255 steps")
+    parser.add_argument('--no-memory', action='store_true', help="skip the peak memory measurement")
+    parser.add_argument('--update-golden', action='store_true',
+                        help=f"render the golden images again with the {REFERENCE_RENDERER} renderer")
+    parser.add_argument('--output', help="write the report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = run(args.scenes, args.renderers, args.resolutions, args.depths, args.processes, args.repeat,
+                 args.tolerance, not args.no_memory, args.update_golden, args.precisions)
+    encoded = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(encoded)
+    else:
+        print(encoded)
+    return 0 if report['passed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
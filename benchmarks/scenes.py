@@ -0,0 +1,171 @@
+import numpy as np
+from functools import partial
+from typing import Callable, Dict, List, Tuple
+from core.lights import LightSource, PointLight, SpotLight, DirectionalLight
+from core.mesh import TriangleMesh
+from core.objects import SceneObject, Plane, Cuboid, Sphere
+from renders import get_example_scene
+
+# (camera, ambient, lights, objects), the arguments the renderers take before screen_size
+SceneData = Tuple[np.ndarray, np.ndarray, List[LightSource], List[SceneObject]]
+
+# Shininess values are multiples of 20 so the specular exponent (shininess / 10) is an even
+# integer and the scalar and batched renderers agree on negative cosines instead of giving NaN
+
+
+def box(center, size) -> Cuboid:
+    """
+        Axis aligned cuboid, the a, b, c, d face looks at the camera like in get_example_scene.
+    """
+    (x0, y0, z0), (x1, y1, z1) = np.subtract(center, np.divide(size, 2)), np.add(center, np.divide(size, 2))
+    return Cuboid([x0, y1, z1], [x0, y0, z1], [x1, y0, z1], [x1, y1, z1], [x1, y0, z0], [x1, y1, z0])
+
+
+def floor_and_wall(reflection: float = 0.3) -> List[SceneObject]:
+    floor = Plane([0, 1, 0], [0, -0.5, 0])
+    floor.set_material([0.2, 0.2, 0.2], [0.4, 0.4, 0.4], [0.5, 0.5, 0.5], 100, reflection)
+    wall = Plane([0, 0, 1], [0, 0, -8])
+    wall.set_material([0.0, 0.1, 0.3], [0.3, 0.5, 0.6], [0.2, 0.2, 0.2], 100, reflection)
+    return [floor, wall]
+
+
+def random_material(rng: np.random.Generator, reflection: float, refractive_index: float = 0):
+    color = rng.uniform(0.1, 1, 3)
+    return (0.2 * color).tolist(), color.tolist(), [0.5, 0.5, 0.5], int(rng.integers(1, 10)) * 20, \
+        reflection, refractive_index
+
+
+def random_lights(rng: np.random.Generator, count: int) -> List[LightSource]:
+    lights = []
+    for i in range(count):
+        intensity = rng.uniform(0.5, 1, 3) * 2 / count
+        position = [rng.uniform(-3, 3), rng.uniform(1, 3), rng.uniform(-3, 1)]
+        if i % 3 == 2:
+            lights.append(SpotLight(intensity=intensity, position=np.array(position),
+                                    direction=np.array([0, -1, -0.5]), kc=0.1, kl=0.1, kq=0.1))
+        else:
+            lights.append(PointLight(intensity=intensity, position=np.array(position), kc=0.1, kl=0.1, kq=0.1))
+    return lights
+
+
+def sphere_field(count: int, light_count: int = 2, seed: int = 0) -> SceneData:
+    """
+        count random spheres in front of the camera, over a floor and a back wall.
+    """
+    rng = np.random.default_rng(seed)
+    objects = floor_and_wall()
+    for _ in range(count):
+        radius = rng.uniform(0.05, 0.25)
+        sphere = Sphere(np.array([rng.uniform(-2.5, 2.5), rng.uniform(-0.4, 2), rng.uniform(-6, -1.5)]), radius)
+        sphere.set_material(*random_material(rng, rng.uniform(0, 0.5)))
+        objects.append(sphere)
+    return np.array([0, 0.3, 1]), np.array([0.1, 0.1, 0.1]), random_lights(rng, light_count), objects
+
+
+def cuboid_field(count: int, light_count: int = 2, seed: int = 0) -> SceneData:
+    """
+        count random axis aligned cuboids standing on the floor.
+    """
+    rng = np.random.default_rng(seed)
+    objects = floor_and_wall()
+    for _ in range(count):
+        size = rng.uniform(0.1, 0.5, 3)
+        center = [rng.uniform(-2.5, 2.5), -0.5 + size[1] / 2, rng.uniform(-6, -1.5)]
+        cuboid = box(center, size)
+        cuboid.set_material(*random_material(rng, rng.uniform(0, 0.5))[:5])
+        cuboid.apply_materials_to_faces()
+        objects.append(cuboid)
+    return np.array([0, 0.3, 1]), np.array([0.1, 0.1, 0.1]), random_lights(rng, light_count), objects
+
+
+def many_lights(light_count: int, seed: int = 0) -> SceneData:
+    """
+        A small sphere field lit by light_count lights, every hit point is shaded by all of them.
+    """
+    camera, ambient, _, objects = sphere_field(16, seed=seed)
+    lights = random_lights(np.random.default_rng(seed + 1), light_count)
+    lights.append(DirectionalLight(intensity=np.array([0.2, 0.2, 0.2]), direction=np.array([0.3, 1, 0.4])))
+    return camera, ambient, lights, objects
+
+
+def mirror_room(seed: int = 0) -> SceneData:
+    """
+        Spheres between two facing mirrors, nearly every ray is reflected up to max_depth times.
+    """
+    rng = np.random.default_rng(seed)
+    objects = floor_and_wall(reflection=0.9)
+    left = Plane([1, 0, 0], [-2, 0, 0])
+    left.set_material([0.05, 0.05, 0.05], [0.1, 0.1, 0.1], [1, 1, 1], 200, 0.9)
+    right = Plane([-1, 0, 0], [2, 0, 0])
+    right.set_material([0.05, 0.05, 0.05], [0.1, 0.1, 0.1], [1, 1, 1], 200, 0.9)
+    objects += [left, right]
+    for _ in range(8):
+        sphere = Sphere(np.array([rng.uniform(-1.5, 1.5), rng.uniform(-0.3, 1), rng.uniform(-5, -2)]), 0.3)
+        sphere.set_material(*random_material(rng, 0.8))
+        objects.append(sphere)
+    return np.array([0, 0.3, 1]), np.array([0.1, 0.1, 0.1]), random_lights(rng, 2), objects
+
+
+def glass_spheres(seed: int = 0) -> SceneData:
+    """
+        Refractive spheres in front of colored cuboids, every hit spawns a reflected and a
+        refracted ray.
+    """
+    rng = np.random.default_rng(seed)
+    objects = floor_and_wall()
+    for i in range(5):
+        cuboid = box([-2 + i, 0.25, -4], [0.6, 1.5, 0.6])
+        cuboid.set_material(*random_material(rng, 0.2)[:5])
+        cuboid.apply_materials_to_faces()
+        objects.append(cuboid)
+    for i in range(6):
+        sphere = Sphere(np.array([-1.25 + 0.5 * i, rng.uniform(-0.2, 0.6), rng.uniform(-2.5, -1.5)]), 0.22)
+        sphere.set_material([0.05, 0.05, 0.05], [0.1, 0.1, 0.1], [0.9, 0.9, 0.9], 200, 0.1, 1.5)
+        objects.append(sphere)
+    return np.array([0, 0.3, 1]), np.array([0.1, 0.1, 0.1]), random_lights(rng, 2), objects
+
+
+def torus(major_segments: int, minor_segments: int, center, radius: float = 0.6,
+          tube_radius: float = 0.25) -> TriangleMesh:
+    """
+        Torus mesh parallel to the floor with 2 * major_segments * minor_segments triangles.
+    """
+    u, v = np.meshgrid(np.linspace(0, 2 * np.pi, major_segments, endpoint=False),
+                       np.linspace(0, 2 * np.pi, minor_segments, endpoint=False), indexing='ij')
+    vertices = np.stack([(radius + tube_radius * np.cos(v)) * np.cos(u), tube_radius * np.sin(v),
+                         (radius + tube_radius * np.cos(v)) * np.sin(u)], axis=-1).reshape(-1, 3) + center
+    i, j = np.meshgrid(np.arange(major_segments), np.arange(minor_segments), indexing='ij')
+    next_i, next_j = (i + 1) % major_segments, (j + 1) % minor_segments
+    a, b = i * minor_segments + j, next_i * minor_segments + j
+    c, d = next_i * minor_segments + next_j, i * minor_segments + next_j
+    faces = np.concatenate([np.stack([a, d, b], axis=-1).reshape(-1, 3), np.stack([b, d, c], axis=-1).reshape(-1, 3)])
+    return TriangleMesh(vertices, faces)
+
+
+def mesh_scene(major_segments: int, minor_segments: int, seed: int = 0) -> SceneData:
+    """
+        A reflective torus mesh over the floor, with a few spheres around it.
+    """
+    rng = np.random.default_rng(seed)
+    mesh = torus(major_segments, minor_segments, [0, -0.1, -3])
+    mesh.set_material([0.2, 0.1, 0.1], [0.8, 0.3, 0.3], [0.5, 0.5, 0.5], 100, 0.3)
+    objects = floor_and_wall() + [mesh]
+    for _ in range(4):
+        sphere = Sphere(np.array([rng.uniform(-2, 2), rng.uniform(-0.2, 0.8), rng.uniform(-5, -2)]), 0.2)
+        sphere.set_material(*random_material(rng, 0.3))
+        objects.append(sphere)
+    return np.array([0, 0.8, 1]), np.array([0.1, 0.1, 0.1]), random_lights(rng, 2), objects
+
+
+# Standard scenes by name, every call builds the same scene
+SCENES: Dict[str, Callable[[], SceneData]] = {
+    'example': get_example_scene,
+    'spheres_16': partial(sphere_field, 16),
+    'spheres_128': partial(sphere_field, 128),
+    'cuboids_32': partial(cuboid_field, 32),
+    'lights_8': partial(many_lights, 8),
+    'lights_32': partial(many_lights, 32),
+    'mirrors': mirror_room,
+    'glass': glass_spheres,
+    'mesh_100k': partial(mesh_scene, 320, 160),
+}
@@ -4,3 +4,7 @@ from .lights import LightSource, DirectionalLight, PointLight, SpotLight
 from .objects import Object3D, Plane, Rectangle, Cuboid, Sphere
 from .ray import Ray
 from .scene import Scene, get_color
+from .bvh import BVH
+from .compiled import CompiledScene, compile_scene
+from .instrumentation import RenderStats
+from .mesh import TriangleMesh, load_mesh
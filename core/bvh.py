@@ -0,0 +1,283 @@
+import math
+import time
+import numpy as np
+from typing import List, Optional, Tuple
+from .instrumentation import RenderStats
+from .objects import Plane, Primitive, Rectangle, SceneObject, Sphere, flatten_primitives
+from .ray import Ray
+
+# Relative costs used by the surface area heuristic
+TRAVERSAL_COST = 1.0
+INTERSECTION_COST = 1.0
+# Boxes are padded so flat rectangles (zero thickness on one axis) are never missed
+BOX_PADDING = 1e-9
+
+
+class BVH:
+    """
+        Bounding volume hierarchy over the primitives of a scene, cuboids are split into their faces.
+        Planes have no bounding box so they are kept in a separate list that every query tests.
+        Every primitive keeps its index in flatten_primitives order and hits at the same distance
+        are resolved by that index, so queries return exactly what the linear scan of
+        Ray.nearest_intersected_object returns. A mesh counts as one test plus the triangle
+        tests of its own BVH.
+    """
+
+    def __init__(self, objects: List[SceneObject], max_leaf_size: int = 2):
+        start = time.perf_counter()
+        self.max_leaf_size = max_leaf_size
+        self.unbounded: List[Tuple[int, Primitive]] = []
+        bounded: List[Tuple[int, Primitive]] = []
+        lows, highs = [], []
+        primitives = flatten_primitives(objects)
+        # Indices of the meshes (the primitives that are not analytic), they count their triangle tests
+        self.meshes = {index for index, primitive in enumerate(primitives)
+                       if not isinstance(primitive, (Sphere, Plane, Rectangle))}
+        for index, primitive in enumerate(primitives):
+            box = primitive.bounding_box()
+            if box is None:
+                self.unbounded.append((index, primitive))
+            else:
+                bounded.append((index, primitive))
+                lows.append(box[0])
+                highs.append(box[1])
+
+        # Nodes are kept in flat lists, a node is a leaf when node_items is not None
+        self.node_low: List[Tuple[float, float, float]] = []
+        self.node_high: List[Tuple[float, float, float]] = []
+        self.node_children: List[Optional[Tuple[int, int]]] = []
+        self.node_items: List[Optional[List[Tuple[int, Primitive]]]] = []
+        self.depth = 0
+        if bounded:
+            self._build(bounded, np.array(lows, dtype=float).reshape(-1, 3),
+                        np.array(highs, dtype=float).reshape(-1, 3))
+        self.build_time = time.perf_counter() - start
+
+    def _build(self, items: List[Tuple[int, Primitive]], lows: np.ndarray, highs: np.ndarray):
+        root = self._add_node()
+        stack = [(root, np.arange(len(items)), 1)]
+        while stack:
+            node, members, depth = stack.pop()
+            self.depth = max(self.depth, depth)
+            low, high = lows[members].min(axis=0), highs[members].max(axis=0)
+            self.node_low[node] = tuple((low - BOX_PADDING).tolist())
+            self.node_high[node] = tuple((high + BOX_PADDING).tolist())
+
+            split = None
+            if len(members) > self.max_leaf_size:
+                split = self._find_split(members, lows, highs, surface_area(low, high))
+            if split is None:
+                self.node_items[node] = [items[m] for m in members]
+                continue
+
+            left, right = self._add_node(), self._add_node()
+            self.node_children[node] = (left, right)
+            stack.append((left, split[0], depth + 1))
+            stack.append((right, split[1], depth + 1))
+
+    def _find_split(self, members: np.ndarray, lows: np.ndarray, highs: np.ndarray,
+                    parent_area: float) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+            Sweeps the sorted centroids on every axis and returns the split with the lowest
+            surface area heuristic cost, or None when keeping a leaf is cheaper.
+        """
+        centroids = (lows[members] + highs[members]) / 2
+        best_cost = INTERSECTION_COST * len(members)
+        best_split = None
+        count = len(members)
+
+        for axis in range(3):
+            order = members[np.argsort(centroids[:, axis], kind='stable')]
+            left_area = prefix_areas(lows[order], highs[order])
+            right_area = prefix_areas(lows[order][::-1], highs[order][::-1])[::-1]
+            # Split after position k puts order[:k + 1] on the left
+            left_count = np.arange(1, count)
+            costs = TRAVERSAL_COST + INTERSECTION_COST * (
+                left_area[:-1] * left_count + right_area[1:] * (count - left_count)) / max(parent_area, 1e-12)
+            k = int(np.argmin(costs))
+            if costs[k] < best_cost:
+                best_cost = costs[k]
+                best_split = (order[:k + 1], order[k + 1:])
+
+        # Fall back to a median split so leaves never grow past max_leaf_size
+        if best_split is None and count > 2 * self.max_leaf_size:
+            axis = int(np.argmax(np.ptp(centroids, axis=0)))
+            order = members[np.argsort(centroids[:, axis], kind='stable')]
+            best_split = (order[:count // 2], order[count // 2:])
+        return best_split
+
+    def _add_node(self) -> int:
+        self.node_low.append(None)
+        self.node_high.append(None)
+        self.node_children.append(None)
+        self.node_items.append(None)
+        return len(self.node_items) - 1
+
+    def nearest_hit(self, ray: Ray, stats: Optional[RenderStats] = None) -> Optional[Tuple[float, Primitive, int]]:
+        """
+            Nearest hit of the ray: its distance, the primitive (the face of a cuboid, the
+            Triangle of a mesh) and its index in flatten_primitives order. The primitive tests
+            are counted in stats when given.
+        """
+        best_dist, best_index, best_object = math.inf, -1, None
+        tests = len(self.unbounded)
+
+        for index, primitive in self.unbounded:
+            intersection = self._intersect(index, primitive, ray, stats)
+            if intersection and is_closer(intersection[0], index, best_dist, best_index):
+                best_dist, best_index = intersection[0], index
+                best_object = intersection[1]
+
+        if self.node_items:
+            origin = tuple(np.asarray(ray.origin, dtype=float).tolist())
+            inverse = inverse_direction(ray.direction)
+            t_root = None if inverse is None else slab_test(
+                origin, inverse, self.node_low[0], self.node_high[0])
+            stack = [] if t_root is None else [(0, t_root)]
+            while stack:
+                node, t_near = stack.pop()
+                # Equal distances can still win on a lower index so the test is not strict
+                if t_near > best_dist:
+                    continue
+                items = self.node_items[node]
+                if items is None:
+                    # The nearer child is pushed last so it is visited first
+                    hits = []
+                    for child in self.node_children[node]:
+                        t_child = slab_test(origin, inverse, self.node_low[child], self.node_high[child])
+                        if t_child is not None:
+                            hits.append((child, t_child))
+                    hits.sort(key=lambda hit: -hit[1])
+                    stack.extend(hits)
+                    continue
+                tests += len(items)
+                for index, primitive in items:
+                    intersection = self._intersect(index, primitive, ray, stats)
+                    if intersection and is_closer(intersection[0], index, best_dist, best_index):
+                        best_dist, best_index = intersection[0], index
+                        best_object = intersection[1]
+
+        if stats is not None:
+            stats.count_tests(tests)
+        if best_object is None:
+            return None
+        return best_dist, best_object, best_index
+
+    def occluded(self, ray: Ray, max_distance: float, stats: Optional[RenderStats] = None) -> bool:
+        """
+            Any hit query for shadow rays, True as soon as some primitive is hit closer than
+            max_distance, without looking for the nearest one.
+        """
+        tests = 0
+        for index, primitive in self.unbounded:
+            tests += 1
+            intersection = self._intersect(index, primitive, ray, stats)
+            if intersection and intersection[0] < max_distance:
+                return count_tests(stats, tests, True)
+
+        if not self.node_items:
+            return count_tests(stats, tests, False)
+        origin = tuple(np.asarray(ray.origin, dtype=float).tolist())
+        inverse = inverse_direction(ray.direction)
+        if inverse is None:
+            return count_tests(stats, tests, False)
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            t_near = slab_test(origin, inverse, self.node_low[node], self.node_high[node])
+            if t_near is None or t_near > max_distance:
+                continue
+            items = self.node_items[node]
+            if items is None:
+                stack.extend(self.node_children[node])
+                continue
+            for index, primitive in items:
+                tests += 1
+                intersection = self._intersect(index, primitive, ray, stats)
+                if intersection and intersection[0] < max_distance:
+                    return count_tests(stats, tests, True)
+        return count_tests(stats, tests, False)
+
+    def _intersect(self, index: int, primitive: Primitive, ray: Ray, stats: Optional[RenderStats]):
+        if index in self.meshes:
+            return primitive.intersect(ray, stats)
+        return primitive.intersect(ray)
+
+    def report(self) -> dict:
+        """
+            Build time and quality numbers of the tree, sah_cost is the expected number of node
+            visits and primitive tests for a random ray that hits the root box.
+        """
+        leaves = [items for items in self.node_items if items is not None]
+        report = {
+            'build_time': self.build_time,
+            'primitives': sum(len(items) for items in leaves) + len(self.unbounded),
+            'unbounded_primitives': len(self.unbounded),
+            'nodes': len(self.node_items),
+            'leaves': len(leaves),
+            'max_depth': self.depth,
+            'average_leaf_size': sum(len(items) for items in leaves) / len(leaves) if leaves else 0,
+            'sah_cost': 0.0,
+        }
+        if leaves:
+            root_area = surface_area(self.node_low[0], self.node_high[0])
+            cost = 0.0
+            for node, items in enumerate(self.node_items):
+                area = surface_area(self.node_low[node], self.node_high[node]) / max(root_area, 1e-12)
+                cost += area * (TRAVERSAL_COST if items is None else INTERSECTION_COST * len(items))
+            report['sah_cost'] = cost
+        return report
+
+
+def count_tests(stats: Optional[RenderStats], tests: int, result: bool) -> bool:
+    if stats is not None:
+        stats.count_tests(tests)
+    return result
+
+
+def is_closer(dist: float, index: int, best_dist: float, best_index: int) -> bool:
+    return dist < best_dist or (dist == best_dist and index < best_index)
+
+
+def surface_area(low, high) -> float:
+    dx, dy, dz = np.maximum(np.subtract(high, low), 0)
+    return float(2 * (dx * dy + dy * dz + dz * dx))
+
+
+def prefix_areas(lows: np.ndarray, highs: np.ndarray) -> np.ndarray:
+    extent = np.maximum(np.maximum.accumulate(highs) - np.minimum.accumulate(lows), 0)
+    return 2 * (extent[:, 0] * extent[:, 1] + extent[:, 1] * extent[:, 2] + extent[:, 2] * extent[:, 0])
+
+
+def inverse_direction(direction: np.ndarray) -> Optional[Tuple[float, float, float]]:
+    inverse = []
+    for d in np.asarray(direction, dtype=float).tolist():
+        if math.isnan(d):
+            # Nothing is hit by a ray without a direction
+            return None
+        inverse.append(math.inf if abs(d) < 1e-300 else 1 / d)
+    return tuple(inverse)
+
+
+def slab_test(origin, inverse, low, high) -> Optional[float]:
+    """
+        Returns the distance where the ray enters the box, or None when it misses it.
+    """
+    t_near, t_far = -math.inf, math.inf
+    for o, inv, lo, hi in zip(origin, inverse, low, high):
+        if math.isinf(inv):
+            if o < lo or o > hi:
+                return None
+            continue
+        t1, t2 = (lo - o) * inv, (hi - o) * inv
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > t_near:
+            t_near = t1
+        if t2 < t_far:
+            t_far = t2
+        if t_near > t_far:
+            return None
+    if t_far < 0:
+        return None
+    return t_near
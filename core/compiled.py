@@ -0,0 +1,208 @@
+import copy
+import numpy as np
+from typing import List, Optional, Tuple, TYPE_CHECKING
+from .instrumentation import RenderStats
+from .objects import SceneObject, Sphere, Plane, Rectangle, flatten_primitives
+from .kernels import intersect_planes, intersect_rectangles, intersect_spheres, nearest_of
+from .mesh import MeshBVH, TriangleMesh
+from .precision import DEFAULT_PRECISION, Precision
+
+if TYPE_CHECKING:
+    from .scene import Scene
+
+# Primitive type codes of CompiledScene.types
+SPHERE, PLANE, RECTANGLE, MESH = 0, 1, 2, 3
+# Names of the type codes, the same names the scalar renderer counts hits with (a mesh hit is a triangle)
+PRIMITIVE_NAMES = ('sphere', 'plane', 'rectangle', 'triangle')
+
+# Rays are intersected in chunks so the (rays, primitives) blocks stay small
+RAY_CHUNK_SIZE = 4096
+
+
+class CompiledScene:
+    """
+        Structure of arrays form of the scene geometry and materials. Cuboids are split into their
+        faces and every primitive gets an object id, its index in flatten_primitives order (the
+        same ids BVH.nearest_hit returns). Geometry is packed into contiguous arrays per primitive
+        type and the materials into a table indexed by object id, so batched renderers never touch
+        the python objects and the whole thing pickles as a handful of arrays. A triangle mesh is
+        one object id, its triangles are intersected through the mesh BVH and the hits also
+        return the triangle id. Every float array has the dtype of precision, so rays of that
+        dtype are intersected and shaded without being upcast.
+    """
+
+    def __init__(self, camera: np.ndarray, ambient: np.ndarray, objects: List[SceneObject],
+                 precision: Precision = DEFAULT_PRECISION):
+        primitives = flatten_primitives(objects)
+        self.count = len(primitives)
+        self.precision = precision
+        dtype = precision.dtype
+        self.camera = np.asarray(camera, dtype=dtype)
+        self.ambient = np.asarray(ambient, dtype=dtype)
+        self.types = np.array([primitive_type(p) for p in primitives], dtype=np.int64)
+
+        self.sphere_ids = np.flatnonzero(self.types == SPHERE)
+        self.sphere_centers = np.array([primitives[i].center for i in self.sphere_ids], dtype=dtype).reshape(-1, 3)
+        self.sphere_radii = np.array([primitives[i].radius for i in self.sphere_ids], dtype=dtype)
+
+        self.plane_ids = np.flatnonzero(self.types == PLANE)
+        self.plane_normals = np.array([primitives[i].normal for i in self.plane_ids], dtype=dtype).reshape(-1, 3)
+        self.plane_points = np.array([primitives[i].point for i in self.plane_ids], dtype=dtype).reshape(-1, 3)
+        self.plane_offsets = np.einsum('ij,ij->i', self.plane_normals, self.plane_points)
+
+        self.rectangle_ids = np.flatnonzero(self.types == RECTANGLE)
+        self.rectangle_corners = np.array([primitives[i].abcd for i in self.rectangle_ids],
+                                          dtype=dtype).reshape(-1, 4, 3)
+        self.rectangle_normals = np.array([primitives[i].normal for i in self.rectangle_ids],
+                                          dtype=dtype).reshape(-1, 3)
+
+        self.mesh_ids = np.flatnonzero(self.types == MESH)
+        self.meshes: List[TriangleMesh] = [primitives[i] for i in self.mesh_ids]
+        # The mesh trees and triangle normals the batched queries use, in the dtype of precision
+        self.mesh_bvhs: List[MeshBVH] = [mesh.bvh.astype(precision) for mesh in self.meshes]
+        self.mesh_normals = [mesh.normals.astype(dtype, copy=False) for mesh in self.meshes]
+
+        # Material table, row i is the material of object id i
+        self.material_ambient = material_column(primitives, 'ambient', (3,), dtype)
+        self.material_diffuse = material_column(primitives, 'diffuse', (3,), dtype)
+        self.material_specular = material_column(primitives, 'specular', (3,), dtype)
+        self.material_shininess = material_column(primitives, 'shininess', (), dtype)
+        self.material_reflection = material_column(primitives, 'reflection', (), dtype)
+        self.material_refractive_index = material_column(primitives, 'refractive_index', (), dtype)
+
+    def with_camera(self, camera: np.ndarray) -> "CompiledScene":
+        """
+            The same compiled scene seen from another camera, the geometry arrays are shared.
+        """
+        moved = copy.copy(self)
+        moved.camera = np.asarray(camera, dtype=self.precision.dtype)
+        return moved
+
+    def nearest_intersections(self, origins: np.ndarray, directions: np.ndarray,
+                              stats: Optional[RenderStats] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+            Finds the nearest hit of every ray. Returns the hit distance buffer (np.inf for a miss),
+            the object id buffer (-1 for a miss) and the triangle id buffer (-1 unless a mesh was hit).
+        """
+        if stats is not None:
+            stats.count_tests(len(directions) * (self.count - len(self.mesh_ids)))
+        nearest_dist = np.full(len(directions), np.inf, dtype=self.precision.dtype)
+        epsilon = self.precision.parallel_epsilon
+        object_ids = np.full(len(directions), -1, dtype=np.int64)
+        single_origin = np.ndim(origins) == 1
+
+        for start in range(0, len(directions), RAY_CHUNK_SIZE):
+            chunk = slice(start, start + RAY_CHUNK_SIZE)
+            chunk_origins = origins if single_origin else origins[chunk]
+            chunk_directions = directions[chunk]
+            chunk_dist, chunk_ids = nearest_dist[chunk], object_ids[chunk]
+            nearest_of(intersect_spheres(chunk_origins, chunk_directions, self.sphere_centers, self.sphere_radii),
+                       self.sphere_ids, chunk_dist, chunk_ids)
+            nearest_of(intersect_planes(chunk_origins, chunk_directions, self.plane_normals, self.plane_points,
+                                        epsilon),
+                       self.plane_ids, chunk_dist, chunk_ids)
+            nearest_of(intersect_rectangles(chunk_origins, chunk_directions, self.rectangle_corners,
+                                            self.rectangle_normals, epsilon),
+                       self.rectangle_ids, chunk_dist, chunk_ids)
+
+        # Meshes get all the rays at once, the packets of their BVH traversal stay large
+        triangle_ids = np.full(len(directions), -1, dtype=np.int64)
+        for mesh_id, bvh in zip(self.mesh_ids, self.mesh_bvhs):
+            mesh_dist, mesh_triangles = bvh.nearest(origins, directions, nearest_dist, stats)
+            closer = (mesh_dist < nearest_dist) | ((mesh_dist == nearest_dist) & np.isfinite(mesh_dist) &
+                                                  (mesh_id < object_ids))
+            nearest_dist[closer] = mesh_dist[closer]
+            object_ids[closer] = mesh_id
+            triangle_ids[closer] = mesh_triangles[closer]
+
+        if stats is not None:
+            for code, hits in enumerate(np.bincount(self.types[object_ids[object_ids >= 0]]).tolist()):
+                if hits:
+                    stats.count_hits(PRIMITIVE_NAMES[code], hits)
+        return nearest_dist, object_ids, triangle_ids
+
+    def occluded(self, origins: np.ndarray, directions: np.ndarray, max_distances: np.ndarray,
+                 stats: Optional[RenderStats] = None) -> np.ndarray:
+        """
+            Batched any hit query for shadow rays, True for every ray that hits something closer
+            than its max distance. Rays that are already blocked are not tested again against the
+            next primitive types.
+        """
+        blocked = np.zeros(len(directions), dtype=bool)
+        epsilon = self.precision.parallel_epsilon
+        tests = [
+            (len(self.sphere_ids),
+             lambda o, d: intersect_spheres(o, d, self.sphere_centers, self.sphere_radii)),
+            (len(self.rectangle_ids),
+             lambda o, d: intersect_rectangles(o, d, self.rectangle_corners, self.rectangle_normals, epsilon)),
+            (len(self.plane_ids),
+             lambda o, d: intersect_planes(o, d, self.plane_normals, self.plane_points, epsilon)),
+        ]
+        for start in range(0, len(directions), RAY_CHUNK_SIZE):
+            chunk = np.arange(start, min(start + RAY_CHUNK_SIZE, len(directions)))
+            for primitives, test in tests:
+                active = chunk[~blocked[chunk]]
+                if len(active) == 0:
+                    break
+                if stats is not None:
+                    stats.count_tests(len(active) * primitives)
+                dists = test(origins[active], directions[active])
+                blocked[active] = (dists < max_distances[active, np.newaxis]).any(axis=1)
+        for bvh in self.mesh_bvhs:
+            active = np.flatnonzero(~blocked)
+            if len(active) == 0:
+                break
+            blocked[active] = bvh.occluded(origins[active], directions[active], max_distances[active], stats)
+        return blocked
+
+    def compute_normals(self, object_ids: np.ndarray, points: np.ndarray,
+                        triangle_ids: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+            Batched compute_normal, the normal of object object_ids[k] at points[k] (and of its
+            triangle triangle_ids[k] for a mesh).
+            Like Plane.compute_normal the plane normals are returned as they were given.
+        """
+        normals = np.zeros((len(object_ids), 3), dtype=self.precision.dtype)
+        types = self.types[object_ids]
+
+        spheres = types == SPHERE
+        if spheres.any():
+            centers = self.sphere_centers[np.searchsorted(self.sphere_ids, object_ids[spheres])]
+            offsets = points[spheres] - centers
+            norms = np.sqrt(np.einsum('ij,ij->i', offsets, offsets))
+            norms[norms == 0] = 1
+            normals[spheres] = offsets / norms[:, np.newaxis]
+
+        planes = types == PLANE
+        normals[planes] = self.plane_normals[np.searchsorted(self.plane_ids, object_ids[planes])]
+
+        rectangles = types == RECTANGLE
+        normals[rectangles] = self.rectangle_normals[np.searchsorted(self.rectangle_ids, object_ids[rectangles])]
+
+        for mesh_id, mesh_normals in zip(self.mesh_ids, self.mesh_normals):
+            hits = object_ids == mesh_id
+            normals[hits] = mesh_normals[triangle_ids[hits]]
+        return normals
+
+
+def primitive_type(primitive) -> int:
+    if isinstance(primitive, Sphere):
+        return SPHERE
+    if isinstance(primitive, Plane):
+        return PLANE
+    if isinstance(primitive, Rectangle):
+        return RECTANGLE
+    if isinstance(primitive, TriangleMesh):
+        return MESH
+    raise ValueError(f"Can't compile object of type {type(primitive).__name__}")
+
+
+def material_column(primitives: list, name: str, shape: Tuple[int, ...], dtype=np.float64) -> np.ndarray:
+    column = np.zeros((len(primitives),) + shape, dtype=dtype)
+    for i, primitive in enumerate(primitives):
+        column[i] = getattr(primitive, name, 0)
+    return column
+
+
+def compile_scene(scene: "Scene") -> CompiledScene:
+    return CompiledScene(scene.camera, scene.ambient, scene.objects, scene.precision)
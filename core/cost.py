@@ -0,0 +1,126 @@
+import itertools
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+from .lights import Light
+from .mesh import TriangleMesh
+from .objects import SceneObject, Plane, flatten_primitives
+
+# Constants of the cost model, calibrated on the benchmark scenes (python -m benchmarks.cost
+# compares the estimates with the counters of real renders)
+# Fraction of the pixels adaptive anti-aliasing supersamples, the edges
+EDGE_FRACTION = 0.3
+# Fraction of the camera rays that hit something in a scene without a plane (with one they all do)
+PRIMARY_HIT_FRACTION = 0.5
+# Fraction of the reflected and refracted rays that hit something
+SECONDARY_HIT_FRACTION = 0.7
+# Primitive tests a ray makes in the scene BVH per level of a balanced tree over the bounded
+# primitives, on top of the planes every ray tests
+BVH_TESTS_PER_LEVEL = 0.1
+# Leaves of a mesh BVH a ray that reaches the mesh tests the triangles of, it doesn't grow with
+# the depth of the tree (measured on the benchmark torus from 48 to 100k triangles)
+MESH_LEAVES_PER_RAY = 1.5
+
+
+class RenderCost:
+    """
+        Estimated work of a render: rays by kind (primary, reflection, refraction, shadow) and
+        primitive intersection tests, counted like RenderStats counts them for the scalar renderer.
+    """
+
+    def __init__(self, rays: Dict[str, float], intersection_tests: float):
+        self.rays = rays
+        self.intersection_tests = intersection_tests
+
+    @property
+    def total_rays(self) -> float:
+        return sum(self.rays.values())
+
+    def times(self, count: float) -> "RenderCost":
+        """
+            Cost of count renders like this one, the frames of an animation.
+        """
+        return RenderCost({kind: rays * count for kind, rays in self.rays.items()}, self.intersection_tests * count)
+
+    def to_dict(self) -> dict:
+        return {
+            'rays': {kind: int(count) for kind, count in self.rays.items()},
+            'total_rays': int(self.total_rays),
+            'intersection_tests': int(self.intersection_tests),
+        }
+
+
+def estimate_cost(camera: np.ndarray, ambient: np.ndarray, lights: List[Light], objects: List[SceneObject],
+                  screen_size: Tuple[int, int], max_depth: int, max_samples: int = 1, min_weight: float = 0.0,
+                  shadows: bool = True, light_samples: int = 0, crop: Optional[List[int]] = None,
+                  **options) -> RenderCost:
+    """
+        Cost of rendering the output of parse_scene_data with the render settings of Scene (the
+        ones that don't change the amount of work are ignored), without tracing any ray.
+        Cuboids count as their 6 faces and a mesh as one primitive plus the triangle tests of
+        the rays that reach it (mesh_tests_per_ray). Every hit spawns a reflected ray while its path weight (approximated by
+        the reflection of the primitive to the power of the depth) is at least min_weight, which
+        is always the case with the default of 0, and a refracted ray on refractive primitives,
+        in the proportion of the primitives that do. Light culling is not modelled, so the cost
+        of a render with light_cutoff is overestimated.
+    """
+    width, height = screen_size if crop is None else (crop[2] - crop[0], crop[3] - crop[1])
+    primitives = flatten_primitives(objects)
+    planes = sum(isinstance(primitive, Plane) for primitive in primitives)
+    bounded = len(primitives) - planes
+    light_count = min(len(lights), light_samples) if light_samples else len(lights)
+
+    reflections = np.array([primitive.reflection for primitive in primitives], dtype=float)
+    refractive = np.array([primitive.refractive_index > 0 for primitive in primitives], dtype=float)
+    refracted_fraction = refractive.mean() if len(primitives) and min_weight <= 1 else 0.0
+
+    primary = width * height * (1 + EDGE_FRACTION * (max_samples - 1))
+    rays = {'primary': primary, 'reflection': 0.0, 'refraction': 0.0, 'shadow': 0.0}
+    hits = primary * (1.0 if planes else PRIMARY_HIT_FRACTION) if primitives else 0.0
+    for depth in range(1, max_depth + 1):
+        if shadows:
+            rays['shadow'] += hits * light_count
+        if depth == max_depth:
+            break
+        reflected = hits * (np.mean(reflections ** depth >= min_weight) if len(primitives) else 0.0)
+        refracted = hits * refracted_fraction
+        rays['reflection'] += reflected
+        rays['refraction'] += refracted
+        hits = (reflected + refracted) * SECONDARY_HIT_FRACTION
+
+    tests_per_ray = planes + BVH_TESTS_PER_LEVEL * np.log2(bounded + 1) + sum(
+        mesh_tests_per_ray(camera, screen_size, primitive) for primitive in primitives
+        if isinstance(primitive, TriangleMesh))
+    return RenderCost(rays, sum(rays.values()) * tests_per_ray)
+
+
+def mesh_tests_per_ray(camera: np.ndarray, screen_size: Tuple[int, int], mesh: TriangleMesh) -> float:
+    """
+        Triangle tests of a mesh per ray of the render: the rays that reach its bounding box, in
+        the proportion of the screen the box covers (for the secondary rays too), test the
+        triangles of MESH_LEAVES_PER_RAY leaves of its BVH, or of all of them in a shallow tree.
+    """
+    box = mesh.bounding_box()
+    if box is None:
+        return 0.0
+    leaves = int(np.count_nonzero(mesh.bvh.node_children[:, 0] < 0))
+    tests = len(mesh.bvh.v0) / leaves * min(leaves, MESH_LEAVES_PER_RAY)
+    return screen_fraction(camera, screen_size, box) * tests
+
+
+def screen_fraction(camera: np.ndarray, screen_size: Tuple[int, int], box: Tuple[np.ndarray, np.ndarray]) -> float:
+    """
+        Fraction of the screen (the z = 0 window of get_screen) covered by the bounding box
+        seen from the camera, 1 when the box reaches the camera plane.
+    """
+    camera = np.asarray(camera, dtype=float)
+    corners = np.array(list(itertools.product(*zip(*box))), dtype=float)
+    depths = camera[2] - corners[:, 2]
+    if np.any(depths <= 0):
+        return 1.0
+    projected = camera[:2] + (corners[:, :2] - camera[:2]) * (camera[2] / depths)[:, np.newaxis]
+    width, height = screen_size
+    half_height = height / width
+    x0, x1 = np.clip([projected[:, 0].min(), projected[:, 0].max()], -1, 1)
+    y0, y1 = np.clip([projected[:, 1].min(), projected[:, 1].max()], -half_height, half_height)
+    return float((x1 - x0) * (y1 - y0) / (4 * half_height))
+
@@ -0,0 +1,84 @@
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional, Tuple
+
+
+class RenderStats:
+    """
+        Counters of a render: rays cast by kind (primary, reflection, refraction, shadow) and depth
+        (the number of bounces, 0 for camera rays and the shadow rays of their hits), primitive
+        intersection tests and nearest hits by primitive type, plus the time spent in named stages.
+        Instrumentation is off when a Scene has no stats, the hot paths then only compare with None.
+    """
+
+    def __init__(self):
+        self.rays: "Counter[Tuple[str, int]]" = Counter()
+        self.intersection_tests = 0
+        self.hits: "Counter[str]" = Counter()
+        self.timings: Dict[str, float] = defaultdict(float)
+
+    def count_rays(self, kind: str, depth: int, count: int = 1):
+        self.rays[kind, depth] += count
+
+    def count_tests(self, count: int):
+        self.intersection_tests += count
+
+    def count_hits(self, primitive_type: str, count: int = 1):
+        self.hits[primitive_type] += count
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - start
+
+    def merge(self, other: "RenderStats"):
+        self.rays.update(other.rays)
+        self.intersection_tests += other.intersection_tests
+        self.hits.update(other.hits)
+        for stage, seconds in other.timings.items():
+            self.timings[stage] += seconds
+
+    def counters(self) -> dict:
+        rays: Dict[str, Dict[str, int]] = {}
+        for (kind, depth), count in sorted(self.rays.items()):
+            rays.setdefault(kind, {})[str(depth)] = count
+        return {
+            'rays': rays,
+            'total_rays': sum(self.rays.values()),
+            'intersection_tests': self.intersection_tests,
+            'hits': dict(sorted(self.hits.items())),
+        }
+
+    def to_dict(self) -> dict:
+        return {**self.counters(), 'timings': dict(self.timings)}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "RenderStats":
+        """
+            The inverse of to_dict.
+        """
+        stats = cls()
+        for kind, depths in data['rays'].items():
+            for depth, count in depths.items():
+                stats.rays[kind, int(depth)] = count
+        stats.intersection_tests = data['intersection_tests']
+        stats.hits.update(data['hits'])
+        stats.timings.update(data['timings'])
+        return stats
+
+    def server_timing(self) -> str:
+        """
+            The stage timings as a Server-Timing header value (durations in milliseconds).
+        """
+        return ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.timings.items())
+
+
+def timer(stats: Optional[RenderStats], stage: str):
+    """
+        stats.timer(stage), or a context that does nothing when instrumentation is off.
+    """
+    return nullcontext() if stats is None else stats.timer(stage)
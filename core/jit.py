@@ -0,0 +1,533 @@
+import os
+import math
+import numpy as np
+from typing import List, Tuple, TYPE_CHECKING
+from .compiled import CompiledScene, PRIMITIVE_NAMES, SPHERE, PLANE, RECTANGLE
+from .lights import Light, DirectionalLight, SpotLight
+
+if TYPE_CHECKING:
+    from .scene import Scene
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Single ray kernels of the scalar renderer (intersections, get_color) on the packed arrays of
+# JitScene. They are compiled by numba when it is installed; without it they are plain python
+# and the renderers use the python objects instead (jit_available), the kernels can still be
+# run as they are to check them against the reference renderer, only slowly.
+
+# Ray kinds of the ray counters, the first axis of JitScene.rays
+RAY_KINDS = ('primary', 'reflection', 'refraction', 'shadow')
+PRIMARY, REFLECTION, REFRACTION, SHADOW = 0, 1, 2, 3
+# Light type codes
+DIRECTIONAL, POINT, SPOT = 0, 1, 2
+
+# Epsilons and offsets of the scalar renderer, the kernels always compute in float64 like it
+PARALLEL_EPSILON = 1e-6
+DETERMINANT_EPSILON = 1e-12
+SURFACE_OFFSET = 1e-2
+# Depth of the traversal stack of the mesh BVHs, far more than their median split trees need
+MESH_STACK_SIZE = 128
+
+# JIT=0 turns the compiled kernels off at startup, set_jit_enabled switches them at runtime
+_enabled = os.getenv('JIT', '1').lower() not in ('0', 'false', 'no')
+
+
+def jit(function):
+    """
+        numba.njit when numba is installed, otherwise the function itself.
+    """
+    if numba is None:
+        return function
+    # The numpy error model gives inf and nan for divisions by zero like the python code
+    return numba.njit(cache=True, error_model='numpy')(function)
+
+
+def jit_available() -> bool:
+    return numba is not None and _enabled
+
+
+def set_jit_enabled(enabled: bool):
+    global _enabled
+    _enabled = enabled
+
+
+def jit_supported(scene: "Scene") -> bool:
+    """
+        Whether the compiled kernels render the scene, Russian roulette and light sampling draw
+        from the random generator of the scene and stay on the python path.
+    """
+    return jit_available() and not scene.russian_roulette and not scene.light_samples
+
+
+@jit
+def dot3(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+@jit
+def cross3(a, b):
+    return np.array([a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0]])
+
+
+@jit
+def normalize3(vector):
+    norm = np.sqrt(dot3(vector, vector))
+    if norm == 0:
+        return vector
+    return vector / norm
+
+
+@jit
+def reflected3(vector, axis):
+    return vector - 2 * dot3(vector, axis) * axis
+
+
+@jit
+def intersect_sphere(origin, direction, center, radius):
+    oc = origin - center
+    b = 2 * dot3(direction, oc)
+    c = np.sqrt(dot3(oc, oc)) ** 2 - radius ** 2
+    discriminant = b ** 2 - 4 * c
+    if discriminant > 0:
+        dist1 = (-b + np.sqrt(discriminant)) / 2
+        dist2 = (-b - np.sqrt(discriminant)) / 2
+        if dist1 > 0 and dist2 > 0:
+            return min(dist1, dist2)
+    return math.inf
+
+
+@jit
+def intersect_plane(origin, direction, normal, point):
+    denom = dot3(normal, direction)
+    if abs(denom) < PARALLEL_EPSILON:
+        return math.inf
+    t = dot3(point - origin, normal) / denom
+    if t > 0:
+        return t
+    return math.inf
+
+
+@jit
+def point_in_rectangle(point, corners, normal):
+    for i in range(4):
+        v1 = corners[i] - point
+        v2 = corners[(i + 1) % 4] - point
+        if dot3(normal, cross3(v1, v2)) <= 0:
+            return False
+    return True
+
+
+@jit
+def intersect_rectangle(origin, direction, corners, normal):
+    dist = intersect_plane(origin, direction, normal, corners[0])
+    if dist < math.inf and point_in_rectangle(origin + dist * direction, corners, normal):
+        return dist
+    return math.inf
+
+
+@jit
+def intersect_triangle(origin, direction, v0, e1, e2):
+    p = cross3(direction, e2)
+    det = dot3(p, e1)
+    if not abs(det) > DETERMINANT_EPSILON:
+        return math.inf
+    inv_det = 1 / det
+    s = origin - v0
+    u = dot3(s, p) * inv_det
+    q = cross3(s, e1)
+    v = dot3(direction, q) * inv_det
+    t = dot3(q, e2) * inv_det
+    if u >= 0 and v >= 0 and u + v <= 1 and t > 0:
+        return t
+    return math.inf
+
+
+@jit
+def inverse3(direction):
+    """
+        inverse_direction, with a nan first component for a ray without a direction.
+    """
+    inverse = np.empty(3)
+    for k in range(3):
+        if np.isnan(direction[k]):
+            inverse[0] = np.nan
+            return inverse
+        inverse[k] = math.inf if abs(direction[k]) < 1e-300 else 1 / direction[k]
+    return inverse
+
+
+@jit
+def slab3(origin, inverse, low, high):
+    """
+        slab_test, with math.inf for a miss.
+    """
+    t_near, t_far = -math.inf, math.inf
+    for k in range(3):
+        if np.isinf(inverse[k]):
+            if origin[k] < low[k] or origin[k] > high[k]:
+                return math.inf
+            continue
+        t1, t2 = (low[k] - origin[k]) * inverse[k], (high[k] - origin[k]) * inverse[k]
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > t_near:
+            t_near = t1
+        if t2 < t_far:
+            t_far = t2
+        if t_near > t_far:
+            return math.inf
+    if t_far < 0:
+        return math.inf
+    return t_near
+
+
+@jit
+def mesh_nearest(origin, direction, mesh, meshes, tests):
+    """
+        MeshBVH.intersect_ray, returns the distance (math.inf for a miss) and the triangle id.
+    """
+    roots, node_low, node_high, children, starts, counts, v0, e1, e2, triangle_ids, _, _ = meshes
+    best_dist, best_id = math.inf, np.int64(-1)
+    root = roots[mesh]
+    if root < 0:
+        return best_dist, best_id
+    inverse = inverse3(direction)
+    if np.isnan(inverse[0]):
+        return best_dist, best_id
+    nodes = np.empty(MESH_STACK_SIZE, dtype=np.int64)
+    entries = np.empty(MESH_STACK_SIZE)
+    t_root = slab3(origin, inverse, node_low[root], node_high[root])
+    size = 0
+    if t_root < math.inf:
+        nodes[0], entries[0], size = root, t_root, 1
+    while size > 0:
+        size -= 1
+        node, t_near = nodes[size], entries[size]
+        if t_near > best_dist:
+            continue
+        left, right = children[node, 0], children[node, 1]
+        if left >= 0:
+            t_left = slab3(origin, inverse, node_low[left], node_high[left])
+            t_right = slab3(origin, inverse, node_low[right], node_high[right])
+            # The nearer child is pushed last so it is visited first, the left one on a tie
+            first, t_first, second, t_second = left, t_left, right, t_right
+            if t_left < t_right:
+                first, t_first, second, t_second = right, t_right, left, t_left
+            if t_first < math.inf:
+                nodes[size], entries[size], size = first, t_first, size + 1
+            if t_second < math.inf:
+                nodes[size], entries[size], size = second, t_second, size + 1
+            continue
+        tests[0] += counts[node]
+        for k in range(starts[node], starts[node] + counts[node]):
+            dist = intersect_triangle(origin, direction, v0[k], e1[k], e2[k])
+            if dist < best_dist or (dist == best_dist and dist < math.inf and triangle_ids[k] < best_id):
+                best_dist, best_id = dist, triangle_ids[k]
+    return best_dist, best_id
+
+
+@jit
+def intersect_primitive(origin, direction, index, geometry, meshes, tests):
+    """
+        Distance to the primitive with object id index (math.inf for a miss) and the triangle id
+        of a mesh hit.
+    """
+    types, type_index, centers, radii, plane_normals, plane_points, corners, rectangle_normals = geometry
+    k = type_index[index]
+    if types[index] == SPHERE:
+        tests[0] += 1
+        return intersect_sphere(origin, direction, centers[k], radii[k]), np.int64(-1)
+    if types[index] == PLANE:
+        tests[0] += 1
+        return intersect_plane(origin, direction, plane_normals[k], plane_points[k]), np.int64(-1)
+    if types[index] == RECTANGLE:
+        tests[0] += 1
+        return intersect_rectangle(origin, direction, corners[k], rectangle_normals[k]), np.int64(-1)
+    return mesh_nearest(origin, direction, k, meshes, tests)
+
+
+@jit
+def nearest_hit(origin, direction, geometry, meshes, tests, hits):
+    """
+        Scene.nearest_hit, returns the distance, object id and triangle id (-1 for a miss).
+    """
+    types = geometry[0]
+    best_dist, best_index, best_triangle = math.inf, -1, -1
+    # In object id order, so the lower id wins ties like in the BVH
+    for index in range(len(types)):
+        dist, triangle = intersect_primitive(origin, direction, index, geometry, meshes, tests)
+        if dist < best_dist:
+            best_dist, best_index, best_triangle = dist, index, triangle
+    if best_index >= 0:
+        hits[types[best_index]] += 1
+    return best_dist, best_index, best_triangle
+
+
+@jit
+def occluded(origin, direction, max_distance, geometry, meshes, tests):
+    types = geometry[0]
+    for index in range(len(types)):
+        dist, _ = intersect_primitive(origin, direction, index, geometry, meshes, tests)
+        if dist < max_distance:
+            return True
+    return False
+
+
+@jit
+def normal_at(index, triangle, point, geometry, meshes):
+    types, type_index, centers, _, plane_normals, _, _, rectangle_normals = geometry
+    k = type_index[index]
+    if types[index] == SPHERE:
+        return normalize3(point - centers[k])
+    if types[index] == PLANE:
+        return plane_normals[k].copy()
+    if types[index] == RECTANGLE:
+        return rectangle_normals[k].copy()
+    _, _, _, _, _, _, _, _, _, _, normals, normal_offsets = meshes
+    return normals[normal_offsets[k] + triangle].copy()
+
+
+@jit
+def calc_point3(origin, direction, dist, index, triangle, geometry, meshes):
+    point = origin + dist * direction
+    return point + normal_at(index, triangle, point, geometry, meshes) * SURFACE_OFFSET
+
+
+@jit
+def light_direction(light, point, lights):
+    types, _, positions, directions, _ = lights
+    if types[light] == DIRECTIONAL:
+        return normalize3(directions[light])
+    return normalize3(normalize3(positions[light] - point))
+
+
+@jit
+def light_distance(light, point, lights):
+    types, _, positions, _, _ = lights
+    if types[light] == DIRECTIONAL:
+        return math.inf
+    offset = point - positions[light]
+    return np.sqrt(dot3(offset, offset))
+
+
+@jit
+def light_intensity(light, point, lights):
+    types, intensities, positions, directions, attenuations = lights
+    if types[light] == DIRECTIONAL:
+        return intensities[light].copy()
+    d = light_distance(light, point, lights)
+    kc, kl, kq = attenuations[light, 0], attenuations[light, 1], attenuations[light, 2]
+    if types[light] == POINT:
+        return intensities[light] / (kc + kl * d + kq * (d ** 2))
+    cos_angle = dot3(normalize3(positions[light] - point), directions[light])
+    return intensities[light] * cos_angle / (kc + kl * d + kq * (d ** 2))
+
+
+@jit
+def get_color3(direction, point, index, triangle, max_depth, min_weight, shadows, light_cutoff, camera,
+               ambient, geometry, meshes, materials, lights, rays, tests, hits):
+    """
+        get_color of a hit, the pending hits are kept on a stack in the same order.
+    """
+    material_ambient, diffuse, specular, shininess, reflection, refractive_index = materials
+    size = 2 * max_depth + 2
+    directions, points = np.empty((size, 3)), np.empty((size, 3))
+    indices, triangles, levels = (np.empty(size, dtype=np.int64), np.empty(size, dtype=np.int64),
+                                  np.empty(size, dtype=np.int64))
+    weights = np.empty(size)
+    directions[0], points[0], indices[0], triangles[0], levels[0], weights[0] = direction, point, index, triangle, 1, 1.0
+    pending = 1
+    color = np.zeros(3)
+
+    while pending > 0:
+        pending -= 1
+        direction, point = directions[pending].copy(), points[pending].copy()
+        index, triangle, level, weight = indices[pending], triangles[pending], levels[pending], weights[pending]
+        normal = normal_at(index, triangle, point, geometry, meshes)
+        local_color = material_ambient[index] * ambient
+
+        for light in range(len(lights[0])):
+            intensity = light_intensity(light, point, lights)
+            if light_cutoff > 0 and max(intensity[0], intensity[1], intensity[2]) < light_cutoff:
+                continue
+            to_light = light_direction(light, point, lights)
+            sj = 1.0
+            if shadows:
+                rays[SHADOW, level - 1] += 1
+                if occluded(point, to_light, light_distance(light, point, lights), geometry, meshes, tests):
+                    sj = 0.0
+            diffuse_color = diffuse[index] * intensity * dot3(normal, to_light)
+            view_direction = normalize3(camera - point)
+            reflection_direction = reflected3(-to_light, normal)
+            specular_intensity = dot3(view_direction, normalize3(reflection_direction)) ** (shininess[index] / 10)
+            specular_color = specular[index] * intensity * specular_intensity
+            local_color = local_color + sj * (diffuse_color + specular_color)
+
+        color = color + weight * local_color
+
+        level = level + 1
+        if level > max_depth:
+            continue
+
+        r_weight = weight * reflection[index]
+        if r_weight >= min_weight:
+            r_direction = normalize3(reflected3(direction, normal))
+            rays[REFLECTION, level - 1] += 1
+            dist, hit_index, hit_triangle = nearest_hit(point, r_direction, geometry, meshes, tests, hits)
+            if hit_index >= 0:
+                directions[pending] = r_direction
+                points[pending] = calc_point3(point, r_direction, dist, hit_index, hit_triangle, geometry, meshes)
+                indices[pending], triangles[pending], levels[pending], weights[pending] = (
+                    hit_index, hit_triangle, level, r_weight)
+                pending += 1
+
+        n2 = refractive_index[index]
+        if n2 > 0 and weight >= min_weight:
+            # refracted, with n1 = 1
+            incident = normalize3(direction)
+            cos_theta1 = -dot3(normal, incident)
+            sin_theta1 = np.sqrt(1 - cos_theta1 ** 2)
+            if not sin_theta1 > n2:
+                cos_theta2 = np.sqrt(1 - (1 / n2) ** 2 * (1 - cos_theta1 ** 2))
+                t_direction = normalize3(normalize3((1 / n2) * incident + (1 / n2 * cos_theta1 - cos_theta2) * normal))
+                rays[REFRACTION, level - 1] += 1
+                dist, hit_index, hit_triangle = nearest_hit(point, t_direction, geometry, meshes, tests, hits)
+                if hit_index >= 0:
+                    directions[pending] = t_direction
+                    points[pending] = calc_point3(point, t_direction, dist, hit_index, hit_triangle, geometry, meshes)
+                    indices[pending], triangles[pending], levels[pending], weights[pending] = (
+                        hit_index, hit_triangle, level, weight)
+                    pending += 1
+
+    return color
+
+
+@jit
+def trace_pixels(pixels, camera, max_depth, min_weight, shadows, light_cutoff, ambient, geometry, meshes,
+                 materials, lights, colors, object_ids, rays, tests, hits):
+    """
+        trace_pixel of every pixel position, writes the clipped colors and the hit object ids.
+    """
+    for p in range(len(pixels)):
+        direction = normalize3(normalize3(pixels[p] - camera))
+        rays[PRIMARY, 0] += 1
+        dist, index, triangle = nearest_hit(camera, direction, geometry, meshes, tests, hits)
+        object_ids[p] = index
+        colors[p] = 0
+        if index >= 0:
+            point = calc_point3(camera, direction, dist, index, triangle, geometry, meshes)
+            color = get_color3(direction, point, index, triangle, max_depth, min_weight, shadows, light_cutoff,
+                               camera, ambient, geometry, meshes, materials, lights, rays, tests, hits)
+            for k in range(3):
+                colors[p, k] = min(max(color[k], 0.0), 1.0)
+
+
+class JitScene:
+    """
+        The scene packed into the float64 arrays the kernels take (the scalar renderer traces in
+        float64 whatever the precision of the scene): the geometry and materials of a float64
+        CompiledScene, the mesh BVHs concatenated into one set of node and triangle arrays, and
+        the lights as type codes and parameter rows. The kernels test every primitive in object
+        id order instead of walking the scene BVH, which returns the same hits; the intersection
+        test counters count those tests.
+    """
+
+    def __init__(self, scene: "Scene"):
+        self.scene = scene
+        compiled = CompiledScene(scene.camera, scene.ambient, scene.objects)
+        self.camera, self.ambient = compiled.camera, compiled.ambient
+
+        type_index = np.zeros(compiled.count, dtype=np.int64)
+        for ids in (compiled.sphere_ids, compiled.plane_ids, compiled.rectangle_ids, compiled.mesh_ids):
+            type_index[ids] = np.arange(len(ids))
+        self.geometry = (compiled.types, type_index, compiled.sphere_centers, compiled.sphere_radii,
+                         compiled.plane_normals, compiled.plane_points, compiled.rectangle_corners,
+                         compiled.rectangle_normals)
+        self.meshes = pack_meshes(compiled)
+        self.materials = (compiled.material_ambient, compiled.material_diffuse, compiled.material_specular,
+                          compiled.material_shininess, compiled.material_reflection,
+                          compiled.material_refractive_index)
+        self.lights = pack_lights(scene.lights)
+
+    def trace(self, pixels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+            Clipped colors and hit object ids of the (N, 3) pixel positions, the rays, tests
+            and hits are added to the stats of the scene.
+        """
+        scene = self.scene
+        colors = np.zeros((len(pixels), 3))
+        object_ids = np.full(len(pixels), -1, dtype=np.int64)
+        rays = np.zeros((len(RAY_KINDS), scene.max_depth + 1), dtype=np.int64)
+        tests = np.zeros(1, dtype=np.int64)
+        hits = np.zeros(len(PRIMITIVE_NAMES), dtype=np.int64)
+        with np.errstate(all='ignore'):
+            trace_pixels(np.asarray(pixels, dtype=float), self.camera, scene.max_depth, float(scene.min_weight),
+                         bool(scene.shadows), float(scene.light_cutoff), self.ambient, self.geometry, self.meshes,
+                         self.materials, self.lights, colors, object_ids, rays, tests, hits)
+
+        if scene.stats is not None:
+            for (kind, depth), count in np.ndenumerate(rays):
+                if count:
+                    scene.stats.count_rays(RAY_KINDS[kind], depth, int(count))
+            scene.stats.count_tests(int(tests[0]))
+            for code, count in enumerate(hits.tolist()):
+                if count:
+                    scene.stats.count_hits(PRIMITIVE_NAMES[code], count)
+        return colors, object_ids
+
+
+def pack_meshes(compiled: CompiledScene) -> tuple:
+    """
+        The BVHs of all the meshes in one set of arrays: (root node of every mesh (-1 when it is
+        empty), node boxes, children, first triangle and triangle count of every node, the
+        triangles (v0, e1, e2) and their mesh triangle ids, the normals of all the meshes and the
+        first normal of every mesh).
+    """
+    roots, lows, highs, children, starts, counts = [], [], [], [], [], []
+    v0, e1, e2, triangle_ids, normals, normal_offsets = [], [], [], [], [], []
+    nodes = triangles = normal_count = 0
+    for bvh, mesh_normals in zip(compiled.mesh_bvhs, compiled.mesh_normals):
+        roots.append(nodes if len(bvh.node_count) else -1)
+        lows.append(bvh.node_low)
+        highs.append(bvh.node_high)
+        children.append(np.where(bvh.node_children >= 0, bvh.node_children + nodes, -1))
+        starts.append(bvh.node_start + triangles)
+        counts.append(bvh.node_count)
+        v0.append(bvh.v0), e1.append(bvh.e1), e2.append(bvh.e2), triangle_ids.append(bvh.triangle_ids)
+        normals.append(mesh_normals)
+        normal_offsets.append(normal_count)
+        nodes, triangles, normal_count = nodes + len(bvh.node_count), triangles + len(bvh.v0), normal_count + len(
+            mesh_normals)
+
+    def rows(arrays: List[np.ndarray], shape: Tuple[int, ...], dtype=float) -> np.ndarray:
+        if not arrays:
+            return np.zeros((0,) + shape, dtype=dtype)
+        return np.ascontiguousarray(np.concatenate(arrays), dtype=dtype).reshape((-1,) + shape)
+
+    return (np.array(roots, dtype=np.int64), rows(lows, (3,)), rows(highs, (3,)), rows(children, (2,), np.int64),
+            rows(starts, (), np.int64), rows(counts, (), np.int64), rows(v0, (3,)), rows(e1, (3,)), rows(e2, (3,)),
+            rows(triangle_ids, (), np.int64), rows(normals, (3,)), np.array(normal_offsets, dtype=np.int64))
+
+
+def pack_lights(lights: List[Light]) -> tuple:
+    """
+        (type codes, intensities, positions, directions, (kc, kl, kq) rows), a scalar intensity is
+        repeated over the 3 channels.
+    """
+    count = len(lights)
+    types = np.zeros(count, dtype=np.int64)
+    intensities, positions, directions, attenuations = (np.zeros((count, 3)) for _ in range(4))
+    for l, light in enumerate(lights):
+        intensities[l] = np.broadcast_to(np.asarray(light.intensity, dtype=float), 3)
+        if isinstance(light, DirectionalLight):
+            types[l], directions[l] = DIRECTIONAL, light.direction
+            continue
+        types[l] = SPOT if isinstance(light, SpotLight) else POINT
+        positions[l] = light.position
+        attenuations[l] = light.kc, light.kl, light.kq
+        if isinstance(light, SpotLight):
+            directions[l] = light.direction
+    return types, intensities, positions, directions, attenuations
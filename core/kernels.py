@@ -0,0 +1,82 @@
+import numpy as np
+from .utils import dot_rows
+
+# Batched intersection kernels on plain arrays. origins and directions are (N, 3) arrays
+# (origins can also be a single point), every kernel tests all the rays against all the
+# primitives it gets and returns an (N, count) array of hit distances, np.inf for a miss.
+# The kernels compute in the dtype of their inputs, the epsilons come from the Precision.
+
+
+def intersect_spheres(origins: np.ndarray, directions: np.ndarray, centers: np.ndarray,
+                      radii: np.ndarray) -> np.ndarray:
+    oc = origins[..., np.newaxis, :] - centers
+    half_b = dot_rows(directions[:, np.newaxis, :], oc)
+    # A quarter of b^2 - 4c, from the distance between the center and the line of the ray: it
+    # doesn't cancel out like the difference of the two large terms when the ray grazes the sphere
+    closest = oc - half_b[..., np.newaxis] * directions[:, np.newaxis, :]
+    discriminant = radii ** 2 - dot_rows(closest, closest)
+    hit = discriminant > 0
+    root = np.sqrt(np.where(hit, discriminant, 0))
+    dist1 = -half_b + root
+    dist2 = -half_b - root
+    hit &= (dist1 > 0) & (dist2 > 0)
+    return np.where(hit, np.minimum(dist1, dist2), np.inf)
+
+
+def intersect_planes(origins: np.ndarray, directions: np.ndarray, normals: np.ndarray,
+                     points: np.ndarray, epsilon: float = 1e-6) -> np.ndarray:
+    denom = dot_rows(directions[:, np.newaxis, :], normals)
+    valid = np.abs(denom) >= epsilon
+    t = dot_rows(points - origins[..., np.newaxis, :], normals) / np.where(valid, denom, 1)
+    return np.where(valid & (t > 0), t, np.inf)
+
+
+def intersect_rectangles(origins: np.ndarray, directions: np.ndarray, corners: np.ndarray,
+                         normals: np.ndarray, epsilon: float = 1e-6) -> np.ndarray:
+    """
+        corners is an (R, 4, 3) array of the a, b, c, d vertices of every rectangle.
+    """
+    dists = intersect_planes(origins, directions, normals, corners[:, 0], epsilon)
+    hit = np.isfinite(dists)
+    hit_points = origins[..., np.newaxis, :] + \
+        np.where(hit, dists, 0)[..., np.newaxis] * directions[:, np.newaxis, :]
+    for i in range(4):
+        v1 = corners[:, i] - hit_points
+        v2 = corners[:, (i + 1) % 4] - hit_points
+        hit &= dot_rows(np.cross(v1, v2), normals) > 0
+    return np.where(hit, dists, np.inf)
+
+
+def intersect_triangles(origins: np.ndarray, directions: np.ndarray, v0: np.ndarray, e1: np.ndarray,
+                        e2: np.ndarray, epsilon: float = 1e-12) -> np.ndarray:
+    """
+        Moller-Trumbore test of every ray against every triangle (v0, v0 + e1, v0 + e2).
+    """
+    p = np.cross(directions[:, np.newaxis, :], e2)
+    det = dot_rows(p, e1)
+    valid = np.abs(det) > epsilon
+    inv_det = 1 / np.where(valid, det, 1)
+    s = origins[..., np.newaxis, :] - v0
+    u = dot_rows(s, p) * inv_det
+    q = np.cross(s, e1)
+    v = dot_rows(directions[:, np.newaxis, :], q) * inv_det
+    t = dot_rows(q, e2) * inv_det
+    hit = valid & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 0)
+    return np.where(hit, t, np.inf)
+
+
+def nearest_of(dists: np.ndarray, ids: np.ndarray, nearest_dist: np.ndarray, nearest_ids: np.ndarray):
+    """
+        Merges an (N, count) block of hit distances of the primitives ids into the nearest hit
+        buffers in place. Equal distances go to the lower id, same as a linear scan in id order.
+    """
+    if dists.shape[1] == 0:
+        return
+    # ids are sorted so argmin (first minimum) already prefers the lower id inside the block
+    best = np.argmin(dists, axis=1)
+    best_dist = dists[np.arange(len(dists)), best]
+    best_ids = ids[best]
+    closer = (best_dist < nearest_dist) | ((best_dist == nearest_dist) & np.isfinite(best_dist) &
+                                           (best_ids < nearest_ids))
+    nearest_dist[closer] = best_dist[closer]
+    nearest_ids[closer] = best_ids[closer]
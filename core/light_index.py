@@ -0,0 +1,91 @@
+import numpy as np
+from typing import List, Optional
+from .lights import Light, DirectionalLight
+
+
+def influence_radius(light: Light, cutoff: float) -> float:
+    """
+        Distance beyond which the attenuated intensity of a point or spot light is below cutoff in
+        every channel (np.inf when it never is, -np.inf when it never reaches cutoff). The cone of
+        a spot light only lowers its intensity, so the bound of the point light holds for it too.
+    """
+    brightest = float(np.max(light.intensity))
+    if isinstance(light, DirectionalLight) or cutoff <= 0:
+        return np.inf
+    if brightest < cutoff * light.kc or brightest <= 0:
+        return -np.inf
+    # brightest / (kc + kl * d + kq * d^2) >= cutoff, the largest root of the quadratic
+    c = light.kc - brightest / cutoff
+    if light.kq > 0:
+        return (-light.kl + np.sqrt(light.kl ** 2 - 4 * light.kq * c)) / (2 * light.kq)
+    if light.kl > 0:
+        return -c / light.kl
+    return np.inf
+
+
+class LightIndex:
+    """
+        Light culling and selection for scenes with many lights. A light is culled at a point when
+        it adds less than cutoff there: its intensity at the point (after attenuation and the cone
+        of spot lights, so spot lights that point away from it are always culled) is below cutoff
+        in every channel. The influence radius of every light is precomputed, so lights far from
+        the point are culled with a distance test and their intensity is only computed inside it.
+        Culled lights cast no shadow ray and are not shaded.
+        With samples > 0 at most samples lights are shaded per point, drawn (with replacement)
+        with a probability proportional to their intensity there and weighted by the inverse of
+        it, so the expected color is the one of all the lights that are not culled.
+    """
+
+    def __init__(self, lights: List[Light], cutoff: float = 0.0, samples: int = 0):
+        if cutoff < 0 or samples < 0:
+            raise ValueError("cutoff and samples can't be negative")
+        self.lights = lights
+        self.cutoff = cutoff
+        self.samples = samples
+        self.radii = np.array([influence_radius(light, cutoff) for light in lights])
+
+    def weights(self, points: np.ndarray, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        """
+            (N, L) weights the lights are shaded with at every point, 0 where a light is culled or
+            not drawn. Without samples they are 1 for every light that is not culled.
+        """
+        estimates = np.zeros((len(points), len(self.lights)), dtype=points.dtype)
+        for l, light in enumerate(self.lights):
+            if self.radii[l] < 0:
+                continue
+            if self.radii[l] == np.inf:
+                rows = np.arange(len(points))
+            else:
+                position = np.asarray(light.position, dtype=points.dtype)
+                rows = np.flatnonzero(((points - position) ** 2).sum(axis=1) <= self.radii[l] ** 2)
+            if len(rows):
+                intensities = light.get_intensities(points[rows]).max(axis=1)
+                estimates[rows, l] = np.where(intensities >= self.cutoff, intensities, 0)
+
+        # Lights that add no light (or remove some) are never shaded
+        estimates = np.maximum(estimates, 0)
+        weights = (estimates > 0).astype(points.dtype)
+        if not self.samples:
+            return weights
+
+        sampled = np.flatnonzero(weights.sum(axis=1) > self.samples)
+        if len(sampled):
+            cumulative = np.cumsum(estimates[sampled], axis=1)
+            # Dividing by the last sum makes it exactly 1, so a draw in [0, 1) never picks a light
+            # after the last one with a positive estimate
+            probabilities = estimates[sampled] / cumulative[:, -1:]
+            cumulative = cumulative / cumulative[:, -1:]
+            draws = rng.random((len(sampled), self.samples, 1))
+            chosen = (draws >= cumulative[:, np.newaxis]).sum(axis=2)
+            counts = np.zeros(probabilities.shape, dtype=points.dtype)
+            np.add.at(counts, (np.repeat(np.arange(len(sampled)), self.samples), chosen.ravel()), 1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weights[sampled] = np.where(counts > 0, counts / (self.samples * probabilities), 0)
+        return weights
+
+    def select(self, point: np.ndarray, rng: Optional[np.random.Generator] = None):
+        """
+            weights of a single point, as (light, weight) pairs of the lights that are shaded.
+        """
+        weights = self.weights(np.asarray(point, dtype=float)[np.newaxis], rng)[0]
+        return [(self.lights[l], weights[l]) for l in np.flatnonzero(weights)]
@@ -1,5 +1,5 @@
 import numpy as np
-from .utils import normalize
+from .utils import normalize, normalize_rows, dot_rows
 from .ray import Ray
 from typing import Union, List
 
@@ -17,12 +17,21 @@ class DirectionalLight(LightSource):
     def get_light_ray(self, intersection_point: np.ndarray) -> Ray:
         return Ray(intersection_point, self.direction)
 
-    def get_distance_from_light(self):
+    def get_distance_from_light(self, intersection: np.ndarray = None):
         return np.inf
 
-    def get_intensity(self):
+    def get_intensity(self, intersection: np.ndarray = None):
         return self.intensity
 
+    def get_light_directions(self, intersections: np.ndarray) -> np.ndarray:
+        return np.broadcast_to(np.asarray(self.direction, dtype=intersections.dtype), intersections.shape)
+
+    def get_distances_from_light(self, intersections: np.ndarray) -> np.ndarray:
+        return np.full(len(intersections), np.inf, dtype=intersections.dtype)
+
+    def get_intensities(self, intersections: np.ndarray) -> np.ndarray:
+        return intensity_rows(self.intensity, np.ones(len(intersections), dtype=intersections.dtype))
+
 
 class PointLight(LightSource):
     def __init__(self, intensity: float, position: List[float], kc: float, kl: float, kq: float):
@@ -38,10 +47,20 @@ class PointLight(LightSource):
     def get_distance_from_light(self, intersection: np.ndarray) -> float:
         return np.linalg.norm(intersection - self.position)
 
+    def get_light_directions(self, intersections: np.ndarray) -> np.ndarray:
+        return normalize_rows(np.asarray(self.position, dtype=intersections.dtype) - intersections)
+
+    def get_distances_from_light(self, intersections: np.ndarray) -> np.ndarray:
+        return np.linalg.norm(intersections - np.asarray(self.position, dtype=intersections.dtype), axis=1)
+
     def get_intensity(self, intersection: np.ndarray) -> float:
         d = self.get_distance_from_light(intersection)
         return self.intensity / (self.kc + self.kl*d + self.kq * (d**2))
 
+    def get_intensities(self, intersections: np.ndarray) -> np.ndarray:
+        d = self.get_distances_from_light(intersections)
+        return intensity_rows(self.intensity, 1 / (self.kc + self.kl*d + self.kq * (d**2)))
+
 
 class SpotLight(LightSource):
     def __init__(self, intensity: float, position: np.ndarray, direction: np.ndarray, kc: float, kl: float, kq: float):
@@ -58,6 +77,12 @@ class SpotLight(LightSource):
     def get_distance_from_light(self, intersection: np.ndarray) -> float:
         return np.linalg.norm(intersection - self.position)
 
+    def get_light_directions(self, intersections: np.ndarray) -> np.ndarray:
+        return normalize_rows(np.asarray(self.position, dtype=intersections.dtype) - intersections)
+
+    def get_distances_from_light(self, intersections: np.ndarray) -> np.ndarray:
+        return np.linalg.norm(intersections - np.asarray(self.position, dtype=intersections.dtype), axis=1)
+
     def get_intensity(self, intersection: np.ndarray) -> float:
         light_direction = normalize(self.position - intersection)
         cos_angle = np.dot(light_direction, self.direction)
@@ -68,5 +93,17 @@ class SpotLight(LightSource):
         d = self.get_distance_from_light(intersection)
         return self.kc + self.kl*d + self.kq * (d**2)
 
+    def get_intensities(self, intersections: np.ndarray) -> np.ndarray:
+        direction = np.asarray(self.direction, dtype=intersections.dtype)
+        cos_angles = dot_rows(self.get_light_directions(intersections), direction)
+        d = self.get_distances_from_light(intersections)
+        return intensity_rows(self.intensity, cos_angles / (self.kc + self.kl*d + self.kq * (d**2)))
+
+
+# Batched intensities are (N, 3) rows (or (N, 1) for a scalar intensity), one per intersection,
+# in the dtype of factors
+def intensity_rows(intensity, factors: np.ndarray) -> np.ndarray:
+    return np.asarray(intensity, dtype=factors.dtype).reshape(1, -1) * factors[:, np.newaxis]
+
 
 Light = Union[PointLight, SpotLight, DirectionalLight]
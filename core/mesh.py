@@ -0,0 +1,396 @@
+import os
+import copy
+import hashlib
+import logging
+import tempfile
+import numpy as np
+from functools import lru_cache
+from typing import List, Optional, Tuple
+from .bvh import BOX_PADDING, inverse_direction, slab_test
+from .instrumentation import RenderStats
+from .kernels import intersect_triangles, nearest_of
+from .objects import Object3D
+from .precision import DEFAULT_PRECISION, Precision
+from .ray import Ray
+from .utils import normalize_rows
+
+# Triangles per leaf of the mesh BVH
+MESH_LEAF_SIZE = 16
+# Directory of the parsed mesh files, outside of the mesh directory which may be read only
+MESH_CACHE_DIR = os.getenv('MESH_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'raytracer-mesh-cache'))
+
+
+class MeshBVH:
+    """
+        Bounding volume hierarchy over the triangles of a mesh, built with object median splits.
+        Everything is stored in flat arrays: the triangles are reordered so every leaf is a
+        contiguous slice of them, and triangle_ids maps a position back to the mesh triangle.
+        Rays are traversed as packets (all the rays that reach a node are tested together) by
+        the batched queries and one at a time by intersect_ray.
+    """
+
+    def __init__(self, v0: np.ndarray, e1: np.ndarray, e2: np.ndarray, leaf_size: int = MESH_LEAF_SIZE):
+        vertices = np.stack([v0, v0 + e1, v0 + e2], axis=1)
+        lows, highs = vertices.min(axis=1), vertices.max(axis=1)
+        centroids = (lows + highs) / 2
+
+        node_low, node_high, node_children, node_axis, node_start, node_count = [], [], [], [], [], []
+        order = np.arange(len(v0))
+        # (node, first position, end position) of the nodes still to split
+        stack = []
+        if len(v0):
+            node_low.append(None), node_high.append(None), node_children.append((-1, -1))
+            node_axis.append(0), node_start.append(0), node_count.append(len(v0))
+            stack.append((0, 0, len(v0)))
+        while stack:
+            node, start, end = stack.pop()
+            members = order[start:end]
+            node_low[node] = lows[members].min(axis=0) - BOX_PADDING
+            node_high[node] = highs[members].max(axis=0) + BOX_PADDING
+            if end - start <= leaf_size:
+                # Triangles of a leaf are sorted so the lower id wins ties, like the scene BVH
+                order[start:end] = np.sort(members)
+                continue
+            axis = int(np.argmax(np.ptp(centroids[members], axis=0)))
+            middle = (end - start) // 2
+            order[start:end] = members[np.argpartition(centroids[members, axis], middle)]
+            children = []
+            for child_start, child_end in ((start, start + middle), (start + middle, end)):
+                children.append(len(node_count))
+                node_low.append(None), node_high.append(None), node_children.append((-1, -1))
+                node_axis.append(0), node_start.append(child_start), node_count.append(child_end - child_start)
+                stack.append((children[-1], child_start, child_end))
+            node_children[node] = tuple(children)
+            node_axis[node] = axis
+
+        self.node_low = np.array(node_low, dtype=float).reshape(-1, 3)
+        self.node_high = np.array(node_high, dtype=float).reshape(-1, 3)
+        self.node_children = np.array(node_children, dtype=np.int64).reshape(-1, 2)
+        self.node_axis = np.array(node_axis, dtype=np.int64)
+        self.node_start = np.array(node_start, dtype=np.int64)
+        self.node_count = np.array(node_count, dtype=np.int64)
+        self.triangle_ids = order
+        self.v0, self.e1, self.e2 = v0[order], e1[order], e2[order]
+        self.precision = DEFAULT_PRECISION
+        # Python copies of the node arrays for intersect_ray, made on its first call
+        self._nodes = None
+
+    def astype(self, precision: Precision) -> "MeshBVH":
+        """
+            The same tree with its boxes and triangles in the dtype of precision, the batched
+            queries then compute in that dtype. The boxes get the padding of precision on top
+            so rounding never moves a box inside its triangles.
+        """
+        if precision is self.precision:
+            return self
+        converted = copy.copy(self)
+        converted.precision = precision
+        converted.node_low = (self.node_low - precision.box_padding).astype(precision.dtype)
+        converted.node_high = (self.node_high + precision.box_padding).astype(precision.dtype)
+        converted.v0, converted.e1, converted.e2 = (
+            array.astype(precision.dtype) for array in (self.v0, self.e1, self.e2))
+        converted._nodes = None
+        return converted
+
+    def translated(self, offset: np.ndarray) -> "MeshBVH":
+        """
+            The same tree moved by offset, a moved mesh keeps its tree instead of building a new one.
+        """
+        moved = copy.copy(self)
+        offset = np.asarray(offset, dtype=self.v0.dtype)
+        moved.node_low, moved.node_high, moved.v0 = self.node_low + offset, self.node_high + offset, self.v0 + offset
+        moved._nodes = None
+        return moved
+
+    def is_leaf(self, node: int) -> bool:
+        return self.node_children[node, 0] < 0
+
+    def nearest(self, origins: np.ndarray, directions: np.ndarray, max_distances: Optional[np.ndarray] = None,
+                stats: Optional[RenderStats] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+            Nearest hit of every ray closer than its max distance, returns the distances (np.inf
+            for a miss) and the triangle ids (-1 for a miss).
+        """
+        count = len(directions)
+        origins = np.broadcast_to(origins, (count, 3))
+        inverse = inverse_rows(directions)
+        dtype = self.precision.dtype
+        best = np.full(count, np.inf, dtype=dtype) if max_distances is None else np.array(max_distances, dtype=dtype)
+        best_ids = np.full(count, -1, dtype=np.int64)
+
+        stack = [(0, np.arange(count))] if len(self.node_count) else []
+        while stack:
+            node, rays = stack.pop()
+            t_near = self.slab(node, origins[rays], inverse[rays])
+            # Equal distances can still win on a lower id so the test is not strict
+            rays = rays[np.isfinite(t_near) & (t_near <= best[rays])]
+            if len(rays) == 0:
+                continue
+            if not self.is_leaf(node):
+                left, right = self.node_children[node]
+                # The child on the side the packet comes from is visited first
+                if directions[rays, self.node_axis[node]].sum() < 0:
+                    left, right = right, left
+                stack.append((right, rays))
+                stack.append((left, rays))
+                continue
+            leaf = slice(self.node_start[node], self.node_start[node] + self.node_count[node])
+            if stats is not None:
+                stats.count_tests(len(rays) * int(self.node_count[node]))
+            dists = intersect_triangles(origins[rays], directions[rays], self.v0[leaf], self.e1[leaf], self.e2[leaf],
+                                        self.precision.determinant_epsilon)
+            leaf_best, leaf_ids = best[rays], best_ids[rays]
+            nearest_of(dists, self.triangle_ids[leaf], leaf_best, leaf_ids)
+            best[rays], best_ids[rays] = leaf_best, leaf_ids
+
+        best[best_ids < 0] = np.inf
+        return best, best_ids
+
+    def occluded(self, origins: np.ndarray, directions: np.ndarray, max_distances: np.ndarray,
+                 stats: Optional[RenderStats] = None) -> np.ndarray:
+        """
+            Any hit query, True for every ray that hits a triangle closer than its max distance.
+        """
+        count = len(directions)
+        origins = np.broadcast_to(origins, (count, 3))
+        inverse = inverse_rows(directions)
+        blocked = np.zeros(count, dtype=bool)
+
+        stack = [(0, np.arange(count))] if len(self.node_count) else []
+        while stack:
+            node, rays = stack.pop()
+            rays = rays[~blocked[rays]]
+            if len(rays) == 0:
+                continue
+            rays = rays[self.slab(node, origins[rays], inverse[rays]) < max_distances[rays]]
+            if len(rays) == 0:
+                continue
+            if not self.is_leaf(node):
+                stack.extend((child, rays) for child in self.node_children[node])
+                continue
+            leaf = slice(self.node_start[node], self.node_start[node] + self.node_count[node])
+            if stats is not None:
+                stats.count_tests(len(rays) * int(self.node_count[node]))
+            dists = intersect_triangles(origins[rays], directions[rays], self.v0[leaf], self.e1[leaf], self.e2[leaf],
+                                        self.precision.determinant_epsilon)
+            blocked[rays] = (dists < max_distances[rays, np.newaxis]).any(axis=1)
+        return blocked
+
+    def slab(self, node: int, origins: np.ndarray, inverse: np.ndarray) -> np.ndarray:
+        """
+            Distance where every ray enters the box of the node, np.inf when it misses it.
+        """
+        with np.errstate(invalid='ignore'):
+            t1 = (self.node_low[node] - origins) * inverse
+            t2 = (self.node_high[node] - origins) * inverse
+            # fmin and fmax skip the NaN of a ray that starts on a slab it is parallel to
+            t_near = np.maximum(np.fmax.reduce(np.fmin(t1, t2), axis=1), 0)
+            t_far = np.fmin.reduce(np.fmax(t1, t2), axis=1)
+        return np.where(t_near <= t_far, t_near, np.inf)
+
+    def intersect_ray(self, origin: np.ndarray, direction: np.ndarray,
+                      stats: Optional[RenderStats] = None) -> Optional[Tuple[float, int]]:
+        """
+            Nearest hit of a single ray, the distance and the triangle id, or None. The triangle
+            tests are counted in stats when given.
+        """
+        if not len(self.node_count):
+            return None
+        if self._nodes is None:
+            self._nodes = (self.node_low.tolist(), self.node_high.tolist(), self.node_children.tolist(),
+                           self.node_start.tolist(), self.node_count.tolist())
+        node_low, node_high, node_children, node_start, node_count = self._nodes
+        origin_tuple = tuple(np.asarray(origin, dtype=float).tolist())
+        inverse = inverse_direction(direction)
+        t_root = None if inverse is None else slab_test(origin_tuple, inverse, node_low[0], node_high[0])
+        stack = [] if t_root is None else [(0, t_root)]
+        origins, directions = np.asarray(origin, dtype=float)[np.newaxis], np.asarray(direction)[np.newaxis]
+        best_dist, best_id = np.full(1, np.inf), np.full(1, -1, dtype=np.int64)
+
+        while stack:
+            node, t_near = stack.pop()
+            if t_near > best_dist[0]:
+                continue
+            left, right = node_children[node]
+            if left >= 0:
+                hits = []
+                for child in (left, right):
+                    t_child = slab_test(origin_tuple, inverse, node_low[child], node_high[child])
+                    if t_child is not None:
+                        hits.append((child, t_child))
+                hits.sort(key=lambda hit: -hit[1])
+                stack.extend(hits)
+                continue
+            leaf = slice(node_start[node], node_start[node] + node_count[node])
+            if stats is not None:
+                stats.count_tests(node_count[node])
+            dists = intersect_triangles(origins, directions, self.v0[leaf], self.e1[leaf], self.e2[leaf])
+            nearest_of(dists, self.triangle_ids[leaf], best_dist, best_id)
+
+        if best_id[0] < 0:
+            return None
+        return float(best_dist[0]), int(best_id[0])
+
+
+class Triangle:
+    """
+        The triangle of a mesh a ray hit, it has the material of its mesh and the normal of the
+        triangle, so the renderers can shade it like any other primitive.
+    """
+
+    def __init__(self, mesh: "TriangleMesh", index: int):
+        self.mesh = mesh
+        self.index = index
+
+    def __getattr__(self, name: str):
+        # Material attributes (ambient, diffuse, reflection...) come from the mesh
+        if name == 'mesh':
+            raise AttributeError(name)
+        return getattr(self.mesh, name)
+
+    def compute_normal(self, point: np.ndarray = None) -> np.ndarray:
+        return self.mesh.normals[self.index]
+
+
+class TriangleMesh(Object3D):
+    """
+        A triangle mesh with a single material. vertices is a (V, 3) array and faces a (T, 3)
+        array of vertex indices (counter clockwise seen from the front). The triangles live in
+        the arrays of the mesh BVH, there is no python object per triangle; a hit returns a
+        Triangle for the triangle that was hit.
+    """
+
+    def __init__(self, vertices: np.ndarray, faces: np.ndarray, leaf_size: int = MESH_LEAF_SIZE):
+        self.vertices = vertices
+        self.faces = faces
+        v0 = np.asarray(vertices[faces[:, 0]], dtype=float)
+        e1 = np.asarray(vertices[faces[:, 1]], dtype=float) - v0
+        e2 = np.asarray(vertices[faces[:, 2]], dtype=float) - v0
+        self.normals = normalize_rows(np.cross(e1, e2))
+        self.bvh = MeshBVH(v0, e1, e2, leaf_size)
+        # Where the mesh was loaded from, set by load_mesh (the scene JSON references it)
+        self.source: Optional[str] = None
+        # Modification time (ns) and size of the file, so caches notice when it changes
+        self.file_version: Optional[Tuple[int, int]] = None
+        self.scale = 1.0
+        self.translation = [0.0, 0.0, 0.0]
+
+    def intersect(self, ray: Ray, stats: Optional[RenderStats] = None) -> Optional[Tuple[float, Triangle]]:
+        hit = self.bvh.intersect_ray(ray.origin, ray.direction, stats)
+        if hit is None:
+            return None
+        return hit[0], Triangle(self, hit[1])
+
+    def bounding_box(self) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if not len(self.bvh.node_count):
+            return None
+        return self.bvh.node_low[0], self.bvh.node_high[0]
+
+    def translated(self, offset: np.ndarray) -> "TriangleMesh":
+        moved = copy.copy(self)
+        moved.vertices = self.vertices + offset
+        moved.bvh = self.bvh.translated(offset)
+        moved.translation = (np.asarray(self.translation, dtype=float) + offset).tolist()
+        return moved
+
+
+def inverse_rows(directions: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore'):
+        return 1 / directions
+
+
+def load_obj(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Reads the vertices and faces of a Wavefront OBJ file. Polygons are split into triangle
+        fans, texture coordinates, normals, groups and materials are ignored.
+    """
+    vertices: List[List[float]] = []
+    faces: List[List[int]] = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == 'v':
+                vertices.append([float(x) for x in parts[1:4]])
+            elif parts[0] == 'f':
+                # "f 1/2/3 ..." keeps the vertex index, negative indices count from the end
+                polygon = []
+                for part in parts[1:]:
+                    index = int(part.split('/')[0])
+                    polygon.append(index - 1 if index > 0 else len(vertices) + index)
+                if len(polygon) < 3:
+                    raise ValueError(f"{path}:{line_number}: face with less than 3 vertices")
+                for i in range(1, len(polygon) - 1):
+                    faces.append([polygon[0], polygon[i], polygon[i + 1]])
+
+    vertices = np.array(vertices, dtype=float).reshape(-1, 3)
+    faces = np.array(faces, dtype=np.int64).reshape(-1, 3)
+    if len(faces) and (faces.min() < 0 or faces.max() >= len(vertices)):
+        raise ValueError(f"{path}: face index out of range")
+    return vertices, faces
+
+
+def load_mesh_arrays(path: str, modified: int, size: int, cache: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        The vertices and faces of an OBJ file, modified and size are the ones of its stat. With
+        cache the parsed arrays are saved as .npy files in MESH_CACHE_DIR, named after the path
+        and the version of the file, so the OBJ is only parsed again when it changes.
+    """
+    if not cache:
+        return load_obj(path)
+    name = hashlib.sha256(f"{path}:{modified}:{size}".encode('utf-8')).hexdigest()
+    vertices_path = os.path.join(MESH_CACHE_DIR, f"{name}.vertices.npy")
+    faces_path = os.path.join(MESH_CACHE_DIR, f"{name}.faces.npy")
+    try:
+        return np.load(vertices_path), np.load(faces_path)
+    except (OSError, ValueError):
+        pass
+    vertices, faces = load_obj(path)
+    try:
+        os.makedirs(MESH_CACHE_DIR, exist_ok=True)
+        for array, array_path in ((vertices, vertices_path), (faces, faces_path)):
+            # Written aside and renamed, so other processes never read a partial file
+            partial_path = f"{array_path}.{os.getpid()}.tmp"
+            with open(partial_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(partial_path, array_path)
+    except OSError as e:
+        logging.error(f"Error in load_mesh_arrays: {e}")
+    return vertices, faces
+
+
+def load_mesh(path: str, scale: float = 1.0, translation=(0.0, 0.0, 0.0), cache: bool = True) -> TriangleMesh:
+    """
+        Loads an OBJ file as a TriangleMesh, the vertices are scaled then translated. Loaded
+        meshes are kept (until the file changes) so the parsing and the BVH are only paid once,
+        every call returns its own copy for its material.
+    """
+    stat = os.stat(path)
+    mesh = cached_mesh(os.path.realpath(path), stat.st_mtime_ns, stat.st_size, float(scale),
+                       tuple(float(v) for v in translation), cache)
+    return copy.copy(mesh)
+
+
+@lru_cache(maxsize=8)
+def cached_mesh(path: str, modified: int, size: int, scale: float, translation: Tuple[float, float, float],
+                cache: bool) -> TriangleMesh:
+    vertices, faces = load_mesh_arrays(path, modified, size, cache)
+    if scale != 1 or any(translation):
+        vertices = vertices * scale + np.array(translation)
+    mesh = TriangleMesh(vertices, faces)
+    mesh.scale, mesh.translation = scale, list(translation)
+    mesh.file_version = (modified, size)
+    return mesh
+
+
+def resolve_mesh_path(name: str, mesh_dir: str) -> str:
+    """
+        Path of the mesh file name inside mesh_dir. Scene descriptions come from users and GPT,
+        so names that lead out of mesh_dir are rejected.
+    """
+    root = os.path.realpath(mesh_dir)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Mesh file '{name}' is outside of the mesh directory")
+    return path
@@ -1,7 +1,11 @@
+import copy
 import numpy as np
 from .utils import normalize
 from .ray import Ray
-from typing import Tuple, Union, Optional
+from typing import List, Tuple, Union, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .mesh import TriangleMesh
 
 
 class Object3D:
@@ -32,6 +36,18 @@ class Plane(Object3D):
     def compute_normal(self, hit_point: np.ndarray) -> np.ndarray:
         return self.normal
 
+    def bounding_box(self) -> None:
+        # A plane is unbounded
+        return None
+
+    def translated(self, offset: np.ndarray) -> 'Plane':
+        """
+            A copy of the object (with its material) moved by offset.
+        """
+        moved = copy.copy(self)
+        moved.point = self.point + offset
+        return moved
+
 
 class Rectangle(Object3D):
     """
@@ -68,6 +84,14 @@ class Rectangle(Object3D):
 
         return None
 
+    def bounding_box(self) -> Tuple[np.ndarray, np.ndarray]:
+        return np.min(self.abcd, axis=0), np.max(self.abcd, axis=0)
+
+    def translated(self, offset: np.ndarray) -> 'Rectangle':
+        moved = copy.copy(self)
+        moved.abcd = [v + offset for v in self.abcd]
+        return moved
+
     def check_point_in_rectangle(self, point: np.ndarray) -> bool:
         for i in range(len(self.abcd)):
             v1 = self.abcd[i] - point
@@ -116,6 +140,15 @@ class Cuboid(Object3D):
 
         return closest_intersection
 
+    def bounding_box(self) -> Tuple[np.ndarray, np.ndarray]:
+        corners = [v for rectangle in self.face_list for v in rectangle.abcd]
+        return np.min(corners, axis=0), np.max(corners, axis=0)
+
+    def translated(self, offset: np.ndarray) -> 'Cuboid':
+        moved = copy.copy(self)
+        moved.face_list = [rectangle.translated(offset) for rectangle in self.face_list]
+        return moved
+
 
 class Sphere(Object3D):
     def __init__(self, center: np.ndarray, radius: float):
@@ -139,5 +172,32 @@ class Sphere(Object3D):
     def compute_normal(self, intersection: np.ndarray) -> np.ndarray:
         return normalize(intersection - self.center)
 
+    def bounding_box(self) -> Tuple[np.ndarray, np.ndarray]:
+        center = np.asarray(self.center, dtype=float)
+        return center - self.radius, center + self.radius
+
+    def translated(self, offset: np.ndarray) -> 'Sphere':
+        moved = copy.copy(self)
+        moved.center = np.asarray(self.center, dtype=float) + offset
+        moved.normal = moved.center
+        return moved
+
+
+SceneObject = Union[Sphere, Plane, Cuboid, "TriangleMesh"]
 
-SceneObject = Union[Sphere, Plane, Cuboid]
+# A mesh is a single primitive, its triangles are handled by its own BVH
+Primitive = Union[Sphere, Plane, Rectangle, "TriangleMesh"]
+
+
+def flatten_primitives(objects: List[SceneObject]) -> List[Primitive]:
+    """
+        Cuboids are replaced by their faces (in face_list order) so every entry can be hit on its own,
+        the order of the list keeps the tie breaking of Ray.nearest_intersected_object.
+    """
+    primitives = []
+    for obj in objects:
+        if isinstance(obj, Cuboid):
+            primitives.extend(obj.face_list)
+        else:
+            primitives.append(obj)
+    return primitives
@@ -0,0 +1,64 @@
+import zlib
+import struct
+import numpy as np
+from typing import Tuple
+
+# zlib compression level of encode_png, 0 stores the pixels uncompressed and 9 is the smallest
+DEFAULT_COMPRESSION_LEVEL = 6
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG color types by number of channels: grayscale, RGB, RGBA
+COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+# Row filter of every scanline, Up (the difference with the row above) compresses renders well
+FILTER_UP = 2
+
+
+def to_uint8(image: np.ndarray) -> np.ndarray:
+    """
+        8 bit version of a float image with values in [0, 1], NaNs become 0 and values out of
+        range are clipped. uint8 images are returned as they are.
+    """
+    if image.dtype == np.uint8:
+        return image
+    return np.round(np.clip(np.nan_to_num(image), 0, 1) * 255).astype(np.uint8)
+
+
+def encode_png(image: np.ndarray, compression_level: int = DEFAULT_COMPRESSION_LEVEL) -> bytes:
+    """
+        PNG file of an (H, W), (H, W, 3) or (H, W, 4) image, float images are quantized with
+        to_uint8 once. The scanlines are Up filtered with numpy and compressed with zlib.
+    """
+    pixels = to_uint8(np.asarray(image))
+    if pixels.ndim == 2:
+        pixels = pixels[..., np.newaxis]
+    height, width, channels = pixels.shape
+    if channels not in COLOR_TYPES:
+        raise ValueError(f"Can't encode an image with {channels} channels as PNG")
+
+    rows = pixels.reshape(height, width * channels)
+    scanlines = np.empty((height, width * channels + 1), dtype=np.uint8)
+    scanlines[:, 0] = FILTER_UP
+    scanlines[0, 1:] = rows[0]
+    # uint8 arithmetic wraps around, which is the modulo 256 the filter is defined with
+    np.subtract(rows[1:], rows[:-1], out=scanlines[1:, 1:])
+
+    header = struct.pack('>IIBBBBB', width, height, 8, COLOR_TYPES[channels], 0, 0, 0)
+    return PNG_SIGNATURE + png_chunk(b'IHDR', header) + \
+        png_chunk(b'IDAT', zlib.compress(scanlines.tobytes(), compression_level)) + png_chunk(b'IEND', b'')
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def encode_raw(image: np.ndarray) -> Tuple[bytes, Tuple[int, ...]]:
+    """
+        The to_uint8 pixels of the image as bytes in row major order, without any header or
+        compression, and their shape, for internal consumers (decode_raw reads them back).
+    """
+    pixels = np.ascontiguousarray(to_uint8(np.asarray(image)))
+    return pixels.tobytes(), pixels.shape
+
+
+def decode_raw(data: bytes, shape: Tuple[int, ...]) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.uint8).reshape(shape)
@@ -0,0 +1,48 @@
+import numpy as np
+from typing import Dict
+
+
+class Precision:
+    """
+        Float type of the batched pipeline (camera rays, compiled scene, hit buffers, shading and
+        framebuffer) and the epsilons that go with it. float32 halves the size of every ray and hit
+        array, its epsilons are larger so grazing rays and degenerate triangles are still rejected
+        and box bounds still contain their primitives after rounding.
+    """
+
+    def __init__(self, name: str, surface_offset: float, parallel_epsilon: float,
+                 determinant_epsilon: float, box_padding: float):
+        self.name = name
+        self.dtype = np.dtype(name)
+        # Offset of a hit point along the normal so secondary rays don't hit their own surface
+        self.surface_offset = surface_offset
+        # Rays whose direction is closer than this to parallel with a plane never hit it
+        self.parallel_epsilon = parallel_epsilon
+        # Triangles with a smaller Moller-Trumbore determinant (parallel or degenerate) are missed
+        self.determinant_epsilon = determinant_epsilon
+        # Padding of the mesh BVH boxes
+        self.box_padding = box_padding
+
+    def __repr__(self) -> str:
+        return f"Precision('{self.name}')"
+
+    def __reduce__(self):
+        # Workers get the shared instance back instead of a copy
+        return get_precision, (self.name,)
+
+
+# The float64 epsilons are the ones of the scalar renderer. The surface offset is already far
+# above the float32 resolution at scene scales (~1e-7 relative), so both keep the same image.
+PRECISIONS: Dict[str, Precision] = {
+    'float64': Precision('float64', surface_offset=1e-2, parallel_epsilon=1e-6, determinant_epsilon=1e-12,
+                         box_padding=1e-9),
+    'float32': Precision('float32', surface_offset=1e-2, parallel_epsilon=1e-5, determinant_epsilon=1e-10,
+                         box_padding=1e-5),
+}
+DEFAULT_PRECISION = PRECISIONS['float64']
+
+
+def get_precision(name: str) -> Precision:
+    if name not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{name}', expected one of {list(PRECISIONS)}")
+    return PRECISIONS[name]
@@ -0,0 +1,54 @@
+import numpy as np
+from typing import Callable, Tuple
+
+# Sample positions follow the R2 low discrepancy sequence, g is the plastic number
+_PLASTIC = 1.32471795724474602596
+# After this many samples a pixel whose samples agree stops early
+EARLY_EXIT_SAMPLES = 4
+
+
+def find_edges(image: np.ndarray, object_ids: np.ndarray, contrast_threshold: float) -> np.ndarray:
+    """
+        Marks the pixels that differ from one of their 4 neighbors by more than the contrast
+        threshold (on any color channel) or that hit a different object, both pixels of such a
+        pair are marked.
+    """
+    mask = np.zeros(object_ids.shape, dtype=bool)
+    for axis in (0, 1):
+        first = [slice(None), slice(None)]
+        second = [slice(None), slice(None)]
+        first[axis], second[axis] = slice(None, -1), slice(1, None)
+        first, second = tuple(first), tuple(second)
+        differ = (np.abs(image[first] - image[second]).max(axis=-1) > contrast_threshold) | \
+            (object_ids[first] != object_ids[second])
+        mask[first] |= differ
+        mask[second] |= differ
+    return mask
+
+
+def sample_offsets(count: int) -> np.ndarray:
+    """
+        Returns count (x, y) offsets inside a pixel, in [-0.5, 0.5) of the pixel size,
+        the first one is the center of the pixel.
+    """
+    k = np.arange(count)[:, np.newaxis]
+    alpha = np.array([1 / _PLASTIC, 1 / _PLASTIC ** 2])
+    return (0.5 + k * alpha) % 1 - 0.5
+
+
+def supersample(trace: Callable[[np.ndarray], np.ndarray], pixel: np.ndarray, pixel_size: Tuple[float, float],
+                center_color: np.ndarray, max_samples: int, contrast_threshold: float) -> np.ndarray:
+    """
+        Averages up to max_samples samples spread over the pixel, center_color is the sample that
+        was already traced through its center. When the first samples agree within the contrast
+        threshold the pixel is not really on an edge and the rest are skipped.
+    """
+    offsets = sample_offsets(max_samples)
+    samples = [center_color]
+    for dx, dy in offsets[1:]:
+        sample = pixel + np.array([dx * pixel_size[0], dy * pixel_size[1], 0])
+        samples.append(trace(sample))
+        if len(samples) == EARLY_EXIT_SAMPLES < max_samples and \
+                np.ptp(samples, axis=0).max() <= contrast_threshold:
+            break
+    return np.mean(samples, axis=0)
@@ -3,57 +3,176 @@ from typing import List, Tuple, Optional
 from .lights import Light, SpotLight, PointLight, DirectionalLight
 from .objects import Sphere, Plane, Cuboid, SceneObject
 from .ray import Ray
+from .bvh import BVH
+from .compiled import CompiledScene, compile_scene
+from .instrumentation import RenderStats
+from .light_index import LightIndex
+from .precision import get_precision
 from .utils import normalize, reflected
 
 
 class Scene:
     def __init__(self, camera: np.ndarray, ambient: np.ndarray, lights: List[Light],
-                 objects: List[SceneObject], screen_size: Tuple[int, int] = (256, 256), max_depth: int = 1):
+                 objects: List[SceneObject], screen_size: Tuple[int, int] = (256, 256), max_depth: int = 1,
+                 max_samples: int = 1, contrast_threshold: float = 0.1, min_weight: float = 0.0,
+                 russian_roulette: bool = False, seed: int = 0, precision: str = 'float64',
+                 crop: Optional[Tuple[int, int, int, int]] = None, shadows: bool = True,
+                 light_cutoff: float = 0.0, light_samples: int = 0, stats: Optional[RenderStats] = None):
         self.camera = camera
         self.ambient = ambient
         self.lights = lights
         self.objects = objects
         self.screen_size = screen_size
         self.max_depth = max_depth
+        # Anti-aliasing: pixels on edges get up to max_samples samples (1 turns it off)
+        self.max_samples = max_samples
+        self.contrast_threshold = contrast_threshold
+        # Reflected and refracted rays whose weight (the product of the reflection coefficients
+        # along their path) is below min_weight are not traced. With russian_roulette they are
+        # traced with probability weight / min_weight and their weight raised to min_weight,
+        # which keeps the expected color of the pixel the same.
+        self.min_weight = min_weight
+        self.russian_roulette = russian_roulette
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        # Float type of the batched pipeline and of the framebuffer ('float64' or 'float32'),
+        # the scalar renderers trace every ray in float64 and only store the result in it
+        self.precision = get_precision(precision)
+        # Only the pixels of crop = (x0, y0, x1, y1) are rendered (x1 and y1 excluded), the image
+        # is the (y1 - y0, x1 - x0) window of the full screen_size image. Anti-aliasing only
+        # compares pixels inside the window, so edges on its border can be sampled differently.
+        check_crop(screen_size, crop)
+        self.crop = None if crop is None else tuple(int(v) for v in crop)
+        # Without shadows every light reaches every point and no shadow ray is cast
+        self.shadows = shadows
+        # Lights that add less than light_cutoff to a point are skipped there, with light_samples
+        # only that many lights are drawn per point (see LightIndex), 0 turns them off
+        self.light_cutoff = light_cutoff
+        self.light_samples = light_samples
+        self.light_index = LightIndex(lights, light_cutoff, light_samples) if light_cutoff or light_samples else None
+        self.bvh = BVH(objects)
+        self.compiled: Optional[CompiledScene] = None
+        # Rays, intersection tests and hits are counted here when it is set
+        self.stats = stats
+
+    @property
+    def window(self) -> Tuple[int, int, int, int]:
+        """
+            The rendered rows and columns, (first row, last row + 1, first column, last column + 1).
+        """
+        if self.crop is None:
+            width, height = self.screen_size
+            return 0, height, 0, width
+        x0, y0, x1, y1 = self.crop
+        return y0, y1, x0, x1
+
+    @property
+    def window_size(self) -> Tuple[int, int]:
+        """
+            (width, height) of the rendered image.
+        """
+        i0, i1, j0, j1 = self.window
+        return j1 - j0, i1 - i0
+
+    def nearest_intersected_object(self, ray: Ray) -> Optional[Tuple[float, SceneObject]]:
+        hit = self.nearest_hit(ray)
+        if hit is None:
+            return None
+        return hit[0], hit[1]
+
+    def compile(self) -> CompiledScene:
+        """
+            Packs the geometry and materials into arrays for the batched renderers, the result is
+            kept so later calls are free.
+        """
+        if self.compiled is None:
+            self.compiled = compile_scene(self)
+        return self.compiled
+
+    def occluded(self, ray: Ray, max_distance: float) -> bool:
+        return self.bvh.occluded(ray, max_distance, self.stats)
+
+    def nearest_hit(self, ray: Ray) -> Optional[Tuple[float, SceneObject, int]]:
+        hit = self.bvh.nearest_hit(ray, self.stats)
+        if hit is not None and self.stats is not None:
+            self.stats.count_hits(type(hit[1]).__name__.lower())
+        return hit
 
 
 def get_color(scene: Scene, ray: Ray, hit_point: np.ndarray, hit_object: SceneObject, level: int,
               max_level: int = 1) -> np.ndarray:
-    color = calc_ambient_color(scene, hit_object)
-
-    for light in scene.lights:
-        sj = get_shading_factor(light, hit_point, scene.objects)
-        diffuse = calc_diffuse_color(hit_point, hit_object, light)
-        specular = calc_specular_color(scene, hit_point, hit_object, light)
-        color = np.add(color, sj * (diffuse + specular))
-
-    level = level + 1
-    if level > max_level:
-        return color
-
-    r_ray: Ray = Ray(hit_point, reflected(
-        ray.direction, hit_object.compute_normal(hit_point)))
-    intersection = r_ray.nearest_intersected_object(scene.objects)
-    if intersection:
-        dist, obj_hit = intersection
-        r_hit = calc_point(dist, r_ray, obj_hit)
-        color += hit_object.reflection * \
-            get_color(scene, r_ray, r_hit, obj_hit, level, max_level)
-
-    if hit_object.refractive_index > 0:
-        refracted_dir = refracted(hit_object, ray, hit_point)
-        if refracted_dir is not None and len(refracted_dir):
-            t_ray: Ray = Ray(hit_point, refracted_dir)
-            intersection = t_ray.nearest_intersected_object(scene.objects)
+    """
+        Evaluates the ray tree of the hit iteratively, every pending hit carries the weight its
+        color is added to the result with.
+    """
+    color = np.zeros(3)
+    pending = [(ray, hit_point, hit_object, level, 1.0)]
+
+    while pending:
+        ray, hit_point, hit_object, level, weight = pending.pop()
+        local_color = calc_ambient_color(scene, hit_object)
+
+        for light, light_weight in shaded_lights(scene, hit_point):
+            sj = get_shading_factor(light, hit_point, scene, level - 1)
+            diffuse = calc_diffuse_color(hit_point, hit_object, light)
+            specular = calc_specular_color(scene, hit_point, hit_object, light)
+            local_color = np.add(local_color, light_weight * sj * (diffuse + specular))
+
+        color = color + weight * local_color
+
+        level = level + 1
+        if level > max_level:
+            continue
+
+        r_weight = secondary_weight(scene, weight * hit_object.reflection)
+        if r_weight is not None:
+            r_ray: Ray = Ray(hit_point, reflected(
+                ray.direction, hit_object.compute_normal(hit_point)))
+            if scene.stats is not None:
+                scene.stats.count_rays('reflection', level - 1)
+            intersection = scene.nearest_intersected_object(r_ray)
             if intersection:
                 dist, obj_hit = intersection
-                t_hit = calc_point(dist, t_ray, obj_hit)
-                color += get_color(scene, t_ray, t_hit,
-                                   obj_hit, level, max_level)
+                r_hit = calc_point(dist, r_ray, obj_hit)
+                pending.append((r_ray, r_hit, obj_hit, level, r_weight))
+
+        t_weight = secondary_weight(scene, weight) if hit_object.refractive_index > 0 else None
+        if t_weight is not None:
+            refracted_dir = refracted(hit_object, ray, hit_point)
+            if refracted_dir is not None and len(refracted_dir):
+                t_ray: Ray = Ray(hit_point, refracted_dir)
+                if scene.stats is not None:
+                    scene.stats.count_rays('refraction', level - 1)
+                intersection = scene.nearest_intersected_object(t_ray)
+                if intersection:
+                    dist, obj_hit = intersection
+                    t_hit = calc_point(dist, t_ray, obj_hit)
+                    pending.append((t_ray, t_hit, obj_hit, level, t_weight))
 
     return color
 
 
+def shaded_lights(scene: Scene, hit_point: np.ndarray) -> List[Tuple[Light, float]]:
+    """
+        The lights that are shaded at hit_point and their weights, every light with weight 1
+        unless the scene culls or samples its lights.
+    """
+    if scene.light_index is None:
+        return [(light, 1) for light in scene.lights]
+    return scene.light_index.select(hit_point, scene.rng)
+
+
+def secondary_weight(scene: Scene, weight: float) -> Optional[float]:
+    """
+        Returns the weight a secondary ray is traced with, or None when it is pruned.
+    """
+    if weight >= scene.min_weight:
+        return weight
+    if scene.russian_roulette and weight > 0 and scene.rng.random() < weight / scene.min_weight:
+        return scene.min_weight
+    return None
+
+
 def calc_ambient_color(scene: Scene, hit_object: SceneObject) -> np.ndarray:
     return hit_object.ambient * scene.ambient
 
@@ -81,15 +200,33 @@ def calc_point(dist: float, ray: Ray, hit_object: SceneObject) -> np.ndarray:
     return point + hit_object.compute_normal(point) * 1e-2
 
 
-def get_shading_factor(light: Light, hit_point: np.ndarray, objects: List[SceneObject]) -> float:
+def get_shading_factor(light: Light, hit_point: np.ndarray, scene: Scene, depth: int = 0) -> float:
+    """
+        depth is the number of bounces of the ray that hit hit_point, only used by the stats.
+    """
+    if not scene.shadows:
+        return 1
     light_ray = light.get_light_ray(hit_point)
-    is_object_blocked = light_ray.nearest_intersected_object(objects)
+    if scene.stats is not None:
+        scene.stats.count_rays('shadow', depth)
     distance_to_light = light.get_distance_from_light(hit_point)
-    if is_object_blocked and is_object_blocked[0] < distance_to_light:
+    # Any object between the point and the light blocks it, no need to find the nearest one
+    if scene.occluded(light_ray, distance_to_light):
         return 0
     return 1
 
 
+def check_crop(screen_size: Tuple[int, int], crop: Optional[Tuple[int, int, int, int]]):
+    if crop is None:
+        return
+    if len(crop) != 4:
+        raise ValueError(f"crop must be [x0, y0, x1, y1], got {list(crop)}")
+    width, height = screen_size
+    x0, y0, x1, y1 = crop
+    if not (0 <= x0 < x1 <= width and 0 <= y0 < y1 <= height):
+        raise ValueError(f"crop {list(crop)} is not a non empty window of the {width}x{height} image")
+
+
 def refracted(hit_object: SceneObject, ray: Ray, intersection: np.ndarray) -> Optional[np.ndarray]:
     n1 = 1.0
     n2 = hit_object.refractive_index
@@ -0,0 +1,125 @@
+import numpy as np
+import logging
+from typing import Tuple, List
+from .lights import Light, DirectionalLight, PointLight, SpotLight
+from .mesh import TriangleMesh, load_mesh, resolve_mesh_path
+from .objects import SceneObject, Sphere, Plane, Rectangle, Cuboid
+
+# Directory the mesh files referenced by scenes are loaded from
+MESH_DIR = 'meshes'
+
+
+def parse_scene_data(scene_data: dict,
+                     mesh_dir: str = MESH_DIR) -> Tuple[np.ndarray, np.ndarray, List[Light], List[SceneObject]]:
+    """
+        A mesh entry references an OBJ file by its name inside mesh_dir:
+        {"type": "mesh", "file": "bunny.obj", "scale": 1, "translation": [0, 0, -2], <material>}
+    """
+    try:
+        camera = np.array(scene_data['camera'])
+        ambient = np.array(scene_data['ambient'])
+        lights = []
+        for light_data in scene_data['lights']:
+            if light_data['type'] == 'directional':
+                lights.append(DirectionalLight(
+                    np.array(light_data['intensity']), np.array(light_data['direction'])))
+            elif light_data['type'] == 'point':
+                lights.append(PointLight(np.array(light_data['intensity']), np.array(
+                    light_data['position']), light_data['kc'], light_data['kl'], light_data['kq']))
+            elif light_data['type'] == 'spot':
+                lights.append(SpotLight(np.array(light_data['intensity']), np.array(light_data['position']), np.array(
+                    light_data['direction']), light_data['kc'], light_data['kl'], light_data['kq']))
+
+        objects = []
+        for obj_data in scene_data['objects']:
+            if obj_data['type'] == 'sphere':
+                obj = Sphere(np.array(obj_data['center']), obj_data['radius'])
+            elif obj_data['type'] == 'plane':
+                obj = Plane(np.array(obj_data['normal']),
+                            np.array(obj_data['point']))
+            elif obj_data['type'] == 'rectangle':
+                obj = Rectangle(np.array(obj_data['a']), np.array(
+                    obj_data['b']), np.array(obj_data['c']), np.array(obj_data['d']))
+            elif obj_data['type'] == 'cuboid':
+                obj = Cuboid(np.array(obj_data['a']), np.array(obj_data['b']), np.array(
+                    obj_data['c']), np.array(obj_data['d']), np.array(obj_data['e']), np.array(obj_data['f']))
+            elif obj_data['type'] == 'mesh':
+                obj = load_mesh(resolve_mesh_path(obj_data['file'], mesh_dir), obj_data.get('scale', 1),
+                                obj_data.get('translation', [0, 0, 0]))
+                obj.source = obj_data['file']
+            else:
+                raise ValueError(f"Unknown object type '{obj_data['type']}'")
+            obj.set_material(np.array(obj_data['ambient']), np.array(obj_data['diffuse']), np.array(
+                obj_data['specular']), obj_data['shininess'], obj_data['reflection'], obj_data.get('refractive_index', 0))
+            if obj_data['type'] == 'cuboid':
+                obj.apply_materials_to_faces()
+            objects.append(obj)
+
+        return camera, ambient, lights, objects
+    except Exception as e:
+        logging.error(f"Error in parse_scene_data: {e}")
+        raise
+
+
+def serialize_scene_data(camera: np.ndarray, ambient: np.ndarray, lights: List[Light],
+                         objects: List[SceneObject]) -> dict:
+    """
+        The inverse of parse_scene_data, returns the scene in the JSON format of the prompt
+        with plain python numbers so it can be dumped with json.dumps.
+    """
+    return {
+        'camera': to_list(camera),
+        'ambient': to_list(ambient),
+        'lights': [serialize_light(light) for light in lights],
+        'objects': [serialize_object(obj) for obj in objects],
+    }
+
+
+def serialize_light(light: Light) -> dict:
+    if isinstance(light, DirectionalLight):
+        return {'type': 'directional', 'intensity': to_list(light.intensity), 'direction': to_list(light.direction)}
+    light_data = {'intensity': to_list(light.intensity), 'position': to_list(light.position),
+                  'kc': float(light.kc), 'kl': float(light.kl), 'kq': float(light.kq)}
+    if isinstance(light, SpotLight):
+        light_data.update({'type': 'spot', 'direction': to_list(light.direction)})
+    else:
+        light_data['type'] = 'point'
+    return light_data
+
+
+def serialize_object(obj: SceneObject) -> dict:
+    if isinstance(obj, Sphere):
+        obj_data = {'type': 'sphere', 'center': to_list(obj.center), 'radius': float(obj.radius)}
+    elif isinstance(obj, Plane):
+        obj_data = {'type': 'plane', 'normal': to_list(obj.normal), 'point': to_list(obj.point)}
+    elif isinstance(obj, Rectangle):
+        a, b, c, d = obj.abcd
+        obj_data = {'type': 'rectangle', 'a': to_list(a), 'b': to_list(b), 'c': to_list(c), 'd': to_list(d)}
+    elif isinstance(obj, Cuboid):
+        # Face A is (a, b, c, d) and face B is (d, c, e, f)
+        a, b, c, d = obj.face_list[0].abcd
+        e, f = obj.face_list[1].abcd[2:]
+        obj_data = {'type': 'cuboid', 'a': to_list(a), 'b': to_list(b), 'c': to_list(c),
+                    'd': to_list(d), 'e': to_list(e), 'f': to_list(f)}
+    elif isinstance(obj, TriangleMesh):
+        if obj.source is None:
+            raise ValueError("Can't serialize a mesh that was not loaded from a file")
+        obj_data = {'type': 'mesh', 'file': obj.source, 'scale': float(obj.scale),
+                    'translation': to_list(obj.translation)}
+    else:
+        raise ValueError(f"Can't serialize object of type {type(obj).__name__}")
+
+    if hasattr(obj, 'ambient'):
+        obj_data.update({
+            'ambient': to_list(obj.ambient),
+            'diffuse': to_list(obj.diffuse),
+            'specular': to_list(obj.specular),
+            'shininess': float(obj.shininess),
+            'reflection': float(obj.reflection),
+            'refractive_index': float(obj.refractive_index),
+        })
+    return obj_data
+
+
+def to_list(vector) -> list:
+    return np.asarray(vector, dtype=float).tolist()
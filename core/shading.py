@@ -0,0 +1,87 @@
+import numpy as np
+from typing import List, Optional
+from .compiled import CompiledScene
+from .instrumentation import RenderStats
+from .lights import Light
+from .utils import dot_rows, normalize_rows
+
+
+def shadow_factors(compiled: CompiledScene, lights: List[Light], points: np.ndarray,
+                   stats: Optional[RenderStats] = None, selected: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+        Batched get_shading_factor, returns an (N, L) array that is 0 where points[k] is in the
+        shadow of lights[l] and 1 where it is lit. All the (point, light) pairs are tested at once
+        with an any hit query. With an (N, L) selected mask only its pairs are tested, the others
+        are 0.
+    """
+    count = len(points)
+    if count == 0 or not lights:
+        return np.ones((count, len(lights)), dtype=points.dtype)
+    if selected is None:
+        origins = np.repeat(points[np.newaxis], len(lights), axis=0).reshape(-1, 3)
+        directions = np.concatenate([light.get_light_directions(points) for light in lights])
+        distances = np.concatenate([light.get_distances_from_light(points) for light in lights])
+        blocked = compiled.occluded(origins, directions, distances, stats)
+        return 1 - blocked.reshape(len(lights), count).T.astype(points.dtype)
+
+    rows = [np.flatnonzero(selected[:, l]) for l in range(len(lights))]
+    origins = np.concatenate([points[light_rows] for light_rows in rows])
+    directions = np.concatenate([light.get_light_directions(points[light_rows])
+                                 for light, light_rows in zip(lights, rows)])
+    distances = np.concatenate([light.get_distances_from_light(points[light_rows])
+                                for light, light_rows in zip(lights, rows)])
+    lit = 1 - compiled.occluded(origins, directions, distances, stats).astype(points.dtype)
+    factors = np.zeros((count, len(lights)), dtype=points.dtype)
+    start = 0
+    for l, light_rows in enumerate(rows):
+        factors[light_rows, l] = lit[start:start + len(light_rows)]
+        start += len(light_rows)
+    return factors
+
+
+def shade(compiled: CompiledScene, lights: List[Light], points: np.ndarray, normals: np.ndarray,
+          object_ids: np.ndarray, shadows: np.ndarray, selected: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+        Batched local Phong color of get_color (ambient + diffuse + specular of every light),
+        points[k] is a hit point on object object_ids[k] with normals[k] and shadows is the
+        (N, L) array of shadow_factors (times the light weights). The view direction is from the
+        point to the camera for every ray, the same as calc_specular_color. With an (N, L)
+        selected mask only its pairs are shaded, the lights culled at a point add nothing.
+    """
+    color = compiled.material_ambient[object_ids] * compiled.ambient
+    if not lights:
+        return color
+
+    diffuse = compiled.material_diffuse[object_ids]
+    specular = compiled.material_specular[object_ids]
+    exponents = compiled.material_shininess[object_ids] / 10
+    view_directions = normalize_rows(compiled.camera - points)
+
+    # Shadowed lights are still computed, like get_color does 0 * (diffuse + specular)
+    with np.errstate(invalid='ignore'):
+        for l, light in enumerate(lights):
+            if selected is None:
+                color += shadows[:, l, np.newaxis] * light_color(
+                    light, points, normals, view_directions, diffuse, specular, exponents)
+                continue
+            rows = np.flatnonzero(selected[:, l])
+            color[rows] += shadows[rows, l, np.newaxis] * light_color(
+                light, points[rows], normals[rows], view_directions[rows], diffuse[rows], specular[rows],
+                exponents[rows])
+    return color
+
+
+def light_color(light: Light, points: np.ndarray, normals: np.ndarray, view_directions: np.ndarray,
+                diffuse: np.ndarray, specular: np.ndarray, exponents: np.ndarray) -> np.ndarray:
+    """
+        Diffuse + specular color of one light at every point, before shadows.
+    """
+    light_directions = light.get_light_directions(points)
+    intensities = light.get_intensities(points)
+
+    cos_diffuse = dot_rows(normals, light_directions)
+    reflection_directions = normalize_rows(
+        -light_directions + 2 * cos_diffuse[:, np.newaxis] * normals)
+    specular_intensity = dot_rows(view_directions, reflection_directions) ** exponents
+
+    return intensities * (diffuse * cos_diffuse[:, np.newaxis] + specular * specular_intensity[:, np.newaxis])
@@ -10,6 +10,20 @@ def normalize(vector: np.ndarray) -> np.ndarray:
     return vector / norm
 
 
+# This function gets two (N, 3) arrays (or an (N, 3) array and a single vector)
+# and returns the dot product of every pair of rows.
+def dot_rows(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.einsum('...j,...j->...', a, b)
+
+
+# This function gets an (N, 3) array of vectors and normalizes every row,
+# rows of length zero are returned as they are (same as normalize).
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.sqrt(dot_rows(vectors, vectors))
+    norms[norms == 0] = 1
+    return vectors / norms[:, np.newaxis]
+
+
 # This function gets a vector and the normal of the surface it hit
 # This function returns the vector that reflects from the surface
 def reflected(vector: np.ndarray, axis: np.ndarray) -> np.ndarray:
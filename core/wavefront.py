@@ -0,0 +1,199 @@
+import numpy as np
+from typing import Optional, Tuple, TYPE_CHECKING
+from .compiled import CompiledScene
+from .precision import Precision
+from .shading import shade, shadow_factors
+from .utils import dot_rows, normalize_rows
+
+if TYPE_CHECKING:
+    from .scene import Scene
+
+
+def generate_camera_rays(camera: np.ndarray, screen_size: Tuple[int, int], dtype=np.float64,
+                         window: Optional[Tuple[int, int, int, int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Returns the pixel positions on the screen (the screen is on the origin) and the normalized
+        directions from the camera to them, both as (height * width, 3) arrays of dtype in row
+        major order. With a window (first row, last row + 1, first column, last column + 1) only
+        the pixels inside it are returned.
+    """
+    width, height = screen_size
+    ratio = float(width) / height
+    screen = (-1, 1 / ratio, 1, -1 / ratio)
+    i0, i1, j0, j1 = (0, height, 0, width) if window is None else window
+
+    ys, xs = np.meshgrid(np.linspace(screen[1], screen[3], height, dtype=dtype)[i0:i1],
+                         np.linspace(screen[0], screen[2], width, dtype=dtype)[j0:j1], indexing='ij')
+    pixels = np.stack([xs.ravel(), ys.ravel(), np.zeros(xs.size, dtype=dtype)], axis=1)
+    directions = normalize_rows(pixels - np.asarray(camera, dtype=dtype))
+    return pixels, directions
+
+
+class GBuffer:
+    """
+        Primary visibility of a set of camera rays: per ray the hit distance (np.inf for a miss),
+        object id and triangle id (-1 for none), hit point (offset along the normal like every hit
+        of trace_rays) and normal (zeros for a miss). It only depends on the camera, the geometry
+        and the rays, so a scene whose lights, ambient or materials changed is shaded again from
+        it without intersecting its camera rays.
+    """
+
+    def __init__(self, dists: np.ndarray, object_ids: np.ndarray, triangle_ids: np.ndarray, points: np.ndarray,
+                 normals: np.ndarray):
+        self.dists = dists
+        self.object_ids = object_ids
+        self.triangle_ids = triangle_ids
+        self.points = points
+        self.normals = normals
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.dists, self.object_ids, self.triangle_ids, self.points,
+                                              self.normals))
+
+
+def primary_gbuffer(scene: "Scene", origins: np.ndarray, directions: np.ndarray) -> GBuffer:
+    """
+        Intersects the camera rays with the scene and returns their GBuffer.
+    """
+    compiled = scene.compile()
+    origins, directions = prepare_rays(compiled.precision, origins, directions)
+    if scene.stats is not None:
+        scene.stats.count_rays('primary', 0, len(directions))
+    dists, object_ids, triangle_ids = compiled.nearest_intersections(origins, directions, scene.stats)
+    points = np.zeros(directions.shape, dtype=compiled.precision.dtype)
+    normals = np.zeros(directions.shape, dtype=compiled.precision.dtype)
+    hit = object_ids >= 0
+    points[hit], normals[hit] = surface_points(compiled, origins[hit], directions[hit], dists[hit],
+                                               object_ids[hit], triangle_ids[hit])
+    return GBuffer(dists, object_ids, triangle_ids, points, normals)
+
+
+def trace_rays(scene: "Scene", origins: np.ndarray, directions: np.ndarray,
+               gbuffer: Optional[GBuffer] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Batched get_color for a set of camera rays, returns their (unclipped) colors and the object
+        id every ray hits first (-1 for a miss).
+        The ray tree is evaluated one generation at a time: all the rays of a level are intersected,
+        shaded and spawn their reflected and refracted rays together. Every ray carries the pixel it
+        belongs to and the weight its color is added with, the product of the reflection
+        coefficients along its path, and rays below scene.min_weight are pruned like in get_color.
+        Everything is computed in the dtype of scene.precision, the rays are converted to it once.
+        The first generation comes from gbuffer when it is given (the primary_gbuffer of the same
+        rays), otherwise it is computed here.
+    """
+    compiled = scene.compile()
+    precision = compiled.precision
+    count = len(directions)
+    if gbuffer is None:
+        gbuffer = primary_gbuffer(scene, origins, directions)
+    colors = np.zeros((count, 3), dtype=precision.dtype)
+    origins, directions = prepare_rays(precision, origins, directions)
+    pixels = np.arange(count)
+    weights = np.ones(count, dtype=precision.dtype)
+    stats = scene.stats
+
+    for level in range(1, scene.max_depth + 1):
+        if level == 1:
+            hit = gbuffer.object_ids >= 0
+            object_ids, triangle_ids = gbuffer.object_ids[hit], gbuffer.triangle_ids[hit]
+            points, normals = gbuffer.points[hit], gbuffer.normals[hit]
+        else:
+            dists, object_ids, triangle_ids = compiled.nearest_intersections(origins, directions, stats)
+            hit = object_ids >= 0
+            object_ids, triangle_ids = object_ids[hit], triangle_ids[hit]
+            points, normals = surface_points(compiled, origins[hit], directions[hit], dists[hit], object_ids,
+                                             triangle_ids)
+        if not hit.any():
+            break
+        directions, pixels, weights = directions[hit], pixels[hit], weights[hit]
+
+        # The (point, light) pairs that are shaded, all of them unless the scene culls its lights
+        light_weights = None if scene.light_index is None else scene.light_index.weights(points, scene.rng)
+        selected = None if light_weights is None else light_weights > 0
+        if not scene.shadows:
+            shadows = np.ones((len(points), len(scene.lights)), dtype=precision.dtype)
+        else:
+            if stats is not None:
+                shadow_rays = len(points) * len(scene.lights) if selected is None else int(selected.sum())
+                stats.count_rays('shadow', level - 1, shadow_rays)
+            shadows = shadow_factors(compiled, scene.lights, points, stats, selected)
+        if light_weights is not None:
+            shadows = shadows * light_weights
+        local = shade(compiled, scene.lights, points, normals, object_ids, shadows, selected)
+        np.add.at(colors, pixels, weights[:, np.newaxis] * local)
+
+        if level == scene.max_depth:
+            break
+
+        reflected_directions = normalize_rows(
+            directions - 2 * dot_rows(directions, normals)[:, np.newaxis] * normals)
+        refractive = compiled.material_refractive_index[object_ids] > 0
+        refracted_directions, refracts = refracted_rows(
+            directions[refractive], normals[refractive], compiled.material_refractive_index[object_ids[refractive]])
+        refracted_from = np.flatnonzero(refractive)[refracts]
+
+        origins = np.concatenate([points, points[refracted_from]])
+        directions = np.concatenate([reflected_directions, refracted_directions[refracts]])
+        pixels = np.concatenate([pixels, pixels[refracted_from]])
+        weights = np.concatenate([weights * compiled.material_reflection[object_ids], weights[refracted_from]])
+
+        traced, weights = secondary_weights(scene, weights)
+        origins, directions, pixels, weights = origins[traced], directions[traced], pixels[traced], weights[traced]
+        if stats is not None:
+            for kind, spawned in (('reflection', traced[:len(points)]), ('refraction', traced[len(points):])):
+                if spawned.any():
+                    stats.count_rays(kind, level, int(spawned.sum()))
+
+    return colors, gbuffer.object_ids
+
+
+def prepare_rays(precision: Precision, origins: np.ndarray, directions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        The rays as (N, 3) arrays of the dtype of precision, with normalized directions like Ray.
+    """
+    directions = normalize_rows(np.asarray(directions, dtype=precision.dtype))
+    return np.broadcast_to(np.asarray(origins, dtype=precision.dtype), directions.shape), directions
+
+
+def surface_points(compiled: CompiledScene, origins: np.ndarray, directions: np.ndarray, dists: np.ndarray,
+                   object_ids: np.ndarray, triangle_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Batched calc_point and compute_normal of the hits of rays, returns the hit points offset
+        along their normal and the normals there.
+    """
+    points = origins + dists[:, np.newaxis] * directions
+    points = points + compiled.compute_normals(object_ids, points, triangle_ids) * compiled.precision.surface_offset
+    return points, compiled.compute_normals(object_ids, points, triangle_ids)
+
+
+def secondary_weights(scene: "Scene", weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Batched secondary_weight, returns the mask of the rays that are traced and their weights.
+    """
+    traced = weights >= scene.min_weight
+    if scene.russian_roulette and not traced.all():
+        candidates = ~traced & (weights > 0)
+        survive = candidates & (scene.rng.random(len(weights)) < weights / scene.min_weight)
+        weights = np.where(survive, scene.min_weight, weights)
+        traced |= survive
+    return traced, weights
+
+
+def refracted_rows(directions: np.ndarray, normals: np.ndarray,
+                   refractive_indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Batched refracted, returns the refracted directions and a mask that is False where
+        refracted returns None (total internal reflection).
+    """
+    n1 = 1.0
+    n2 = refractive_indices
+    incident = normalize_rows(directions)
+    with np.errstate(invalid='ignore'):
+        cos_theta1 = -dot_rows(normals, incident)
+        sin_theta1 = np.sqrt(1 - cos_theta1 ** 2)
+        refracts = ~(sin_theta1 > n2 / n1)
+        cos_theta2 = np.sqrt(1 - (n1 / n2) ** 2 * (1 - cos_theta1 ** 2))
+        refraction = (n1 / n2)[:, np.newaxis] * incident + \
+            (n1 / n2 * cos_theta1 - cos_theta2)[:, np.newaxis] * normals
+    return normalize_rows(refraction), refracts
@@ -0,0 +1,397 @@
+import os
+import json
+import time
+import uuid
+import queue
+import select
+import socket
+import struct
+import logging
+import argparse
+import threading
+import numpy as np
+from multiprocessing import Process
+from typing import Dict, Iterator, List, Optional, Tuple
+from core.instrumentation import RenderStats
+from core.lights import Light
+from core.objects import SceneObject
+from core.scene import Scene
+from core.serialization import MESH_DIR, parse_scene_data, serialize_scene_data
+from renders import Tile, antialias_tasks, antialias_tile_pixels, split_tiles, trace_tile
+
+# Every message is a (header length, payload length) prefix, a JSON header and a binary payload
+PREFIX = struct.Struct('>II')
+
+# Keyword arguments of Scene that are sent to the workers with the scene
+SCENE_SETTINGS = ('max_samples', 'contrast_threshold', 'min_weight', 'russian_roulette', 'seed', 'crop', 'shadows',
+                  'light_cutoff', 'light_samples')
+
+
+def send_message(sock: socket.socket, header: dict, payload: bytes = b''):
+    data = json.dumps(header).encode()
+    sock.sendall(PREFIX.pack(len(data), len(payload)) + data + payload)
+
+
+def recv_message(sock: socket.socket) -> Tuple[dict, bytes]:
+    header_size, payload_size = PREFIX.unpack(recv_exactly(sock, PREFIX.size))
+    return json.loads(recv_exactly(sock, header_size)), recv_exactly(sock, payload_size)
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def scene_message(scene: Scene, render_id: str) -> dict:
+    """
+        The scene in the JSON format of parse_scene_data with its render settings, meshes are
+        sent by file name and loaded by the workers from their own mesh directory.
+    """
+    settings = {name: getattr(scene, name) for name in SCENE_SETTINGS}
+    return {
+        'type': 'scene',
+        'render': render_id,
+        'scene': serialize_scene_data(scene.camera, scene.ambient, scene.lights, scene.objects),
+        'screen_size': list(scene.screen_size),
+        'max_depth': scene.max_depth,
+        'settings': {**settings, 'precision': scene.precision.name},
+        'stats': scene.stats is not None,
+    }
+
+
+class TileRender:
+    def __init__(self, scene: Scene):
+        self.id = uuid.uuid4().hex
+        self.scene = scene
+        self.message = scene_message(scene, self.id)
+        # (task, result header, payload) of every finished or failed task
+        self.results: "queue.Queue[Tuple[TileTask, dict, bytes]]" = queue.Queue()
+        # Tasks of a closed render are dropped instead of being sent to a worker
+        self.closed = False
+
+
+class TileTask:
+    """
+        A tile to render ('render') or the edge pixels of a tile to supersample ('antialias'),
+        the latter with the colors of their first pass.
+    """
+
+    def __init__(self, render: TileRender, kind: str, tile: Tile, pixels: Optional[np.ndarray] = None,
+                 colors: Optional[np.ndarray] = None):
+        self.render = render
+        self.kind = kind
+        self.tile = tile
+        self.pixels = pixels
+        self.colors = colors
+        self.attempts = 0
+
+    def message(self) -> Tuple[dict, bytes]:
+        header = {'type': self.kind, 'render': self.render.id, 'tile': [int(v) for v in self.tile]}
+        if self.kind == 'render':
+            return header, b''
+        header['count'] = len(self.pixels)
+        return header, self.pixels.astype(np.int64).tobytes() + self.colors.tobytes()
+
+
+class TileCoordinator:
+    """
+        Serves the tiles of renders to workers that connect over TCP (run_worker). Every worker
+        gets the serialized scene once per render, then pulls one tile at a time and sends its
+        pixels back, so expensive regions are spread over the farm like over the process pool of
+        fast_render_scene, and the image is the same. Workers send a heartbeat every
+        heartbeat_interval seconds; a worker that is silent for heartbeat_timeout seconds or
+        whose connection drops is dropped and its tile is queued again, a tile that is lost
+        max_attempts times fails the render.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, heartbeat_interval: float = 1.0,
+                 heartbeat_timeout: float = 5.0, max_attempts: int = 3):
+        self.server = socket.create_server((host, port))
+        # The accept loop checks for close() this often
+        self.server.settimeout(heartbeat_interval)
+        self.address: Tuple[str, int] = self.server.getsockname()[:2]
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.tasks: "queue.Queue[TileTask]" = queue.Queue()
+        # Finished tasks by connected worker name
+        self.workers: Dict[str, int] = {}
+        self.retried = 0
+        self.lost_workers = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        threading.Thread(target=self._accept, daemon=True, name='tile-coordinator').start()
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn: socket.socket):
+        """
+            Sends tasks to one worker until it disconnects or the coordinator is closed.
+        """
+        name, task = None, None
+        try:
+            # Reads time out when the worker misses its heartbeats
+            conn.settimeout(self.heartbeat_timeout)
+            hello, _ = recv_message(conn)
+            name = f"{hello['name']}@{conn.getpeername()[0]}"
+            with self.lock:
+                self.workers[name] = 0
+            logging.info(f"Tile worker {name} connected")
+            current_render = None
+            last_seen = time.monotonic()
+            while not self.closed:
+                try:
+                    task = self.tasks.get(timeout=self.heartbeat_interval)
+                except queue.Empty:
+                    last_seen = self._read_heartbeats(conn, last_seen)
+                    continue
+                if task.render.closed:
+                    task = None
+                    continue
+                if task.render.id != current_render:
+                    send_message(conn, task.render.message)
+                    current_render = task.render.id
+                send_message(conn, *task.message())
+                header, payload = recv_message(conn)
+                while header['type'] == 'heartbeat':
+                    header, payload = recv_message(conn)
+                last_seen = time.monotonic()
+                task.render.results.put((task, header, payload))
+                task = None
+                with self.lock:
+                    self.workers[name] += 1
+        except (OSError, ValueError) as e:
+            logging.error(f"Error in tile worker {name}: {e}")
+            if task is not None:
+                self.retry(task)
+        finally:
+            conn.close()
+            with self.lock:
+                if name in self.workers:
+                    del self.workers[name]
+                    self.lost_workers += not self.closed
+
+    def _read_heartbeats(self, conn: socket.socket, last_seen: float) -> float:
+        """
+            Reads the heartbeats an idle worker sent, raises when it stopped sending them.
+        """
+        while select.select([conn], [], [], 0)[0]:
+            recv_message(conn)
+            last_seen = time.monotonic()
+        if time.monotonic() - last_seen > self.heartbeat_timeout:
+            raise TimeoutError(f"No heartbeat for {self.heartbeat_timeout}s")
+        return last_seen
+
+    def retry(self, task: TileTask):
+        task.attempts += 1
+        with self.lock:
+            self.retried += 1
+        if task.attempts >= self.max_attempts:
+            task.render.results.put((task, {'type': 'error', 'error': f"lost {task.attempts} times"}, b''))
+        else:
+            self.tasks.put(task)
+
+    def _results(self, render: TileRender, count: int) -> Iterator[Tuple[TileTask, bytes]]:
+        """
+            Waits for count results of the render, fails when a task failed or when no worker is
+            connected for heartbeat_timeout seconds.
+        """
+        idle_since = time.monotonic()
+        for _ in range(count):
+            while True:
+                try:
+                    task, header, payload = render.results.get(timeout=self.heartbeat_interval)
+                    break
+                except queue.Empty:
+                    if self.workers:
+                        idle_since = time.monotonic()
+                    elif time.monotonic() - idle_since > self.heartbeat_timeout:
+                        raise RuntimeError("No tile workers are connected")
+            if header['type'] == 'error':
+                raise RuntimeError(f"Tile {list(task.tile)} failed: {header['error']}")
+            if header['stats'] is not None and render.scene.stats is not None:
+                render.scene.stats.merge(RenderStats.from_dict(header['stats']))
+            yield task, payload
+
+    def iter_render_tiles(self, scene: Scene, tile_size: int = 16) -> Iterator[Tuple[Tile, np.ndarray]]:
+        """
+            renders.iter_render_tiles on the workers: yields every tile as soon as it is back,
+            together with the framebuffer colors it was written into, and the tiles with edges
+            a second time once they are supersampled. Closing the generator early drops the
+            tiles that were not sent yet.
+        """
+        render = TileRender(scene)
+        tiles = split_tiles(scene.window_size, tile_size)
+        width, height = scene.window_size
+        dtype = scene.precision.dtype
+        colors = np.zeros((height, width, 3), dtype=dtype)
+        object_ids = np.full((height, width), -1, dtype=np.int64)
+
+        try:
+            for tile in tiles:
+                self.tasks.put(TileTask(render, 'render', tile))
+            for task, payload in self._results(render, len(tiles)):
+                i0, i1, j0, j1 = task.tile
+                shape = (i1 - i0, j1 - j0)
+                colors_size = shape[0] * shape[1] * 3
+                colors[i0:i1, j0:j1] = np.frombuffer(payload, dtype, colors_size).reshape(shape + (3,))
+                object_ids[i0:i1, j0:j1] = np.frombuffer(payload, np.int64, offset=colors_size * dtype.itemsize
+                                                         ).reshape(shape)
+                yield task.tile, colors
+
+            if scene.max_samples > 1:
+                tasks = [TileTask(render, 'antialias', tile, pixels, colors[pixels[:, 0], pixels[:, 1]])
+                         for tile, pixels in antialias_tasks(scene, tiles, colors, object_ids)]
+                for task in tasks:
+                    self.tasks.put(task)
+                for task, payload in self._results(render, len(tasks)):
+                    colors[task.pixels[:, 0], task.pixels[:, 1]] = np.frombuffer(payload, dtype).reshape(-1, 3)
+                    yield task.tile, colors
+        finally:
+            render.closed = True
+
+    def render_scene(self, camera: np.ndarray, ambient: np.ndarray, lights: List[Light],
+                     objects: List[SceneObject], screen_size: Tuple[int, int], max_depth: int,
+                     tile_size: int = 16, **options) -> np.ndarray:
+        """
+            fast_render_scene on the workers.
+        """
+        scene = Scene(camera, ambient, lights, objects, screen_size, max_depth, **options)
+        width, height = scene.window_size
+
+        image = np.zeros((height, width, 3), dtype=scene.precision.dtype)
+        for (i0, i1, j0, j1), colors in self.iter_render_tiles(scene, tile_size):
+            image[i0:i1, j0:j1] = colors[i0:i1, j0:j1]
+
+        return image
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'address': f"{self.address[0]}:{self.address[1]}",
+                'workers': dict(self.workers),
+                'queued': self.tasks.qsize(),
+                'retried': self.retried,
+                'lost_workers': self.lost_workers,
+            }
+
+    def close(self):
+        self.closed = True
+        self.server.close()
+
+
+def load_worker_scene(message: dict, mesh_dir: str) -> Scene:
+    camera, ambient, lights, objects = parse_scene_data(message['scene'], mesh_dir)
+    return Scene(camera, ambient, lights, objects, tuple(message['screen_size']), message['max_depth'],
+                 stats=RenderStats() if message['stats'] else None, **message['settings'])
+
+
+def run_task(scene: Scene, header: dict, payload: bytes) -> Tuple[dict, bytes]:
+    """
+        Renders a task of the coordinator, returns the result message.
+    """
+    tile = tuple(header['tile'])
+    if scene.stats is not None:
+        scene.stats = RenderStats()
+    if header['type'] == 'render':
+        colors, object_ids = trace_tile(scene, tile)
+        payload = colors.tobytes() + object_ids.tobytes()
+    elif header['type'] == 'antialias':
+        count = header['count']
+        pixels = np.frombuffer(payload, np.int64, count * 2).reshape(count, 2)
+        colors = np.frombuffer(payload, scene.precision.dtype, offset=pixels.nbytes).reshape(count, 3)
+        payload = antialias_tile_pixels(scene, tile, pixels, colors).tobytes()
+    else:
+        raise ValueError(f"Unknown task '{header['type']}'")
+    return {'type': 'result', 'stats': None if scene.stats is None else scene.stats.to_dict()}, payload
+
+
+def run_worker(host: str, port: int, mesh_dir: str = MESH_DIR, heartbeat_interval: float = 1.0):
+    """
+        Connects to a TileCoordinator and renders the tasks it sends until the connection is
+        closed. A heartbeat is sent every heartbeat_interval seconds from a separate thread, also
+        while a tile is being rendered. Errors are sent back and fail the render.
+    """
+    sock = socket.create_connection((host, port))
+    send_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def send(header: dict, payload: bytes = b''):
+        with send_lock:
+            send_message(sock, header, payload)
+
+    def heartbeat():
+        while not stopped.wait(heartbeat_interval):
+            try:
+                send({'type': 'heartbeat'})
+            except OSError:
+                return
+
+    threading.Thread(target=heartbeat, daemon=True, name='tile-worker-heartbeat').start()
+    scene: Optional[Scene] = None
+    scene_error: Optional[str] = None
+    try:
+        send({'type': 'hello', 'name': f"{socket.gethostname()}:{os.getpid()}"})
+        while True:
+            try:
+                header, payload = recv_message(sock)
+            except ConnectionError:
+                return
+            if header['type'] == 'scene':
+                try:
+                    scene, scene_error = load_worker_scene(header, mesh_dir), None
+                except Exception as e:
+                    scene, scene_error = None, str(e)
+                continue
+            try:
+                if scene is None:
+                    raise ValueError(f"Can't load the scene: {scene_error}")
+                send(*run_task(scene, header, payload))
+            except OSError:
+                # The coordinator closed the connection or dropped this worker
+                return
+            except Exception as e:
+                logging.error(f"Error in run_worker: {e}")
+                send({'type': 'error', 'error': str(e)})
+    finally:
+        stopped.set()
+        sock.close()
+
+
+def start_local_workers(address: Tuple[str, int], count: int, mesh_dir: str = MESH_DIR) -> List[Process]:
+    """
+        Starts count workers as processes of this machine, for testing without a farm.
+    """
+    workers = [Process(target=run_worker, args=(*address, mesh_dir), daemon=True, name=f"tile-worker-{i}")
+               for i in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tile render worker')
+    parser.add_argument('coordinator', help='host:port of the coordinator')
+    parser.add_argument('--mesh-dir', default=MESH_DIR, help='directory the mesh files of the scenes are in')
+    parser.add_argument('--heartbeat-interval', type=float, default=1.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    run_worker(*parse_address(args.coordinator), args.mesh_dir, args.heartbeat_interval)
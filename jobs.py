@@ -0,0 +1,141 @@
+import time
+import uuid
+import queue
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, key: str, render: Callable[[], bytes], priority: int = 0):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.render = render
+        self.priority = priority
+        self.status = 'queued'
+        self.result: Optional[bytes] = None
+        self.error: Optional[str] = None
+        self.submissions = 1
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.done = threading.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'priority': self.priority,
+            'error': self.error,
+            'submissions': self.submissions,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class RenderJobQueue:
+    """
+        A bounded queue of render jobs served by a fixed number of worker threads. A job that is
+        submitted while a job with the same key is still queued or running is coalesced into it,
+        so duplicate scenes are rendered once. Finished jobs are kept (up to max_finished) so
+        their status and result can still be fetched. Queued jobs are served by priority (lower
+        first), in submission order within a priority.
+    """
+
+    def __init__(self, workers: int = 1, max_queued: int = 16, max_finished: int = 256):
+        self.queue: "queue.PriorityQueue[Tuple[int, int, Job]]" = queue.PriorityQueue(maxsize=max_queued)
+        self.sequence = itertools.count()
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.in_flight: Dict[str, Job] = {}
+        self.max_finished = max_finished
+        self.coalesced = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self._work, daemon=True, name=f"render-worker-{i}")
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, key: str, render: Callable[[], bytes], priority: int = 0) -> Job:
+        with self.lock:
+            job = self.in_flight.get(key)
+            if job is not None:
+                job.submissions += 1
+                self.coalesced += 1
+                return job
+            job = Job(key, render, priority)
+            try:
+                self.queue.put_nowait((priority, next(self.sequence), job))
+            except queue.Full:
+                self.rejected += 1
+                raise QueueFull(f"Render queue is full ({self.queue.maxsize} jobs)")
+            self.in_flight[key] = job
+            self.jobs[job.id] = job
+            return job
+
+    def completed(self, key: str, result: bytes) -> Job:
+        """
+            Registers a job that is already done, used when the result came from a cache.
+        """
+        job = Job(key, None)
+        self._finish(job, result, None)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._trim()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self.lock:
+            statuses = [job.status for job in self.jobs.values()]
+            deferred = sum(job.status == 'queued' and job.priority > 0 for job in self.jobs.values())
+            return {
+                'workers': len(self.workers),
+                'queued': statuses.count('queued'),
+                'deferred': deferred,
+                'running': statuses.count('running'),
+                'done': statuses.count('done'),
+                'failed': statuses.count('failed'),
+                'max_queued': self.queue.maxsize,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+            }
+
+    def _work(self):
+        while True:
+            _, _, job = self.queue.get()
+            job.status = 'running'
+            job.started = time.time()
+            try:
+                result, error = job.render(), None
+            except Exception as e:
+                logging.error(f"Error in render job {job.id}: {e}")
+                result, error = None, str(e)
+            with self.lock:
+                self.in_flight.pop(job.key, None)
+                self._finish(job, result, error)
+                self._trim()
+            self.queue.task_done()
+
+    def _finish(self, job: Job, result: Optional[bytes], error: Optional[str]):
+        job.result = result
+        job.error = error
+        job.status = 'failed' if error is not None else 'done'
+        job.finished = time.time()
+        job.render = None
+        job.done.set()
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done.is_set()]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self.jobs[job_id]
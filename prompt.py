@@ -1,3 +1,5 @@
+import hashlib
+
 sceneJSONFormat = """
 {
     "camera": [x, y, z],
@@ -129,3 +131,7 @@ prompt = f"Based on the user abstract description of a 3D scene, generate a JSON
         and in a format for using python json.loads(), \
         meaning no spaces and \. Answer only with a JSON.\n\nScene JSON Format: {sceneJSONFormat}\n\n\
         This is also an example for a scene with a cubid pyramid and a sphere: {scene_example}"
+
+
+# Cached scene descriptions are keyed on this, so editing the prompt invalidates them
+PROMPT_VERSION = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:12]
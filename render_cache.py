@@ -0,0 +1,174 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import numpy as np
+from core.lights import Light
+from core.mesh import TriangleMesh
+from core.objects import SceneObject
+from core.serialization import serialize_object, serialize_scene_data, to_list
+from core.wavefront import GBuffer
+
+# Object fields that only change the shading, not which object a camera ray sees
+MATERIAL_FIELDS = ('ambient', 'diffuse', 'specular', 'shininess', 'reflection', 'refractive_index')
+
+
+def scene_key(camera: np.ndarray, ambient: np.ndarray, lights: List[Light], objects: List[SceneObject],
+              screen_size: Tuple[int, int], max_depth: int, **options) -> str:
+    """
+        Canonical hash of a parsed scene and the render settings. The scene is serialized back to
+        its JSON form with sorted keys so two scenes that parse to the same objects get the same
+        key, whatever the formatting of the JSON they came from. Meshes are referenced by file
+        name there, so the version of their files is added. Any extra render option that changes
+        the image is passed as a keyword argument.
+    """
+    canonical = {
+        'scene': serialize_scene_data(camera, ambient, lights, objects),
+        'mesh_files': mesh_file_versions(objects),
+        'screen_size': [int(v) for v in screen_size],
+        'max_depth': int(max_depth),
+        'options': options,
+    }
+    encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def geometry_key(camera: np.ndarray, objects: List[SceneObject], screen_size: Tuple[int, int],
+                 crop: Optional[Tuple[int, int, int, int]], precision: str) -> str:
+    """
+        Canonical hash of what the primary visibility of a render depends on: the camera, the
+        objects without their materials and the camera rays. Lights, ambient and materials are
+        left out so relighting a scene finds the GBuffer of its previous render.
+    """
+    canonical = {
+        'camera': to_list(camera),
+        'objects': [{name: value for name, value in serialize_object(obj).items() if name not in MATERIAL_FIELDS}
+                    for obj in objects],
+        'mesh_files': mesh_file_versions(objects),
+        'screen_size': [int(v) for v in screen_size],
+        'crop': None if crop is None else [int(v) for v in crop],
+        'precision': precision,
+    }
+    encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def mesh_file_versions(objects: List[SceneObject]) -> list:
+    """
+        Modification time and size of the file of every mesh, a mesh file edited in place gives
+        new keys.
+    """
+    return [list(obj.file_version) for obj in objects
+            if isinstance(obj, TriangleMesh) and obj.file_version is not None]
+
+
+class RenderCache:
+    """
+        Encoded images (PNG bytes) by scene key. The memory tier is an LRU bounded by the total
+        size of the stored images, the optional disk tier keeps every image in cache_dir so it
+        survives restarts and refills the memory tier on a hit.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, cache_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        data = self._read_disk(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        with self.lock:
+            self._store(key, data)
+        self._write_disk(key, data)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'size': self.size,
+                'max_bytes': self.max_bytes,
+            }
+
+    def entry_size(self, data) -> int:
+        return len(data)
+
+    def _store(self, key: str, data: bytes):
+        if key in self.entries:
+            self.size -= self.entry_size(self.entries.pop(key))
+        if self.entry_size(data) > self.max_bytes:
+            return
+        self.entries[key] = data
+        self.size += self.entry_size(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= self.entry_size(evicted)
+            self.evictions += 1
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.error(f"Error in RenderCache._read_disk: {e}")
+            return None
+
+    def _write_disk(self, key: str, data: bytes):
+        if not self.cache_dir:
+            return
+        try:
+            # Written next to the final path and renamed so readers never see a partial file
+            tmp_path = f"{self._disk_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError as e:
+            logging.error(f"Error in RenderCache._write_disk: {e}")
+
+
+class GBufferCache(RenderCache):
+    """
+        GBuffers by geometry_key, an LRU bounded by the total size of their arrays. They are only
+        kept in memory.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        super().__init__(max_bytes)
+
+    def entry_size(self, data: GBuffer) -> int:
+        return data.nbytes
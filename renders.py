@@ -1,82 +1,396 @@
 from core.scene import *
-import matplotlib.pyplot as plt
-from multiprocessing import Pool
+from core.sampling import EARLY_EXIT_SAMPLES, find_edges, sample_offsets, supersample
+from core.instrumentation import RenderStats
+from core.jit import JitScene, jit_supported
+from core.png import encode_png
+from core.utils import normalize_rows
+from core.wavefront import generate_camera_rays, primary_gbuffer, trace_rays
+from render_cache import GBufferCache, geometry_key
+from collections import deque
+from multiprocessing import Pool, shared_memory
+from typing import Callable, Iterator
 
 
-def render_pixel(args: Tuple[int, int, np.ndarray, Tuple[float, float], np.ndarray, List[SceneObject], Scene]) -> Tuple[int, int, np.ndarray]:
-    i, j, pixel, screen, camera, objects, scene = args
+# Tile = (first row, last row + 1, first column, last column + 1)
+Tile = Tuple[int, int, int, int]
+# Framebuffer = (colors (height, width, 3), hit object ids (height, width))
+Framebuffer = Tuple[np.ndarray, np.ndarray]
 
-    origin = camera
+# Each pool worker receives the scene once through init_worker and keeps it here,
+# together with its view of the shared framebuffer the tiles are written into
+_worker_scene: Optional[Scene] = None
+_worker_framebuffer: Optional[Tuple[shared_memory.SharedMemory, Framebuffer]] = None
+
+
+def get_screen(screen_size: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Returns the x coordinates of the pixel columns and the y coordinates of the pixel rows,
+        the screen is on the origin.
+    """
+    width, height = screen_size
+    ratio = float(width) / height
+    screen = (-1, 1 / ratio, 1, -1 / ratio)
+    return np.linspace(screen[0], screen[2], width), np.linspace(screen[1], screen[3], height)
+
+
+def get_window_screen(scene: Scene) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        get_screen of the rendered window of the scene, the pixels of a crop keep the positions
+        they have in the full image.
+    """
+    xs, ys = get_screen(scene.screen_size)
+    i0, i1, j0, j1 = scene.window
+    return xs[j0:j1], ys[i0:i1]
+
+
+def get_pixel_size(xs: np.ndarray, ys: np.ndarray) -> Tuple[float, float]:
+    return (xs[1] - xs[0] if len(xs) > 1 else 0.0), (ys[1] - ys[0] if len(ys) > 1 else 0.0)
+
+
+def trace_pixel(scene: Scene, pixel: np.ndarray) -> Tuple[np.ndarray, int]:
+    """
+        Returns the color of the pixel and the id of the object seen through it (-1 for none).
+    """
+    origin = scene.camera
     direction = normalize(pixel - origin)
     ray = Ray(origin, direction)
     color = np.zeros(3)
+    object_id = -1
+    if scene.stats is not None:
+        scene.stats.count_rays('primary', 0)
 
-    intersection = ray.nearest_intersected_object(objects)
-    if intersection and intersection[1]:
-        dist, hit_object = intersection
+    hit = scene.nearest_hit(ray)
+    if hit:
+        dist, hit_object, object_id = hit
         hit_point = calc_point(dist, ray, hit_object)
         color = get_color(scene, ray, hit_point,
                           hit_object, 1, scene.max_depth)
 
-    return i, j, np.clip(color, 0, 1)
+    # We clip the values between 0 and 1 so all pixel values will make sense.
+    return np.clip(color, 0, 1), object_id
 
 
-def fast_render_scene(camera: np.ndarray, ambient: np.ndarray, lights: List[Light], objects: List[SceneObject],
-                      screen_size: Tuple[int, int], max_depth: int):
+def antialias_pixels(scene: Scene, image: np.ndarray, pixels: np.ndarray):
+    """
+        Replaces the color of every (row, column) in pixels by its supersampled color,
+        image holds the colors of the first pass.
+    """
+    image[pixels[:, 0], pixels[:, 1]] = supersample_pixels(scene, pixels, image[pixels[:, 0], pixels[:, 1]])
+
+
+def supersample_pixels(scene: Scene, pixels: np.ndarray, colors: np.ndarray,
+                       trace: Optional[Callable[[np.ndarray], np.ndarray]] = None) -> np.ndarray:
+    """
+        Supersampled colors of the (row, column) pixels, colors are their colors of the first pass.
+        trace returns the color of a pixel position, trace_pixel by default.
+    """
+    pixel_size = get_pixel_size(*get_screen(scene.screen_size))
+    xs, ys = get_window_screen(scene)
+
+    if trace is None:
+        def trace(pixel: np.ndarray) -> np.ndarray:
+            return trace_pixel(scene, pixel)[0]
+
+    supersampled = np.empty_like(colors)
+    for k, (i, j) in enumerate(pixels):
+        supersampled[k] = supersample(trace, np.array([xs[j], ys[i], 0]), pixel_size, colors[k].copy(),
+                                      scene.max_samples, scene.contrast_threshold)
+    return supersampled
+
+
+def split_tiles(screen_size: Tuple[int, int], tile_size: int) -> List[Tile]:
     width, height = screen_size
-    ratio = float(width) / height
-    screen = (-1, 1 / ratio, 1, -1 / ratio)
-    scene = Scene(camera, ambient, lights, objects, screen_size, max_depth)
+    return [(i, min(i + tile_size, height), j, min(j + tile_size, width))
+            for i in range(0, height, tile_size)
+            for j in range(0, width, tile_size)]
 
-    image = np.zeros((height, width, 3))
-    args = []
 
-    for i, y in enumerate(np.linspace(screen[1], screen[3], height)):
-        for j, x in enumerate(np.linspace(screen[0], screen[2], width)):
-            pixel = np.array([x, y, 0])
-            args.append((i, j, pixel, screen, camera, objects, scene))
+def framebuffer_views(buffer, screen_size: Tuple[int, int], dtype=np.float64) -> Framebuffer:
+    width, height = screen_size
+    colors = np.ndarray((height, width, 3), dtype=dtype, buffer=buffer)
+    object_ids = np.ndarray((height, width), dtype=np.int64, buffer=buffer, offset=colors.nbytes)
+    return colors, object_ids
 
-    with Pool() as pool:
-        results = pool.map(render_pixel, args)
 
-    for result in results:
-        i, j, color = result
-        image[i, j] = color
+def create_framebuffer(screen_size: Tuple[int, int],
+                       dtype=np.float64) -> Tuple[shared_memory.SharedMemory, Framebuffer]:
+    width, height = screen_size
+    size = height * width * (3 * np.dtype(dtype).itemsize + np.dtype(np.int64).itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    colors, object_ids = framebuffer_views(shm.buf, screen_size, dtype)
+    colors.fill(0)
+    object_ids.fill(-1)
+    return shm, (colors, object_ids)
+
+
+def init_worker(scene: Scene, framebuffer_name: str):
+    global _worker_scene, _worker_framebuffer
+    shm = shared_memory.SharedMemory(name=framebuffer_name)
+    _worker_scene = scene
+    _worker_framebuffer = shm, framebuffer_views(shm.buf, scene.window_size, scene.precision.dtype)
+
+
+def render_tile(tile: Tile) -> Tuple[Tile, Optional[RenderStats]]:
+    """
+        Renders the tile straight into the shared framebuffer, only the tile itself (and its stats
+        when instrumentation is on) is sent back.
+    """
+    scene = _worker_scene
+    _, (colors, object_ids) = _worker_framebuffer
+    i0, i1, j0, j1 = tile
+    if scene.stats is not None:
+        scene.stats = RenderStats()
+    colors[i0:i1, j0:j1], object_ids[i0:i1, j0:j1] = trace_tile(scene, tile)
+    return tile, scene.stats
+
+
+def trace_tile(scene: Scene, tile: Tile) -> Framebuffer:
+    """
+        Colors and hit object ids of the pixels of a tile.
+    """
+    i0, i1, j0, j1 = tile
+    xs, ys = get_window_screen(scene)
+    # Random choices only depend on the tile, not on which worker renders it
+    scene.rng = np.random.default_rng((scene.seed, i0, j0))
+    colors = np.zeros((i1 - i0, j1 - j0, 3), dtype=scene.precision.dtype)
+    object_ids = np.full((i1 - i0, j1 - j0), -1, dtype=np.int64)
+
+    for i in range(i0, i1):
+        for j in range(j0, j1):
+            colors[i - i0, j - j0], object_ids[i - i0, j - j0] = trace_pixel(scene, np.array([xs[j], ys[i], 0]))
+
+    return colors, object_ids
+
+
+def antialias_tile(task: Tuple[Tile, np.ndarray]) -> Tuple[Tile, Optional[RenderStats]]:
+    tile, pixels = task
+    scene = _worker_scene
+    _, (colors, _) = _worker_framebuffer
+    if scene.stats is not None:
+        scene.stats = RenderStats()
+    colors[pixels[:, 0], pixels[:, 1]] = antialias_tile_pixels(scene, tile, pixels,
+                                                               colors[pixels[:, 0], pixels[:, 1]])
+    return tile, scene.stats
+
+
+def antialias_tile_pixels(scene: Scene, tile: Tile, pixels: np.ndarray, colors: np.ndarray) -> np.ndarray:
+    """
+        supersample_pixels of the edge pixels of a tile.
+    """
+    scene.rng = np.random.default_rng((scene.seed, tile[0], tile[2], 1))
+    return supersample_pixels(scene, pixels, colors)
 
-    return image
+
+def antialias_tasks(scene: Scene, tiles: List[Tile], colors: np.ndarray,
+                    object_ids: np.ndarray) -> List[Tuple[Tile, np.ndarray]]:
+    """
+        The edge pixels (window rows and columns) of the first pass grouped by tile, tiles
+        without edges are left out.
+    """
+    edges = find_edges(colors, object_ids, scene.contrast_threshold)
+    tasks = []
+    for i0, i1, j0, j1 in tiles:
+        pixels = np.argwhere(edges[i0:i1, j0:j1]) + [i0, j0]
+        if len(pixels):
+            tasks.append(((i0, i1, j0, j1), pixels))
+    return tasks
+
+
+def iter_render_tiles(scene: Scene, tile_size: int = 16,
+                      processes: Optional[int] = None) -> Iterator[Tuple[Tile, np.ndarray]]:
+    """
+        Renders the scene on a process pool and yields every tile as soon as it is finished,
+        together with the framebuffer colors it was written into. The framebuffer lives in shared
+        memory and is released when the generator ends, so copy what needs to be kept. Closing
+        the generator early terminates the pool.
+        With anti-aliasing on, the tiles that have edges are yielded a second time once their
+        edge pixels are supersampled. The stats of every tile are added to scene.stats.
+        Tiles and the framebuffer cover the window of the scene (its crop), not the full image.
+    """
+    shm, framebuffer = create_framebuffer(scene.window_size, scene.precision.dtype)
+    try:
+        yield from render_tiles(scene, shm.name, framebuffer, tile_size, processes)
+    finally:
+        del framebuffer
+        shm.close()
+        shm.unlink()
+
+
+def render_tiles(scene: Scene, framebuffer_name: str, framebuffer: Framebuffer, tile_size: int = 16,
+                 processes: Optional[int] = None) -> Iterator[Tuple[Tile, np.ndarray]]:
+    """
+        iter_render_tiles into a shared framebuffer the caller owns (framebuffer_name is the name
+        of its shared memory block).
+    """
+    tiles = split_tiles(scene.window_size, tile_size)
+    colors, object_ids = framebuffer
+    with Pool(processes, initializer=init_worker, initargs=(scene, framebuffer_name)) as pool:
+        for tile, stats in pool.imap_unordered(render_tile, tiles, chunksize=1):
+            if stats is not None:
+                scene.stats.merge(stats)
+            yield tile, colors
+
+        if scene.max_samples > 1:
+            tasks = antialias_tasks(scene, tiles, colors, object_ids)
+            for tile, stats in pool.imap_unordered(antialias_tile, tasks, chunksize=1):
+                if stats is not None:
+                    scene.stats.merge(stats)
+                yield tile, colors
+
+
+def fast_render_scene(camera: np.ndarray, ambient: np.ndarray, lights: List[Light], objects: List[SceneObject],
+                      screen_size: Tuple[int, int], max_depth: int, tile_size: int = 16,
+                      processes: Optional[int] = None, **options):
+    """
+        The scene is pickled once per worker, the workers then pull tiles one at a time from the
+        pool queue so expensive regions are spread over all the cores. Pixels are written into a
+        framebuffer in shared memory so no colors are pickled back to the parent, which only
+        copies the framebuffer once all the tiles are done.
+        options are the render settings of Scene (anti-aliasing, secondary ray pruning, crop...),
+        with a crop only its window is rendered and returned.
+    """
+    scene = Scene(camera, ambient, lights, objects, screen_size, max_depth, **options)
+    shm, framebuffer = create_framebuffer(scene.window_size, scene.precision.dtype)
+    try:
+        # The tiles are only drained, the workers already wrote them into the framebuffer
+        deque(render_tiles(scene, shm.name, framebuffer, tile_size, processes), maxlen=0)
+        return framebuffer[0].copy()
+    finally:
+        del framebuffer
+        shm.close()
+        shm.unlink()
 
 
 def render_scene(camera: np.ndarray, ambient: np.ndarray, lights: List[Light], objects: List[SceneObject],
-                 screen_size: Tuple[int, int], max_depth: int):
-    width, height = screen_size
-    ratio = float(width) / height
-    screen = (-1, 1 / ratio, 1, -1 / ratio)
-    scene = Scene(camera, ambient, lights, objects, screen_size, max_depth)
+                 screen_size: Tuple[int, int], max_depth: int, **options):
+    return trace_scene(Scene(camera, ambient, lights, objects, screen_size, max_depth, **options))
 
-    image = np.zeros((height, width, 3))
 
-    for i, y in enumerate(np.linspace(screen[1], screen[3], height)):
-        for j, x in enumerate(np.linspace(screen[0], screen[2], width)):
-            # screen is on origin
-            pixel = np.array([x, y, 0])
-            origin = camera
-            direction = normalize(pixel - origin)
-            ray = Ray(origin, direction)
-            color = np.zeros(3)
+def trace_scene(scene: Scene) -> np.ndarray:
+    """
+        render_scene of a scene that is already built, one pixel at a time.
+    """
+    width, height = scene.window_size
+    xs, ys = get_window_screen(scene)
 
-            intersection = ray.nearest_intersected_object(objects)
-            if intersection:
-                dist, hit_object = intersection
-                hit_point = calc_point(dist, ray, hit_object)
-                color = get_color(scene, ray, hit_point,
-                                  hit_object, 1, scene.max_depth)
+    image = np.zeros((height, width, 3), dtype=scene.precision.dtype)
+    object_ids = np.full((height, width), -1)
 
-            # We clip the values between 0 and 1 so all pixel values will make sense.
-            image[i, j] = np.clip(color, 0, 1)
+    for i, y in enumerate(ys):
+        for j, x in enumerate(xs):
+            image[i, j], object_ids[i, j] = trace_pixel(scene, np.array([x, y, 0]))
+
+    if scene.max_samples > 1:
+        edges = find_edges(image, object_ids, scene.contrast_threshold)
+        antialias_pixels(scene, image, np.argwhere(edges))
 
     return image
 
 
+def jit_render_scene(camera: np.ndarray, ambient: np.ndarray, lights: List[Light], objects: List[SceneObject],
+                     screen_size: Tuple[int, int], max_depth: int, **options):
+    """
+        render_scene with the ray kernels of core.jit compiled by numba, on the scene packed into
+        flat arrays. It falls back to render_scene when numba is not installed, when the kernels
+        are turned off (JIT=0 or set_jit_enabled) and for Russian roulette and light sampling.
+    """
+    scene = Scene(camera, ambient, lights, objects, screen_size, max_depth, **options)
+    return jit_trace_scene(scene) if jit_supported(scene) else trace_scene(scene)
+
+
+def jit_trace_scene(scene: Scene) -> np.ndarray:
+    """
+        jit_render_scene of a scene that is already built, it runs the kernels whether they are
+        compiled or not.
+    """
+    width, height = scene.window_size
+    xs, ys = get_window_screen(scene)
+    packed = JitScene(scene)
+
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    pixels = np.stack([grid_x.ravel(), grid_y.ravel(), np.zeros(grid_x.size)], axis=1)
+    colors, object_ids = packed.trace(pixels)
+    image = colors.reshape(height, width, 3).astype(scene.precision.dtype)
+
+    if scene.max_samples > 1:
+        def trace(pixel: np.ndarray) -> np.ndarray:
+            return packed.trace(pixel[np.newaxis])[0][0]
+
+        pixels = np.argwhere(find_edges(image, object_ids.reshape(height, width), scene.contrast_threshold))
+        image[pixels[:, 0], pixels[:, 1]] = supersample_pixels(scene, pixels, image[pixels[:, 0], pixels[:, 1]], trace)
+
+    return image
+
+
+def wavefront_render_scene(camera: np.ndarray, ambient: np.ndarray, lights: List[Light], objects: List[SceneObject],
+                           screen_size: Tuple[int, int], max_depth: int, gbuffers: Optional[GBufferCache] = None,
+                           **options):
+    """
+        Traces all the camera rays together as arrays, each level of the ray tree (intersection,
+        shadows and shading of every ray) is a few array operations over the compiled scene.
+        With a gbuffers cache the primary hits are looked up by the geometry of the scene and
+        stored there on a miss, so a scene that only differs in its lights, ambient or materials
+        is shaded again without intersecting its camera rays (anti-aliasing samples are still
+        traced).
+    """
+    return wavefront_trace_scene(Scene(camera, ambient, lights, objects, screen_size, max_depth, **options), gbuffers)
+
+
+def wavefront_trace_scene(scene: Scene, gbuffers: Optional[GBufferCache] = None) -> np.ndarray:
+    """
+        wavefront_render_scene of a scene that is already built.
+    """
+    width, height = scene.window_size
+    _, directions = generate_camera_rays(scene.camera, scene.screen_size, scene.precision.dtype, scene.window)
+    gbuffer = None
+    if gbuffers is not None:
+        key = geometry_key(scene.camera, scene.objects, scene.screen_size, scene.crop, scene.precision.name)
+        gbuffer = gbuffers.get(key)
+        if gbuffer is None:
+            gbuffer = primary_gbuffer(scene, scene.camera, directions)
+            gbuffers.put(key, gbuffer)
+    colors, object_ids = trace_rays(scene, scene.camera, directions, gbuffer)
+
+    # We clip the values between 0 and 1 so all pixel values will make sense.
+    image = np.clip(colors, 0, 1).reshape(height, width, 3)
+    if scene.max_samples > 1:
+        edges = find_edges(image, object_ids.reshape(height, width), scene.contrast_threshold)
+        antialias_wavefront(scene, image, np.argwhere(edges))
+
+    return image
+
+
+def antialias_wavefront(scene: Scene, image: np.ndarray, pixels: np.ndarray):
+    """
+        Batched antialias_pixels, takes the same samples as supersample but traces every sample
+        of a round (the first ones, then the rest for pixels whose samples don't agree) together.
+    """
+    pixel_size = np.array(get_pixel_size(*get_screen(scene.screen_size)))
+    xs, ys = get_window_screen(scene)
+    offsets = sample_offsets(scene.max_samples)
+    centers = np.stack([xs[pixels[:, 1]], ys[pixels[:, 0]]], axis=1)
+
+    def trace(which: np.ndarray, sample_offsets: np.ndarray) -> np.ndarray:
+        positions = centers[which, np.newaxis] + sample_offsets * pixel_size
+        samples = np.concatenate([positions, np.zeros(positions.shape[:2] + (1,))], axis=2).reshape(-1, 3)
+        # trace_rays converts the sample directions to the precision of the scene
+        colors, _ = trace_rays(scene, scene.camera, normalize_rows(samples - scene.camera))
+        return np.clip(colors, 0, 1).reshape(len(which), len(sample_offsets), 3)
+
+    first_round = min(EARLY_EXIT_SAMPLES, scene.max_samples)
+    samples = np.concatenate([image[pixels[:, 0], pixels[:, 1], np.newaxis],
+                              trace(np.arange(len(pixels)), offsets[1:first_round])], axis=1)
+    colors = samples.mean(axis=1)
+
+    if scene.max_samples > first_round:
+        disagree = np.flatnonzero(np.ptp(samples, axis=1).max(axis=1) > scene.contrast_threshold)
+        if len(disagree):
+            rest = trace(disagree, offsets[first_round:])
+            colors[disagree] = np.concatenate([samples[disagree], rest], axis=1).mean(axis=1)
+
+    image[pixels[:, 0], pixels[:, 1]] = colors
+
+
 def get_example_scene() -> Scene:
     sphere_a = Sphere([-0.5, 0.2, -1], 0.5)
     sphere_a.set_material([1, 0, 0], [1, 0, 0], [0.3, 0.3, 0.3], 100, 1)
@@ -138,5 +452,5 @@ if __name__ == '__main__':
     camera, ambient, lights, objects = get_example_scene()
 
     im = fast_render_scene(camera, ambient, lights, objects, (256, 256), 3)
-    plt.imshow(im)
-    plt.imsave('scene4.png', im)
+    with open('scene4.png', 'wb') as file:
+        file.write(encode_png(im))
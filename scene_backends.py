@@ -0,0 +1,140 @@
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from prompt import prompt, PROMPT_VERSION
+
+
+class SceneBackend:
+    """
+        Turns a description of a scene into the scene JSON (as a string) in the prompt format.
+    """
+    name = 'base'
+
+    def generate_scene(self, description: str) -> str:
+        raise NotImplementedError
+
+
+class OpenAIBackend(SceneBackend):
+    name = 'openai'
+
+    def __init__(self, api_key: Optional[str], model: str = "gpt-4", temperature: float = 0.7):
+        self.api_key = api_key
+        self.model = model
+        self.temperature = temperature
+        self.client = None
+
+    def generate_scene(self, description: str) -> str:
+        if self.client is None:
+            # Imported on first use so the server starts without loading the openai package
+            from openai import OpenAI
+            self.client = OpenAI(api_key=self.api_key)
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "system", "content": prompt},
+                      {"role": "user", "content": f"Description: {description}"}],
+            temperature=self.temperature
+        )
+        return response.choices[0].message.content
+
+
+class StubBackend(SceneBackend):
+    """
+        Deterministic local backend for tests and benchmarks, no network and no API key.
+        The same description always gets the same canned scene, by default the example scene.
+    """
+    name = 'stub'
+
+    def __init__(self, scenes: Optional[List[str]] = None):
+        if scenes is None:
+            from core.serialization import serialize_scene_data
+            from renders import get_example_scene
+            scenes = [json.dumps(serialize_scene_data(*get_example_scene()))]
+        self.scenes = scenes
+
+    def generate_scene(self, description: str) -> str:
+        digest = hashlib.sha256(normalize_description(description).encode('utf-8')).digest()
+        return self.scenes[int.from_bytes(digest[:4], 'big') % len(self.scenes)]
+
+
+def normalize_description(description: str) -> str:
+    return re.sub(r'\s+', ' ', description).strip().lower()
+
+
+class SceneDescriptionCache:
+    """
+        Scene JSON by normalized description and prompt version, bounded to max_entries
+        (least recently used are dropped first) and every entry expires after ttl seconds.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 24 * 60 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(backend: SceneBackend, description: str) -> str:
+        return f"{backend.name}:{PROMPT_VERSION}:{normalize_description(description)}"
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, scene_json: str):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, scene_json)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+            }
+
+
+def ask_for_scene(backend: SceneBackend, description: str, cache: Optional[SceneDescriptionCache] = None) -> str:
+    if cache is None:
+        return backend.generate_scene(description)
+    key = cache.key(backend, description)
+    scene_json = cache.get(key)
+    if scene_json is not None:
+        logging.info("Scene description cache hit")
+        return scene_json
+    scene_json = backend.generate_scene(description)
+    # Only answers that parse are kept, a broken answer should be asked again
+    json.loads(scene_json)
+    cache.put(key, scene_json)
+    return scene_json
+
+
+def create_backend(name: str, api_key: Optional[str] = None) -> SceneBackend:
+    if name == 'openai':
+        return OpenAIBackend(api_key)
+    if name == 'stub':
+        return StubBackend()
+    raise ValueError(f"Unknown scene backend '{name}', expected 'openai' or 'stub'")
@@ -1,44 +1,148 @@
-from flask import Flask, request, jsonify, send_file
-from openai import OpenAI
+from flask import Flask, Response, request, jsonify, send_file
 import numpy as np
 import io
+import base64
 import json
 from dotenv import load_dotenv
 import os
-from matplotlib import pyplot as plt
+import threading
 from core import *
-from renders import render_scene, fast_render_scene
-from prompt import prompt
+from core.cost import RenderCost, estimate_cost
+from core.instrumentation import RenderStats, timer
+from core.png import encode_png as encode_png_image
+from core.precision import get_precision
+from core.scene import check_crop
+from core.serialization import parse_scene_data
+from distributed import TileCoordinator, parse_address, start_local_workers
+from admission import DEFERRED_PRIORITY, AdmissionControl, RenderTooExpensive
+from animation import ENGINES as ANIMATION_ENGINES, pack_frames, parse_animation, render_animation
+from jobs import RenderJobQueue, QueueFull
+from render_cache import GBufferCache, RenderCache, scene_key
+from renders import render_scene, fast_render_scene, wavefront_render_scene, jit_render_scene, iter_render_tiles
+from scene_backends import SceneDescriptionCache, ask_for_scene, create_backend
 import logging
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 from core.lights import Light
 from core.objects import SceneObject
 
 load_dotenv()
 
 openai_api_key = os.getenv('OPENAI_API_KEY')
-client = OpenAI(api_key=openai_api_key)
+scene_backend = create_backend(os.getenv('SCENE_BACKEND', 'openai'), openai_api_key)
+scene_cache = SceneDescriptionCache(int(os.getenv('SCENE_CACHE_MAX_ENTRIES', 1024)),
+                                    float(os.getenv('SCENE_CACHE_TTL', 24 * 60 * 60)))
 
 app = Flask(__name__)
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+render_cache = RenderCache(int(os.getenv('RENDER_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+                           os.getenv('RENDER_CACHE_DIR') or None)
+
+# Primary hits of the wavefront renders, a scene that only changed its lights, ambient or
+# materials is shaded again from them (0 turns it off)
+gbuffer_cache = GBufferCache(int(os.getenv('GBUFFER_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+
+job_queue = RenderJobQueue(int(os.getenv('JOB_WORKERS', 1)), int(os.getenv('JOB_QUEUE_SIZE', 16)))
+
+MAX_SAMPLES = int(os.getenv('MAX_SAMPLES', 16))
+
+# Requests can ask for another resolution and depth, up to these limits
+DEFAULT_RESOLUTION = (256, 256)
+DEFAULT_MAX_DEPTH = 3
+MAX_RESOLUTION = int(os.getenv('MAX_RESOLUTION', 1024))
+MAX_DEPTH = int(os.getenv('MAX_DEPTH', 8))
+# Previews are rendered this many times smaller than the requested resolution
+PREVIEW_SCALE = int(os.getenv('PREVIEW_SCALE', 4))
+# Longest animation /animation renders
+MAX_FRAMES = int(os.getenv('MAX_FRAMES', 240))
+
+# Admission control of the renders by their estimated cost in intersection tests (core/cost.py):
+# over RENDER_COST_BUDGET they are downscaled, rejected or deferred depending on COST_POLICY, and
+# rejected instead of deferred over RENDER_COST_LIMIT (0 turns either off)
+admission = AdmissionControl(float(os.getenv('RENDER_COST_BUDGET', 2e7)), float(os.getenv('RENDER_COST_LIMIT', 2e8)),
+                             os.getenv('COST_POLICY', 'downscale'))
+
+# zlib level of the PNG responses, 1 is faster and larger, 9 is slower and smaller
+PNG_COMPRESSION = int(os.getenv('PNG_COMPRESSION', 6))
+
+# Mesh files referenced by scenes are only loaded from this directory
+MESH_DIR = os.getenv('MESH_DIR', 'meshes')
+
+# Render instrumentation (ray counters and stage timings), off unless INSTRUMENTATION is set
+INSTRUMENTATION = os.getenv('INSTRUMENTATION', '').lower() in ('1', 'true', 'yes')
+metrics = RenderStats()
+metrics_requests = 0
+metrics_lock = threading.Lock()
+
+RENDERERS = {
+    'scalar': render_scene,
+    'parallel': fast_render_scene,
+    'wavefront': wavefront_render_scene,
+    # Renders with the numba kernels of core.jit, or like 'scalar' when numba is not installed
+    'jit': jit_render_scene,
+}
+
+# With TILE_COORDINATOR (host:port) the "distributed" engine renders the tiles on the workers
+# that connect to it (python distributed.py host:port), TILE_LOCAL_WORKERS starts some here.
+# The coordinator is started by the first distributed render and not on import, the reloader of
+# app.run(debug=True) and spawned processes import this module again
+TILE_COORDINATOR = os.getenv('TILE_COORDINATOR')
+tile_coordinator: Optional[TileCoordinator] = None
+tile_coordinator_lock = threading.Lock()
+
+
+class BadRequest(ValueError):
+    """
+        A render setting of the request is invalid or out of the server limits, answered with a
+        400 and the message.
+    """
+
+
+def get_tile_coordinator() -> TileCoordinator:
+    global tile_coordinator
+    with tile_coordinator_lock:
+        if tile_coordinator is None:
+            tile_coordinator = TileCoordinator(*parse_address(TILE_COORDINATOR),
+                                               float(os.getenv('TILE_HEARTBEAT_INTERVAL', 1)),
+                                               float(os.getenv('TILE_HEARTBEAT_TIMEOUT', 5)),
+                                               int(os.getenv('TILE_MAX_ATTEMPTS', 3)))
+            start_local_workers(tile_coordinator.address, int(os.getenv('TILE_LOCAL_WORKERS', 0)), MESH_DIR)
+        return tile_coordinator
+
+
+def render_distributed(camera: np.ndarray, ambient: np.ndarray, lights: List[Light], objects: List[SceneObject],
+                       screen_size: Tuple[int, int], max_depth: int, **options) -> np.ndarray:
+    return get_tile_coordinator().render_scene(camera, ambient, lights, objects, screen_size, max_depth, **options)
+
+
+if TILE_COORDINATOR:
+    RENDERERS['distributed'] = render_distributed
+
 
 @app.route('/', methods=['POST'])
 def get_scene():
     try:
         req = request.json
-        logging.info("Asking GPT for scene...")
-        gpt_response = ask_gpt4_for_scene(req['message'])
-        scene_data = json.loads(gpt_response)
-        logging.info("Parsing GPT Response...")
-        camera, ambient, lights, objects = parse_scene_data(scene_data)
-        logging.info("Parsing Success")
+        stats = new_stats()
+        camera, ambient, lights, objects = load_scene(req, stats)
         logging.info("Rendering image...")
-        image = render_scene(camera, ambient, lights, objects, (256, 256), 3)
+        renderer = get_renderer(req, 'scalar')
+        screen_size, max_depth, options = get_image_settings(req)
+        screen_size, options, decision, cost = admit_render(
+            camera, ambient, lights, objects, screen_size, max_depth, options)
+        png, cache_hit = render_png(
+            renderer, camera, ambient, lights, objects, screen_size, max_depth, stats, **options)
         logging.info("Rendering Success")
-        return send_image(image)
+        record_metrics(stats)
+        return send_png(png, cache_hit, stats, decision, cost)
+    except BadRequest as e:
+        logging.error(f"Error in get_scene: {e}")
+        return jsonify({"error": str(e)}), 400
+    except RenderTooExpensive as e:
+        logging.error(f"Error in get_scene: {e}")
+        return jsonify({"error": str(e), "cost": e.cost.to_dict()}), 422
     except Exception as e:
         logging.error(f"Error in get_scene: {e}")
         return jsonify({"error": str(e)}), 500
@@ -48,85 +152,514 @@ def get_scene():
 def get_scene_fast():
     try:
         req = request.json
-        logging.info("Asking GPT for Scene...")
-        gpt_response = ask_gpt4_for_scene(req['message'])
-        scene_data = json.loads(gpt_response)
-        logging.info("Parsing GPT Response...")
-        camera, ambient, lights, objects = parse_scene_data(scene_data)
-        logging.info("Parsing Success")
+        stats = new_stats()
+        camera, ambient, lights, objects = load_scene(req, stats)
         logging.info("Rendering image...")
-        image = fast_render_scene(
-            camera, ambient, lights, objects, (256, 256), 3)
+        renderer = get_renderer(req, 'parallel')
+        screen_size, max_depth, options = get_image_settings(req)
+        screen_size, options, decision, cost = admit_render(
+            camera, ambient, lights, objects, screen_size, max_depth, options)
+        png, cache_hit = render_png(
+            renderer, camera, ambient, lights, objects, screen_size, max_depth, stats, **options)
         logging.info("Rendering Success")
-        return send_image(image)
+        record_metrics(stats)
+        return send_png(png, cache_hit, stats, decision, cost)
+    except BadRequest as e:
+        logging.error(f"Error in get_scene_fast: {e}")
+        return jsonify({"error": str(e)}), 400
+    except RenderTooExpensive as e:
+        logging.error(f"Error in get_scene_fast: {e}")
+        return jsonify({"error": str(e), "cost": e.cost.to_dict()}), 422
     except Exception as e:
         logging.error(f"Error in get_scene_fast: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-def ask_gpt4_for_scene(description: str) -> str:
+@app.route('/stream', methods=['POST'])
+def get_scene_stream():
+    """
+        Same pipeline as /fast but the image is sent as server-sent events while it is rendered,
+        one 'tile' event per finished tile (its bounds and a base64 PNG of its pixels) and a
+        final 'done' event. Closing the connection stops the render. With "preview" a 'preview'
+        event with a quick low quality render of the whole image comes before the tiles.
+    """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "system", "content": prompt},
-                      {"role": "user", "content": f"Description: {description}"}],
-            temperature=0.7
-        )
-        return response.choices[0].message.content
+        req = request.json
+        stats = new_stats()
+        camera, ambient, lights, objects = load_scene(req, stats)
+        screen_size, max_depth, options = get_render_settings(req)
+        screen_size, options, decision, cost = admit_render(
+            camera, ambient, lights, objects, screen_size, max_depth, options)
+    except BadRequest as e:
+        logging.error(f"Error in get_scene_stream: {e}")
+        return jsonify({"error": str(e)}), 400
+    except RenderTooExpensive as e:
+        logging.error(f"Error in get_scene_stream: {e}")
+        return jsonify({"error": str(e), "cost": e.cost.to_dict()}), 422
     except Exception as e:
-        logging.error(f"Error in ask_gpt4_for_scene: {e}")
-        raise
+        logging.error(f"Error in get_scene_stream: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    key = scene_key(camera, ambient, lights, objects, screen_size, max_depth, **options)
+    scene = Scene(camera, ambient, lights, objects, screen_size, max_depth, stats=stats, **options)
+
+    def generate():
+        logging.info("Streaming image...")
+        width, height = scene.window_size
+        yield sse_event('start', {"width": width, "height": height, "admission": decision, "cost": cost.to_dict()})
+        if req.get('preview', False):
+            preview_size, preview_depth, preview_options = preview_settings(screen_size, options)
+            with timer(stats, 'preview'):
+                preview_png, _ = render_png(wavefront_render_scene, camera, ambient, lights, objects,
+                                            preview_size, preview_depth, **preview_options)
+            yield sse_event('preview', {"png": base64.b64encode(preview_png).decode('ascii')})
+        with timer(stats, 'cache'):
+            cached = render_cache.get(key)
+        if cached is not None:
+            # A cached image is sent as a single tile that covers the whole frame
+            yield sse_event('tile', {"tile": [0, height, 0, width],
+                                     "png": base64.b64encode(cached).decode('ascii')})
+            record_metrics(stats)
+            yield sse_event('done', {"cache": "hit", **stats_event_data(stats)})
+            return
+        image = np.zeros((height, width, 3))
+        try:
+            tiles = iter_scene_tiles(req, scene)
+            while True:
+                # Only the rendering is timed, not the time the client takes to read the tiles
+                with timer(stats, 'render'):
+                    finished = next(tiles, None)
+                if finished is None:
+                    break
+                (i0, i1, j0, j1), framebuffer = finished
+                image[i0:i1, j0:j1] = framebuffer[i0:i1, j0:j1]
+                with timer(stats, 'encode'):
+                    tile_png = base64.b64encode(encode_png(image[i0:i1, j0:j1])).decode('ascii')
+                yield sse_event('tile', {"tile": [i0, i1, j0, j1], "png": tile_png})
+        except GeneratorExit:
+            logging.info("Client closed the stream, render cancelled")
+            raise
+        except Exception as e:
+            logging.error(f"Error in get_scene_stream: {e}")
+            yield sse_event('error', {"error": str(e)})
+            return
+        logging.info("Streaming Success")
+        with timer(stats, 'encode'):
+            png = encode_png(image)
+        render_cache.put(key, png)
+        record_metrics(stats)
+        yield sse_event('done', {"cache": "miss", **stats_event_data(stats)})
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/animation', methods=['POST'])
+def get_animation():
+    """
+        Renders the scene of the message with the keyframes of "animation" (see parse_animation)
+        on one worker pool. The frames are streamed as server-sent events as soon as they are
+        finished ('frame' events with the frame number and a base64 PNG, not in frame order), or
+        with "format": "zip" sent together as a zip archive of PNG files.
+    """
+    try:
+        req = request.json
+        camera, ambient, lights, objects = load_scene(req, None)
+        screen_size, max_depth, options = get_render_settings(req)
+        try:
+            animation = parse_animation(req['animation'], camera, ambient, lights, objects, screen_size, max_depth,
+                                        **options)
+        except (KeyError, TypeError, ValueError) as e:
+            raise BadRequest(f"Invalid animation: {e}") from e
+        if animation.frames > MAX_FRAMES:
+            raise BadRequest(f"frames must be at most {MAX_FRAMES}")
+        engine = req.get('engine', 'wavefront')
+        if engine not in ANIMATION_ENGINES:
+            raise BadRequest(f"Unknown engine '{engine}', expected one of {list(ANIMATION_ENGINES)}")
+        output = req.get('format', 'stream')
+        if output not in ('stream', 'zip'):
+            raise BadRequest(f"Unknown format '{output}', expected 'stream' or 'zip'")
+        # Admitted as a whole, the cost of a frame times the number of frames
+        screen_size, options, decision, cost = admit_render(
+            camera, ambient, lights, objects, screen_size, max_depth, options, frames=animation.frames)
+        animation.screen_size, animation.options = screen_size, options
+    except BadRequest as e:
+        logging.error(f"Error in get_animation: {e}")
+        return jsonify({"error": str(e)}), 400
+    except RenderTooExpensive as e:
+        logging.error(f"Error in get_animation: {e}")
+        return jsonify({"error": str(e), "cost": e.cost.to_dict()}), 422
+    except Exception as e:
+        logging.error(f"Error in get_animation: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    if output == 'zip':
+        try:
+            logging.info(f"Rendering {animation.frames} frames...")
+            frames = {frame: encode_png(image) for frame, image in render_animation(animation, engine)}
+            logging.info("Rendering Success")
+            response = send_file(io.BytesIO(pack_frames(frames)), mimetype='application/zip',
+                                 download_name='animation.zip')
+            response.headers['X-Render-Admission'] = decision
+            response.headers['X-Render-Cost'] = json.dumps(cost.to_dict(), separators=(',', ':'))
+            return response
+        except Exception as e:
+            logging.error(f"Error in get_animation: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    def generate():
+        logging.info(f"Streaming {animation.frames} frames...")
+        crop = options['crop']
+        width, height = screen_size if crop is None else (crop[2] - crop[0], crop[3] - crop[1])
+        yield sse_event('start', {"frames": animation.frames, "width": width, "height": height,
+                                  "admission": decision, "cost": cost.to_dict()})
+        try:
+            for frame, image in render_animation(animation, engine):
+                png = base64.b64encode(encode_png(image)).decode('ascii')
+                yield sse_event('frame', {"frame": frame, "png": png})
+        except GeneratorExit:
+            logging.info("Client closed the stream, animation cancelled")
+            raise
+        except Exception as e:
+            logging.error(f"Error in get_animation: {e}")
+            yield sse_event('error', {"error": str(e)})
+            return
+        logging.info("Streaming Success")
+        yield sse_event('done', {})
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """
+        Asks GPT for the scene and queues its render, the response is the job (202) and the image
+        is fetched from /jobs/<id>/result once the job is done. A scene that is already queued or
+        rendering joins that job instead of being rendered twice.
+    """
+    try:
+        req = request.json
+        stats = new_stats()
+        camera, ambient, lights, objects = load_scene(req, stats)
+        renderer = get_renderer(req, 'parallel')
+        screen_size, max_depth, options = get_image_settings(req)
+        screen_size, options, decision, _ = admit_render(
+            camera, ambient, lights, objects, screen_size, max_depth, options, queued=True)
+        key = scene_key(camera, ambient, lights, objects, screen_size, max_depth, **options)
+        with timer(stats, 'cache'):
+            cached = render_cache.get(key)
+        record_metrics(stats)
+        if cached is not None:
+            job = job_queue.completed(key, cached)
+        else:
+            # Renders over the cost budget wait until the queue has no cheaper render left
+            job = job_queue.submit(key, lambda: render_job(
+                key, renderer, camera, ambient, lights, objects, screen_size, max_depth, **options),
+                DEFERRED_PRIORITY if decision == 'defer' else 0)
+        logging.info(f"Render job {job.id} is {job.status}")
+        return jsonify(job.to_dict()), 202
+    except QueueFull as e:
+        logging.error(f"Error in create_job: {e}")
+        return jsonify({"error": str(e)}), 503, {'Retry-After': '5'}
+    except BadRequest as e:
+        logging.error(f"Error in create_job: {e}")
+        return jsonify({"error": str(e)}), 400
+    except RenderTooExpensive as e:
+        logging.error(f"Error in create_job: {e}")
+        return jsonify({"error": str(e), "cost": e.cost.to_dict()}), 422
+    except Exception as e:
+        logging.error(f"Error in create_job: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
+    if job.status == 'failed':
+        return jsonify(job.to_dict()), 500
+    if job.status != 'done':
+        return jsonify(job.to_dict()), 202
+    return send_png(job.result)
 
 
-def parse_scene_data(scene_data: dict) -> Tuple[np.ndarray, np.ndarray, List[Light], List[SceneObject]]:
+@app.route('/jobs/stats', methods=['GET'])
+def get_job_stats():
+    return jsonify(job_queue.stats())
+
+
+@app.route('/admission/stats', methods=['GET'])
+def get_admission_stats():
+    """
+        The cost budget and policy of admission control and how many renders it admitted,
+        downscaled, deferred and rejected.
+    """
+    return jsonify(admission.stats())
+
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({"render": render_cache.stats(), "scene": scene_cache.stats(), "gbuffer": gbuffer_cache.stats()})
+
+
+@app.route('/tiles/stats', methods=['GET'])
+def get_tile_stats():
+    """
+        Connected tile workers and their finished tasks, tasks waiting for a worker and tiles
+        that were queued again after their worker was lost.
+    """
+    if not TILE_COORDINATOR:
+        return jsonify({"enabled": False})
+    if tile_coordinator is None:
+        # Nothing was rendered on the workers yet
+        return jsonify({"enabled": True, "started": False})
+    return jsonify({"enabled": True, "started": True, **tile_coordinator.stats()})
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+        Totals of the render instrumentation over all the requests since the server started.
+    """
+    with metrics_lock:
+        return jsonify({"enabled": INSTRUMENTATION, "requests": metrics_requests, **metrics.to_dict()})
+
+
+def load_scene(req: dict, stats: Optional[RenderStats]) -> Tuple[np.ndarray, np.ndarray, List[Light], List[SceneObject]]:
+    logging.info("Asking GPT for scene...")
+    with timer(stats, 'llm'):
+        gpt_response = ask_gpt4_for_scene(req['message'])
+    logging.info("Parsing GPT Response...")
+    with timer(stats, 'parse'):
+        scene_data = json.loads(gpt_response)
+        scene = parse_scene_data(scene_data, MESH_DIR)
+    logging.info("Parsing Success")
+    return scene
+
+
+def render_png(renderer, camera: np.ndarray, ambient: np.ndarray, lights: List[Light], objects: List[SceneObject],
+               screen_size: Tuple[int, int], max_depth: int, stats: Optional[RenderStats] = None,
+               **options) -> Tuple[bytes, bool]:
+    """
+        Returns the encoded image and whether it came from the render cache.
+    """
+    key = scene_key(camera, ambient, lights, objects, screen_size, max_depth, **options)
+    with timer(stats, 'cache'):
+        cached = render_cache.get(key)
+    if cached is not None:
+        logging.info("Render cache hit")
+        return cached, True
+    return render_and_cache(key, renderer, camera, ambient, lights, objects, screen_size, max_depth,
+                            stats, **options), False
+
+
+def render_and_cache(key: str, renderer, camera: np.ndarray, ambient: np.ndarray, lights: List[Light],
+                     objects: List[SceneObject], screen_size: Tuple[int, int], max_depth: int,
+                     stats: Optional[RenderStats] = None, **options) -> bytes:
+    if renderer is wavefront_render_scene and gbuffer_cache.max_bytes > 0:
+        options = {**options, 'gbuffers': gbuffer_cache}
+    with timer(stats, 'render'):
+        image = renderer(camera, ambient, lights, objects, screen_size, max_depth, stats=stats, **options)
+    with timer(stats, 'encode'):
+        png = encode_png(image)
+    render_cache.put(key, png)
+    return png
+
+
+def render_job(key: str, renderer, camera: np.ndarray, ambient: np.ndarray, lights: List[Light],
+               objects: List[SceneObject], screen_size: Tuple[int, int], max_depth: int, **options) -> bytes:
+    stats = new_stats()
+    png = render_and_cache(key, renderer, camera, ambient, lights, objects, screen_size, max_depth, stats,
+                           **options)
+    record_metrics(stats, request=False)
+    return png
+
+
+def new_stats() -> Optional[RenderStats]:
+    return RenderStats() if INSTRUMENTATION else None
+
+
+def record_metrics(stats: Optional[RenderStats], request: bool = True):
+    global metrics_requests
+    if stats is None:
+        return
+    with metrics_lock:
+        metrics.merge(stats)
+        metrics_requests += request
+
+
+def stats_event_data(stats: Optional[RenderStats]) -> dict:
+    return {} if stats is None else {"stats": stats.to_dict()}
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def get_render_settings(req: dict) -> Tuple[Tuple[int, int], int, dict]:
+    """
+        Resolution ("resolution": [width, height]), max depth and render options of the request,
+        bounded by the server limits. Raises BadRequest for invalid or out of range values.
+    """
     try:
-        camera = np.array(scene_data['camera'])
-        ambient = np.array(scene_data['ambient'])
-        lights = []
-        for light_data in scene_data['lights']:
-            if light_data['type'] == 'directional':
-                lights.append(DirectionalLight(
-                    np.array(light_data['intensity']), np.array(light_data['direction'])))
-            elif light_data['type'] == 'point':
-                lights.append(PointLight(np.array(light_data['intensity']), np.array(
-                    light_data['position']), light_data['kc'], light_data['kl'], light_data['kq']))
-            elif light_data['type'] == 'spot':
-                lights.append(SpotLight(np.array(light_data['intensity']), np.array(light_data['position']), np.array(
-                    light_data['direction']), light_data['kc'], light_data['kl'], light_data['kq']))
-
-        objects = []
-        for obj_data in scene_data['objects']:
-            if obj_data['type'] == 'sphere':
-                obj = Sphere(np.array(obj_data['center']), obj_data['radius'])
-            elif obj_data['type'] == 'plane':
-                obj = Plane(np.array(obj_data['normal']),
-                            np.array(obj_data['point']))
-            elif obj_data['type'] == 'rectangle':
-                obj = Rectangle(np.array(obj_data['a']), np.array(
-                    obj_data['b']), np.array(obj_data['c']), np.array(obj_data['d']))
-            elif obj_data['type'] == 'cuboid':
-                obj = Cuboid(np.array(obj_data['a']), np.array(obj_data['b']), np.array(
-                    obj_data['c']), np.array(obj_data['d']), np.array(obj_data['e']), np.array(obj_data['f']))
-            obj.set_material(np.array(obj_data['ambient']), np.array(obj_data['diffuse']), np.array(
-                obj_data['specular']), obj_data['shininess'], obj_data['reflection'], obj_data.get('refractive_index', 0))
-            if obj_data['type'] == 'cuboid':
-                obj.apply_materials_to_faces()
-            objects.append(obj)
-
-        return camera, ambient, lights, objects
+        width, height = (int(v) for v in req.get('resolution', DEFAULT_RESOLUTION))
+        if not (1 <= width <= MAX_RESOLUTION and 1 <= height <= MAX_RESOLUTION):
+            raise ValueError(f"resolution must be between 1x1 and {MAX_RESOLUTION}x{MAX_RESOLUTION}")
+        max_depth = int(req.get('max_depth', DEFAULT_MAX_DEPTH))
+        if not 1 <= max_depth <= MAX_DEPTH:
+            raise ValueError(f"max_depth must be between 1 and {MAX_DEPTH}")
+        return (width, height), max_depth, get_render_options(req, (width, height))
+    except (TypeError, ValueError) as e:
+        raise BadRequest(str(e)) from e
+
+
+def get_image_settings(req: dict) -> Tuple[Tuple[int, int], int, dict]:
+    """
+        get_render_settings of the endpoints that answer with one image. A preview is only sent
+        by /stream, before the full image, so these reject it rather than answer with the
+        preview alone.
+    """
+    if req.get('preview', False):
+        raise BadRequest("preview is only available on /stream, which sends it before the full image")
+    return get_render_settings(req)
+
+
+def preview_settings(screen_size: Tuple[int, int], options: dict) -> Tuple[Tuple[int, int], int, dict]:
+    """
+        The preview preset of a render: PREVIEW_SCALE times smaller, one bounce, no shadows and no
+        anti-aliasing. A crop is scaled down with the image so the preview shows the same window.
+    """
+    width, height = screen_size
+    preview_size = (max(1, width // PREVIEW_SCALE), max(1, height // PREVIEW_SCALE))
+    return preview_size, 1, {**scaled_options(options, screen_size, preview_size), 'max_samples': 1, 'shadows': False}
+
+
+def scaled_options(options: dict, screen_size: Tuple[int, int], new_size: Tuple[int, int]) -> dict:
+    """
+        The render options of the image at another resolution, the crop is scaled with the image
+        so it shows the same window.
+    """
+    crop = options.get('crop')
+    if crop is None:
+        return options
+    (width, height), (new_width, new_height) = screen_size, new_size
+    x0, y0, x1, y1 = crop
+    (x0, x1), (y0, y1) = scale_span(x0, x1, width, new_width), scale_span(y0, y1, height, new_height)
+    return {**options, 'crop': [x0, y0, x1, y1]}
+
+
+def admit_render(camera: np.ndarray, ambient: np.ndarray, lights: List[Light], objects: List[SceneObject],
+                 screen_size: Tuple[int, int], max_depth: int, options: dict,
+                 queued: bool = False, frames: int = 1) -> Tuple[Tuple[int, int], dict, str, RenderCost]:
+    """
+        Resolution and options the render is admitted with, the admission decision and the
+        estimated cost, raises RenderTooExpensive when the render is rejected. queued renders
+        (/jobs) can be deferred instead. An animation is admitted with the cost of all its
+        frames.
+    """
+    def estimate(size: Tuple[int, int]) -> RenderCost:
+        return estimate_cost(camera, ambient, lights, objects, size, max_depth,
+                             **scaled_options(options, screen_size, size)).times(frames)
+
+    decision, new_size, cost = admission.admit(screen_size, estimate(screen_size), estimate, queued)
+    if decision == 'downscale':
+        logging.info(f"Render downscaled from {screen_size[0]}x{screen_size[1]} to {new_size[0]}x{new_size[1]}")
+    return new_size, scaled_options(options, screen_size, new_size), decision, cost
+
+
+def scale_span(start: int, end: int, size: int, new_size: int) -> Tuple[int, int]:
+    # Rounded outwards, and never empty
+    start = start * new_size // size
+    return start, max(start + 1, -(-end * new_size // size))
+
+
+def get_render_options(req: dict, screen_size: Tuple[int, int]) -> dict:
+    """
+        Render settings from the request body that are passed to the renderer as keyword
+        arguments (and are part of the render cache key).
+    """
+    max_samples = int(req.get('max_samples', 1))
+    if not 1 <= max_samples <= MAX_SAMPLES:
+        raise ValueError(f"max_samples must be between 1 and {MAX_SAMPLES}")
+    crop = req.get('crop')
+    if crop is not None:
+        crop = [int(v) for v in crop]
+        check_crop(screen_size, crop)
+    light_cutoff = float(req.get('light_cutoff', 0.0))
+    light_samples = int(req.get('light_samples', 0))
+    if light_cutoff < 0 or light_samples < 0:
+        raise ValueError("light_cutoff and light_samples can't be negative")
+    return {
+        'max_samples': max_samples,
+        'contrast_threshold': float(req.get('contrast_threshold', 0.1)),
+        'min_weight': float(req.get('min_weight', 0.0)),
+        'russian_roulette': bool(req.get('russian_roulette', False)),
+        'precision': get_precision(req.get('precision', 'float64')).name,
+        'crop': crop,
+        'shadows': bool(req.get('shadows', True)),
+        'light_cutoff': light_cutoff,
+        'light_samples': light_samples,
+    }
+
+
+def iter_scene_tiles(req: dict, scene: Scene):
+    """
+        The tiles of /stream, rendered on the tile workers with the "distributed" engine and on
+        the local process pool otherwise.
+    """
+    if req.get('engine') == 'distributed' and TILE_COORDINATOR:
+        return get_tile_coordinator().iter_render_tiles(scene)
+    return iter_render_tiles(scene)
+
+
+def get_renderer(req: dict, default: str):
+    engine = req.get('engine', default)
+    if engine not in RENDERERS:
+        raise BadRequest(
+            f"Unknown engine '{engine}', expected one of {list(RENDERERS)}")
+    return RENDERERS[engine]
+
+
+def ask_gpt4_for_scene(description: str) -> str:
+    try:
+        return ask_for_scene(scene_backend, description, scene_cache)
     except Exception as e:
-        logging.error(f"Error in parse_scene_data: {e}")
+        logging.error(f"Error in ask_gpt4_for_scene: {e}")
         raise
 
 
+def encode_png(image: np.ndarray) -> bytes:
+    return encode_png_image(image, PNG_COMPRESSION)
+
+
 def send_image(image):
+    return send_png(encode_png(image))
+
+
+def send_png(png: bytes, cache_hit: bool = False, stats: Optional[RenderStats] = None,
+             decision: Optional[str] = None, cost: Optional[RenderCost] = None):
     try:
-        bytes_io = io.BytesIO()
-        plt.imsave(bytes_io, image, format='png')
-        bytes_io.seek(0)
-        return send_file(bytes_io, mimetype='image/png')
+        response = send_file(io.BytesIO(png), mimetype='image/png')
+        response.headers['X-Render-Cache'] = 'hit' if cache_hit else 'miss'
+        if decision is not None:
+            response.headers['X-Render-Admission'] = decision
+            response.headers['X-Render-Cost'] = json.dumps(cost.to_dict(), separators=(',', ':'))
+        if stats is not None:
+            response.headers['Server-Timing'] = stats.server_timing()
+            response.headers['X-Render-Stats'] = json.dumps(stats.counters(), separators=(',', ':'))
+        return response
     except Exception as e:
-        logging.error(f"Error in send_image: {e}")
+        logging.error(f"Error in send_png: {e}")
         raise
 
 
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from core.bvh import BVH
+from core.mesh import TriangleMesh
+from core.objects import Cuboid, Plane, Rectangle, Sphere, flatten_primitives
+from core.ray import Ray
+
+
+def linear_scan(primitives, ray):
+    """
+        Nearest hit of the linear scan of Ray.nearest_intersected_object, with the index of the
+        primitive; the first of equal distances wins.
+    """
+    best = None
+    for index, primitive in enumerate(primitives):
+        intersection = primitive.intersect(ray)
+        if intersection and (best is None or intersection[0] < best[0]):
+            best = (intersection[0], intersection[1], index)
+    return best
+
+
+def box(center, size):
+    (x0, y0, z0), (x1, y1, z1) = np.subtract(center, np.divide(size, 2)), np.add(center, np.divide(size, 2))
+    return Cuboid([x0, y1, z1], [x0, y0, z1], [x1, y0, z1], [x1, y1, z1], [x1, y0, z0], [x1, y1, z0])
+
+
+def octahedron(center, radius):
+    vertices = np.array([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1]]) * radius + center
+    faces = np.array([[0, 2, 4], [2, 1, 4], [1, 3, 4], [3, 0, 4], [2, 0, 5], [1, 2, 5], [3, 1, 5], [0, 3, 5]])
+    return TriangleMesh(vertices.astype(float), faces)
+
+
+def random_objects(rng, planes=True):
+    objects = [Plane([0, 1, 0], [0, -1, 0]), Plane([0, 0, 1], [0, 0, -10])] if planes else []
+    for _ in range(12):
+        objects.append(Sphere(rng.uniform(-3, 3, 3) + [0, 0, -5], rng.uniform(0.1, 0.8)))
+    for _ in range(4):
+        a = rng.uniform(-3, 3, 3) + [0, 0, -5]
+        objects.append(Rectangle(a, a + [0, -0.6, 0], a + [0.7, -0.6, 0], a + [0.7, 0, 0]))
+        objects.append(box(rng.uniform(-3, 3, 3) + [0, 0, -5], rng.uniform(0.2, 1, 3)))
+    objects.append(octahedron(rng.uniform(-2, 2, 3) + [0, 0, -5], 0.8))
+    return objects
+
+
+def random_rays(rng, count):
+    origins = rng.uniform(-1, 1, (count, 3)) + [0, 0, 2]
+    # Most rays go towards the objects, the others anywhere (many of them miss everything)
+    directions = np.where(rng.random((count, 1)) < 0.7,
+                          rng.uniform(-1, 1, (count, 3)) * [0.6, 0.6, 0] + [0, 0, -1],
+                          rng.normal(size=(count, 3)))
+    return [Ray(origin, direction) for origin, direction in zip(origins, directions)]
+
+
+@pytest.mark.parametrize('planes', [True, False])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_nearest_hit_matches_linear_scan(seed, planes):
+    rng = np.random.default_rng(seed)
+    objects = random_objects(rng, planes)
+    primitives = flatten_primitives(objects)
+    bvh = BVH(objects)
+    misses = 0
+    for ray in random_rays(rng, 400):
+        expected = linear_scan(primitives, ray)
+        hit = bvh.nearest_hit(ray)
+        if expected is None:
+            assert hit is None
+            misses += 1
+            continue
+        dist, hit_object, index = hit
+        assert index == expected[2]
+        assert dist == expected[0]
+        assert type(hit_object) is type(expected[1])
+    if not planes:
+        assert misses > 0
+
+
+def test_cuboid_and_mesh_hits_are_covered():
+    rng = np.random.default_rng(3)
+    objects = random_objects(rng)
+    primitives = flatten_primitives(objects)
+    bvh = BVH(objects)
+    hit_types = set()
+    for ray in random_rays(rng, 2000):
+        hit = bvh.nearest_hit(ray)
+        if hit is not None:
+            hit_types.add(type(primitives[hit[2]]).__name__)
+    assert {'Plane', 'Sphere', 'Rectangle', 'TriangleMesh'} <= hit_types
+
+
+def test_equal_distances_go_to_the_lower_index():
+    # The same sphere three times, and a face shared by two cuboids
+    objects = [Sphere([0, 0, -5], 1), Sphere([2, 0, -5], 1), Sphere([0, 0, -5], 1), Sphere([0, 0, -5], 1),
+               box([0, 3, -5], [1, 1, 1]), box([0, 3, -5], [1, 1, 1])]
+    primitives = flatten_primitives(objects)
+    bvh = BVH(objects, max_leaf_size=1)
+    for direction, expected_index in (([0, 0, -1], 0), ([0, 3, -5], 4)):
+        ray = Ray(np.array([0.0, 0.0, 0.0]), np.array(direction, dtype=float))
+        assert linear_scan(primitives, ray)[2] == expected_index
+        assert bvh.nearest_hit(ray)[2] == expected_index
+
+
+def test_rays_that_miss():
+    objects = random_objects(np.random.default_rng(4), planes=False)
+    bvh = BVH(objects)
+    for direction in ([0, 0, 1], [0, 1, 0.01], [1, 0, 0.5]):
+        ray = Ray(np.array([0.0, 0.0, 5.0]), np.array(direction, dtype=float))
+        assert linear_scan(flatten_primitives(objects), ray) is None
+        assert bvh.nearest_hit(ray) is None
+        assert not bvh.occluded(ray, np.inf)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_occluded_matches_linear_scan(seed):
+    rng = np.random.default_rng(seed)
+    objects = random_objects(rng)
+    primitives = flatten_primitives(objects)
+    bvh = BVH(objects)
+    for ray in random_rays(rng, 300):
+        max_distance = rng.uniform(0.5, 12)
+        expected = any(hit and hit[0] < max_distance for hit in (p.intersect(ray) for p in primitives))
+        assert bvh.occluded(ray, max_distance) == expected
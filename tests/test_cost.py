@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from benchmarks.scenes import SCENES, mesh_scene
+from core.cost import estimate_cost, screen_fraction
+from core.instrumentation import RenderStats
+from renders import render_scene
+
+
+@pytest.mark.parametrize('data', [SCENES['example'](), SCENES['glass'](), mesh_scene(20, 10), mesh_scene(80, 40)],
+                         ids=['example', 'glass', 'mesh_400', 'mesh_6400'])
+@pytest.mark.parametrize('max_depth', [1, 3])
+def test_estimate_is_close_to_the_counters(data, max_depth):
+    stats = RenderStats()
+    render_scene(*data, (24, 18), max_depth, stats=stats)
+    estimate = estimate_cost(*data, (24, 18), max_depth)
+    counters = stats.counters()
+    assert 0.6 <= estimate.total_rays / counters['total_rays'] <= 1.5
+    assert 0.6 <= estimate.intersection_tests / counters['intersection_tests'] <= 1.5
+
+
+def test_screen_fraction():
+    camera = np.array([0.0, 0.0, 1.0])
+    # The box at z = -1 projects to half its size on the screen
+    box = (np.array([-0.5, -0.25, -1.0]), np.array([0.5, 0.25, -1.0]))
+    assert screen_fraction(camera, (4, 2), box) == pytest.approx(0.25 * 0.5 / 2)
+    assert screen_fraction(camera, (4, 2), (box[0] + [10, 0, 0], box[1] + [10, 0, 0])) == 0
+    assert screen_fraction(camera, (4, 2), (np.array([-1.0, -1, -1]), np.array([1.0, 1, 2]))) == 1
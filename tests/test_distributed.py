@@ -0,0 +1,103 @@
+import time
+import socket
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from benchmarks.scenes import SCENES
+from core.scene import Scene
+from distributed import TileCoordinator, recv_message, send_message, start_local_workers
+from renders import render_scene
+
+SCREEN_SIZE = (32, 24)
+MAX_DEPTH = 2
+
+
+@pytest.fixture
+def coordinator():
+    coordinator = TileCoordinator(heartbeat_interval=0.1, heartbeat_timeout=1.0)
+    yield coordinator
+    coordinator.close()
+
+
+def wait_for(condition, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def silent_worker(address) -> socket.socket:
+    """
+        A worker that says hello and then never sends anything, not even heartbeats.
+    """
+    sock = socket.create_connection(address)
+    send_message(sock, {'type': 'hello', 'name': 'silent'})
+    return sock
+
+
+def test_render_matches_render_scene(coordinator):
+    workers = start_local_workers(coordinator.address, 2)
+    try:
+        data = SCENES['example']()
+        for options in ({}, {'max_samples': 4, 'crop': [4, 2, 28, 20]}):
+            image = coordinator.render_scene(*data, SCREEN_SIZE, MAX_DEPTH, tile_size=8, **options)
+            np.testing.assert_array_equal(image, render_scene(*data, SCREEN_SIZE, MAX_DEPTH, **options))
+    finally:
+        for worker in workers:
+            worker.kill()
+
+
+def test_tiles_of_a_killed_worker_are_rendered_again(coordinator):
+    workers = start_local_workers(coordinator.address, 2)
+    try:
+        wait_for(lambda: len(coordinator.workers) == 2)
+        data = SCENES['example']()
+        scene = Scene(*data, SCREEN_SIZE, MAX_DEPTH)
+        image = np.zeros((SCREEN_SIZE[1], SCREEN_SIZE[0], 3))
+        for count, ((i0, i1, j0, j1), colors) in enumerate(coordinator.iter_render_tiles(scene, tile_size=4)):
+            if count == 0:
+                # Both workers are busy, the killed one loses the tile it was rendering
+                wait_for(lambda: coordinator.tasks.qsize() < 46)
+                workers[0].kill()
+            image[i0:i1, j0:j1] = colors[i0:i1, j0:j1]
+        np.testing.assert_array_equal(image, render_scene(*data, SCREEN_SIZE, MAX_DEPTH))
+        stats = coordinator.stats()
+        assert stats['lost_workers'] == 1
+        assert stats['retried'] >= 1
+        assert len(stats['workers']) == 1
+    finally:
+        for worker in workers:
+            worker.kill()
+
+
+def test_silent_worker_is_dropped(coordinator):
+    sock = silent_worker(coordinator.address)
+    try:
+        wait_for(lambda: 'silent' in str(coordinator.workers))
+        start = time.monotonic()
+        wait_for(lambda: not coordinator.workers)
+        assert time.monotonic() - start >= coordinator.heartbeat_timeout - 0.2
+        assert coordinator.stats()['lost_workers'] == 1
+    finally:
+        sock.close()
+
+
+def test_tile_of_a_silent_worker_is_rendered_by_another_one(coordinator):
+    sock = silent_worker(coordinator.address)
+    workers = []
+    try:
+        wait_for(lambda: coordinator.workers)
+        data = SCENES['example']()
+        with ThreadPoolExecutor(1) as executor:
+            image = executor.submit(coordinator.render_scene, *data, SCREEN_SIZE, MAX_DEPTH, tile_size=8)
+            # The silent worker takes the scene and the first tile, then never answers
+            assert recv_message(sock)[0]['type'] == 'scene'
+            assert recv_message(sock)[0]['type'] == 'render'
+            workers = start_local_workers(coordinator.address, 1)
+            np.testing.assert_array_equal(image.result(timeout=60), render_scene(*data, SCREEN_SIZE, MAX_DEPTH))
+        assert coordinator.stats()['retried'] == 1
+        assert coordinator.stats()['lost_workers'] == 1
+    finally:
+        sock.close()
+        for worker in workers:
+            worker.kill()
@@ -0,0 +1,70 @@
+from functools import partial
+import numpy as np
+import pytest
+from benchmarks.scenes import SCENES, mesh_scene
+from core import jit
+from core.instrumentation import RenderStats
+from core.scene import Scene
+from renders import jit_render_scene, jit_trace_scene, render_scene
+
+SCREEN_SIZE = (16, 12)
+# Scenes with every primitive, reflections, refractions and the light types
+PARITY_SCENES = {
+    'example': SCENES['example'],
+    'cuboids_32': SCENES['cuboids_32'],
+    'mirrors': SCENES['mirrors'],
+    'glass': SCENES['glass'],
+    'mesh': partial(mesh_scene, 24, 12),
+}
+VARIANTS = {
+    'default': {},
+    'antialiased': {'max_samples': 4},
+    'pruned': {'min_weight': 0.1, 'light_cutoff': 0.05},
+    'no_shadows': {'shadows': False},
+}
+
+
+@pytest.fixture
+def python_kernels():
+    # NUMBA_DISABLE_JIT=1 runs them as python with numba installed
+    if jit.numba is not None and not jit.numba.config.DISABLE_JIT:
+        pytest.skip("the kernels are compiled when numba is installed")
+
+
+@pytest.mark.parametrize('variant', list(VARIANTS))
+@pytest.mark.parametrize('scene', list(PARITY_SCENES))
+def test_python_kernels_match_render_scene(python_kernels, scene, variant):
+    data = PARITY_SCENES[scene]()
+    options = VARIANTS[variant]
+    reference_stats, kernel_stats = RenderStats(), RenderStats()
+    reference = render_scene(*data, SCREEN_SIZE, 3, stats=reference_stats, **options)
+    image = jit_trace_scene(Scene(*data, SCREEN_SIZE, 3, stats=kernel_stats, **options))
+    np.testing.assert_allclose(image, reference, rtol=0, atol=1e-6)
+    for key in ('rays', 'hits'):
+        assert kernel_stats.counters()[key] == reference_stats.counters()[key]
+
+
+@pytest.mark.parametrize('variant', list(VARIANTS))
+@pytest.mark.parametrize('scene', list(PARITY_SCENES))
+def test_compiled_kernels_match_render_scene(scene, variant):
+    numba = pytest.importorskip('numba')
+    if numba.config.DISABLE_JIT:
+        pytest.skip("NUMBA_DISABLE_JIT is set")
+    jit.set_jit_enabled(True)
+    data = PARITY_SCENES[scene]()
+    options = VARIANTS[variant]
+    assert jit.jit_supported(Scene(*data, SCREEN_SIZE, 3, **options))
+    reference_stats, kernel_stats = RenderStats(), RenderStats()
+    reference = render_scene(*data, SCREEN_SIZE, 3, stats=reference_stats, **options)
+    image = jit_render_scene(*data, SCREEN_SIZE, 3, stats=kernel_stats, **options)
+    np.testing.assert_allclose(image, reference, rtol=0, atol=1e-6)
+    for key in ('rays', 'hits'):
+        assert kernel_stats.counters()[key] == reference_stats.counters()[key]
+
+
+def test_unsupported_settings_fall_back_to_render_scene():
+    data = SCENES['example']()
+    options = {'russian_roulette': True, 'seed': 1}
+    assert not jit.jit_supported(Scene(*data, SCREEN_SIZE, 3, **options))
+    np.testing.assert_array_equal(jit_render_scene(*data, SCREEN_SIZE, 3, **options),
+                                  render_scene(*data, SCREEN_SIZE, 3, **options))
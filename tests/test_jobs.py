@@ -0,0 +1,63 @@
+import threading
+import pytest
+from jobs import QueueFull, RenderJobQueue
+
+
+def gated(gate: threading.Event, started: threading.Event = None, result: bytes = b'png'):
+    def render() -> bytes:
+        if started is not None:
+            started.set()
+        assert gate.wait(10)
+        return result
+    return render
+
+
+def test_job_goes_from_queued_to_running_to_done():
+    jobs = RenderJobQueue(workers=1)
+    gate, started = threading.Event(), threading.Event()
+    blocker = jobs.submit('blocker', gated(gate, started))
+    job = jobs.submit('scene', lambda: b'png')
+    assert started.wait(10)
+    assert (blocker.status, job.status) == ('running', 'queued')
+    gate.set()
+    assert job.done.wait(10)
+    assert job.status == 'done' and job.result == b'png'
+    assert job.started >= blocker.started and job.finished >= job.started
+    assert jobs.get(job.id) is job
+
+
+def test_identical_jobs_are_coalesced():
+    jobs = RenderJobQueue(workers=1)
+    gate = threading.Event()
+    renders = []
+    jobs.submit('blocker', gated(gate))
+    first = jobs.submit('scene', lambda: renders.append(1) or b'png')
+    second = jobs.submit('scene', lambda: renders.append(2) or b'png')
+    assert second is first and first.submissions == 2
+    gate.set()
+    assert first.done.wait(10)
+    assert renders == [1]
+    assert jobs.stats()['coalesced'] == 1
+
+
+def test_failed_job_keeps_its_error():
+    jobs = RenderJobQueue(workers=1)
+    job = jobs.submit('scene', lambda: 1 / 0)
+    assert job.done.wait(10)
+    assert job.status == 'failed' and 'division' in job.error and job.result is None
+
+
+def test_full_queue_rejects_new_jobs():
+    jobs = RenderJobQueue(workers=1, max_queued=1)
+    gate, started = threading.Event(), threading.Event()
+    jobs.submit('blocker', gated(gate, started))
+    assert started.wait(10)
+    jobs.submit('queued', lambda: b'png')
+    with pytest.raises(QueueFull):
+        jobs.submit('rejected', lambda: b'png')
+    gate.set()
+    assert jobs.stats()['rejected'] == 1
+
+
+def test_unknown_job_is_none():
+    assert RenderJobQueue(workers=0).get('missing') is None
@@ -0,0 +1,39 @@
+import os
+import numpy as np
+from core import mesh
+
+
+def write_quad(path):
+    with open(path, 'w') as f:
+        f.write("v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nf 1 2 3 4\n")
+
+
+def test_parsed_arrays_are_cached_outside_of_the_mesh_directory(tmp_path, monkeypatch):
+    mesh_dir, cache_dir = tmp_path / 'meshes', tmp_path / 'cache'
+    mesh_dir.mkdir()
+    path = str(mesh_dir / 'quad.obj')
+    write_quad(path)
+    monkeypatch.setattr(mesh, 'MESH_CACHE_DIR', str(cache_dir))
+    stat = os.stat(path)
+
+    vertices, faces = mesh.load_mesh_arrays(path, stat.st_mtime_ns, stat.st_size)
+    assert os.listdir(mesh_dir) == ['quad.obj']
+    assert len(os.listdir(cache_dir)) == 2
+    np.testing.assert_array_equal(faces, [[0, 1, 2], [0, 2, 3]])
+
+    # The cached arrays are read instead of the OBJ file
+    monkeypatch.setattr(mesh, 'load_obj', None)
+    cached_vertices, cached_faces = mesh.load_mesh_arrays(path, stat.st_mtime_ns, stat.st_size)
+    np.testing.assert_array_equal(cached_vertices, vertices)
+    np.testing.assert_array_equal(cached_faces, faces)
+
+
+def test_unwritable_cache_directory_still_loads(tmp_path, monkeypatch):
+    path = str(tmp_path / 'quad.obj')
+    write_quad(path)
+    blocker = tmp_path / 'not_a_directory'
+    blocker.write_text('')
+    monkeypatch.setattr(mesh, 'MESH_CACHE_DIR', str(blocker / 'cache'))
+    stat = os.stat(path)
+    vertices, faces = mesh.load_mesh_arrays(path, stat.st_mtime_ns, stat.st_size)
+    assert vertices.shape == (4, 3) and faces.shape == (2, 3)
@@ -0,0 +1,40 @@
+import zlib
+import struct
+import numpy as np
+from benchmarks.scenes import SCENES
+from animation import parse_animation, render_animation
+from core.png import decode_raw, encode_png, encode_raw, to_uint8
+from renders import render_scene
+
+
+def png_pixels(png: bytes, shape) -> np.ndarray:
+    # The IDAT of encode_png is a single chunk of Up filtered scanlines
+    length = struct.unpack('>I', png[33:37])[0]
+    scanlines = np.frombuffer(zlib.decompress(png[41:41 + length]), np.uint8).reshape(shape[0], -1)
+    return np.cumsum(scanlines[:, 1:], axis=0, dtype=np.uint8).reshape(shape)
+
+
+def test_raw_round_trip():
+    image = np.random.default_rng(0).random((5, 7, 3))
+    data, shape = encode_raw(image)
+    assert shape == (5, 7, 3)
+    assert len(data) == 5 * 7 * 3
+    np.testing.assert_array_equal(decode_raw(data, shape), to_uint8(image))
+
+
+def test_png_of_raw_pixels_is_the_same_file():
+    image = np.random.default_rng(1).random((6, 4, 3))
+    pixels = decode_raw(*encode_raw(image))
+    assert encode_png(pixels) == encode_png(image)
+    np.testing.assert_array_equal(png_pixels(encode_png(image), (6, 4, 3)), pixels)
+
+
+def test_animation_frames_come_back_as_raw_pixels():
+    data = SCENES['example']()
+    animation = parse_animation({'frames': 2, 'camera': [{'frame': 0, 'position': [0, 0, 1]},
+                                                         {'frame': 1, 'position': [0, 0.2, 1]}]},
+                                *data, (8, 6), 1)
+    frames = dict(render_animation(animation, 'scalar', processes=1))
+    assert sorted(frames) == [0, 1]
+    assert frames[0].dtype == np.uint8
+    np.testing.assert_array_equal(frames[0], to_uint8(render_scene(*data, (8, 6), 1)))
@@ -0,0 +1,39 @@
+import os
+from core.serialization import parse_scene_data
+from render_cache import geometry_key, scene_key
+
+MATERIAL = {'ambient': [0.1, 0, 0], 'diffuse': [0.7, 0, 0], 'specular': [1, 1, 1], 'shininess': 100,
+            'reflection': 0.5}
+SCENE = {
+    'camera': [0, 0, 1],
+    'ambient': [1, 1, 1],
+    'lights': [{'type': 'directional', 'intensity': [1, 1, 1], 'direction': [0, -1, -1]}],
+    'objects': [dict(MATERIAL, type='sphere', center=[0, 0, -3], radius=0.5),
+                dict(MATERIAL, type='mesh', file='triangle.obj', scale=1, translation=[0, 0, -2])],
+}
+
+
+def write_triangle(path, z: float, modified: int):
+    with open(path, 'w') as f:
+        f.write(f"v 0 0 {z}\nv 1 0 {z}\nv 0 1 {z}\nf 1 2 3\n")
+    os.utime(path, ns=(modified, modified))
+
+
+def keys(mesh_dir) -> tuple:
+    camera, ambient, lights, objects = parse_scene_data(SCENE, str(mesh_dir))
+    return (scene_key(camera, ambient, lights, objects, (8, 6), 3),
+            geometry_key(camera, objects, (8, 6), None, 'float64'))
+
+
+def test_keys_are_stable_for_the_same_mesh_file(tmp_path):
+    write_triangle(tmp_path / 'triangle.obj', 0, 10 ** 18)
+    assert keys(tmp_path) == keys(tmp_path)
+
+
+def test_editing_the_mesh_file_changes_the_keys(tmp_path):
+    write_triangle(tmp_path / 'triangle.obj', 0, 10 ** 18)
+    before = keys(tmp_path)
+    write_triangle(tmp_path / 'triangle.obj', 0.25, 10 ** 18 + 1)
+    after = keys(tmp_path)
+    assert before[0] != after[0]
+    assert before[1] != after[1]
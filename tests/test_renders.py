@@ -0,0 +1,104 @@
+import copy
+import numpy as np
+import pytest
+from benchmarks.scenes import SCENES
+from core.instrumentation import RenderStats
+from render_cache import GBufferCache
+from renders import fast_render_scene, render_scene, wavefront_render_scene
+
+SCREEN_SIZE = (16, 12)
+MAX_DEPTH = 2
+# Anti-aliasing and a crop on top of the defaults
+SETTINGS = {
+    'default': {},
+    'antialiased': {'max_samples': 4},
+    'crop': {'crop': [3, 2, 13, 9]},
+    'cropped_antialiased': {'crop': [3, 2, 13, 9], 'max_samples': 4},
+}
+
+
+@pytest.fixture(scope='module')
+def example():
+    return SCENES['example']()
+
+
+@pytest.mark.parametrize('settings', list(SETTINGS))
+def test_parallel_matches_render_scene(example, settings):
+    options = SETTINGS[settings]
+    reference_stats, stats = RenderStats(), RenderStats()
+    reference = render_scene(*example, SCREEN_SIZE, MAX_DEPTH, stats=reference_stats, **options)
+    image = fast_render_scene(*example, SCREEN_SIZE, MAX_DEPTH, tile_size=4, processes=2, stats=stats, **options)
+    assert image.shape == reference.shape
+    np.testing.assert_array_equal(image, reference)
+    assert stats.counters()['rays'] == reference_stats.counters()['rays']
+
+
+@pytest.mark.parametrize('settings', list(SETTINGS))
+@pytest.mark.parametrize('scene', ['example', 'glass', 'cuboids_32'])
+def test_wavefront_matches_render_scene(scene, settings):
+    data = SCENES[scene]()
+    options = SETTINGS[settings]
+    reference = render_scene(*data, SCREEN_SIZE, MAX_DEPTH, **options)
+    image = wavefront_render_scene(*data, SCREEN_SIZE, MAX_DEPTH, **options)
+    assert image.shape == reference.shape
+    np.testing.assert_allclose(image, reference, rtol=0, atol=1e-6)
+
+
+def relit(data):
+    """
+        The scene with dimmer lights and another ambient, its geometry is unchanged.
+    """
+    camera, ambient, lights, objects = data
+    lights = copy.deepcopy(lights)
+    for light in lights:
+        light.intensity = light.intensity * 0.5
+    return camera, ambient * 0.25, lights, objects
+
+
+@pytest.mark.parametrize('settings', ['default', 'crop'])
+@pytest.mark.parametrize('scene', ['example', 'cuboids_32'])
+def test_gbuffer_is_reused_when_only_the_lights_change(scene, settings):
+    data = SCENES[scene]()
+    options = SETTINGS[settings]
+    gbuffers = GBufferCache()
+    first_stats, stats = RenderStats(), RenderStats()
+    first = wavefront_render_scene(*data, SCREEN_SIZE, MAX_DEPTH, gbuffers=gbuffers, stats=first_stats, **options)
+    assert 'primary' in first_stats.counters()['rays']
+    image = wavefront_render_scene(*relit(data), SCREEN_SIZE, MAX_DEPTH, gbuffers=gbuffers, stats=stats, **options)
+    assert 'primary' not in stats.counters()['rays']
+    assert gbuffers.hits == 1
+    assert not np.allclose(image, first)
+    reference = render_scene(*relit(data), SCREEN_SIZE, MAX_DEPTH, **options)
+    np.testing.assert_allclose(image, reference, rtol=0, atol=1e-6)
+
+
+def ray_counts(renderer, data, **options) -> tuple:
+    stats = RenderStats()
+    image = renderer(*data, SCREEN_SIZE, MAX_DEPTH + 1, stats=stats, **options)
+    return image, {kind: sum(depths.values()) for kind, depths in stats.counters()['rays'].items()}
+
+
+@pytest.mark.parametrize('renderer', [render_scene, wavefront_render_scene])
+def test_min_weight_prunes_reflection_rays(renderer):
+    data = SCENES['lights_8']()
+    image, rays = ray_counts(renderer, data)
+    default_image, default_rays = ray_counts(renderer, data, min_weight=0.0, russian_roulette=False)
+    np.testing.assert_array_equal(default_image, image)
+    assert default_rays == rays
+    _, pruned = ray_counts(renderer, data, min_weight=0.1)
+    _, roulette = ray_counts(renderer, data, min_weight=0.1, russian_roulette=True)
+    assert pruned['primary'] == rays['primary']
+    assert pruned['reflection'] < roulette['reflection'] < rays['reflection']
+
+
+@pytest.mark.parametrize('renderer', [render_scene, wavefront_render_scene])
+def test_light_cutoff_and_sampling_trace_fewer_shadow_rays(renderer):
+    data = SCENES['lights_8']()
+    image, rays = ray_counts(renderer, data)
+    default_image, default_rays = ray_counts(renderer, data, light_cutoff=0.0, light_samples=0)
+    np.testing.assert_array_equal(default_image, image)
+    assert default_rays == rays
+    _, culled = ray_counts(renderer, data, light_cutoff=0.05)
+    _, sampled = ray_counts(renderer, data, light_samples=2)
+    assert culled['shadow'] < rays['shadow'] and sampled['shadow'] < rays['shadow']
+    assert culled['reflection'] == sampled['reflection'] == rays['reflection']
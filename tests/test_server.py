@@ -0,0 +1,120 @@
+import io
+import os
+import threading
+import zipfile
+import pytest
+from core.cost import estimate_cost
+
+os.environ.setdefault('SCENE_BACKEND', 'stub')
+server = pytest.importorskip('server')
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+@pytest.mark.parametrize('route, settings, message', [
+    ('/', {'resolution': [0, 16]}, 'resolution must be between'),
+    ('/fast', {'max_depth': 100}, 'max_depth must be between'),
+    ('/stream', {'crop': [0, 0, 64, 8], 'resolution': [16, 16]}, 'crop'),
+    ('/jobs', {'max_samples': 0}, 'max_samples must be between'),
+    ('/', {'precision': 'float16'}, "Unknown precision"),
+    ('/fast', {'engine': 'gpu'}, "Unknown engine"),
+    ('/', {'resolution': 'large'}, "invalid literal"),
+])
+def test_invalid_settings_are_bad_requests(client, route, settings, message):
+    response = client.post(route, json={'message': 'a red sphere', **settings})
+    assert response.status_code == 400
+    assert message in response.get_json()['error']
+
+
+@pytest.mark.parametrize('route', ['/', '/fast', '/jobs'])
+def test_preview_is_only_for_stream(client, route):
+    response = client.post(route, json={'message': 'a red sphere', 'preview': True, 'resolution': [8, 8]})
+    assert response.status_code == 400
+    assert '/stream' in response.get_json()['error']
+
+
+def test_invalid_animation_is_a_bad_request(client):
+    response = client.post('/animation', json={'message': 'a red sphere', 'resolution': [8, 8],
+                                               'animation': {'frames': 2}, 'format': 'gif'})
+    assert response.status_code == 400
+
+
+def test_valid_render(client):
+    response = client.post('/', json={'message': 'a red sphere', 'resolution': [8, 6], 'max_depth': 1})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+
+
+def animation_request(frames: int, **settings) -> dict:
+    return {'message': 'a red sphere', 'resolution': [16, 12], 'max_depth': 1, 'format': 'zip', 'engine': 'scalar',
+            'animation': {'frames': frames, 'camera': [{'frame': 0, 'position': [0, 0, 1]},
+                                                       {'frame': frames - 1, 'position': [0, 0.5, 1]}]},
+            **settings}
+
+
+def frame_cost() -> float:
+    camera, ambient, lights, objects = server.load_scene({'message': 'a red sphere'}, None)
+    return estimate_cost(camera, ambient, lights, objects, (16, 12), 1).intersection_tests
+
+
+def png_size(png: bytes) -> tuple:
+    return int.from_bytes(png[16:20], 'big'), int.from_bytes(png[20:24], 'big')
+
+
+def test_animation_over_budget_is_downscaled(client, monkeypatch):
+    # One frame fits, the 4 frames don't
+    monkeypatch.setattr(server, 'admission', server.AdmissionControl(2 * frame_cost(), policy='downscale'))
+    response = client.post('/animation', json=animation_request(4))
+    assert response.status_code == 200
+    assert response.headers['X-Render-Admission'] == 'downscale'
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        sizes = {png_size(archive.read(name)) for name in archive.namelist()}
+    assert len(sizes) == 1
+    width, height = sizes.pop()
+    assert width < 16 and height < 12
+
+
+def test_animation_over_budget_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(server, 'admission', server.AdmissionControl(2 * frame_cost(), policy='reject'))
+    response = client.post('/animation', json=animation_request(4))
+    assert response.status_code == 422
+    assert response.get_json()['cost']['intersection_tests'] >= 4 * frame_cost() - 1
+    assert client.post('/animation', json=animation_request(1)).status_code == 200
+
+
+def job_request() -> dict:
+    return {'message': 'a red sphere', 'resolution': [8, 6], 'max_depth': 1, 'engine': 'scalar'}
+
+
+def test_identical_jobs_share_one_render(client, monkeypatch):
+    monkeypatch.setattr(server, 'job_queue', server.RenderJobQueue(workers=1))
+    monkeypatch.setattr(server, 'render_cache', server.RenderCache(1024 * 1024))
+    # The worker is busy, so both submissions find the first job still queued
+    gate = threading.Event()
+    server.job_queue.submit('blocker', lambda: gate.wait(10) and b'')
+    first = client.post('/jobs', json=job_request())
+    second = client.post('/jobs', json=job_request())
+    assert first.status_code == second.status_code == 202
+    job = second.get_json()
+    assert job['id'] == first.get_json()['id']
+    assert (job['status'], job['submissions']) == ('queued', 2)
+    assert client.get(f"/jobs/{job['id']}/result").status_code == 202
+    gate.set()
+    assert server.job_queue.get(job['id']).done.wait(30)
+    assert client.get(f"/jobs/{job['id']}").get_json()['status'] == 'done'
+    result = client.get(f"/jobs/{job['id']}/result")
+    assert result.status_code == 200 and result.mimetype == 'image/png'
+    # Once done, the same scene is served from the render cache as a finished job
+    cached = client.post('/jobs', json=job_request()).get_json()
+    assert cached['status'] == 'done'
+    assert client.get(f"/jobs/{cached['id']}/result").data == result.data
+
+
+@pytest.mark.parametrize('route', ['/jobs/{}', '/jobs/{}/result'])
+def test_unknown_job_is_not_found(client, route):
+    response = client.get(route.format('missing'))
+    assert response.status_code == 404
+    assert 'Unknown job' in response.get_json()['error']